@@ -15,6 +15,16 @@ import threading
 from openai import OpenAI
 import traceback
 import re
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from mainprogress import stage_runner
+from mainprogress.job_engine import JobEngine, JOB_COMPLETED
+from mainprogress.llm_scheduler import scheduler as llm_scheduler
+from mainprogress import result_cache
+from mainprogress.llm_cache import response_cache as llm_response_cache
+from mainprogress.stage_manifest import StageManifest
+from mainprogress.page_render_cache import render_cache
+from mainprogress.page_artifacts import page_store
+from mainprogress import pdf_fast_path, llm_routes
 
 logger = logging.getLogger('gunicorn.error')
 
@@ -112,7 +122,7 @@ def upload_files():
         
         upload_folder = os.path.join(base_dir, 'input_pdf')
         pdf_path = os.path.join(upload_folder, pinyin_filename)
-        pdf_file.save(pdf_path)
+        pdf_sha256 = result_cache.save_and_hash_upload(pdf_file, pdf_path)
         
         json_filename = pinyin_filename.replace(file_extension, '.json')
         json_path = os.path.join(upload_folder, json_filename)
@@ -122,7 +132,8 @@ def upload_files():
             "toc_end": 0,
             "content_start": 0,
             "original_filename": original_filename,
-            "book_name": ""
+            "book_name": "",
+            "pdf_sha256": pdf_sha256
         }
         
         with open(json_path, 'w', encoding='utf-8') as f:
@@ -179,6 +190,84 @@ def download_result(session_id):
     
     return response
 
+def run_script_subprocess(script_name, base_dir):
+    """以独立子进程方式执行阶段脚本（后备模式），返回 (returncode, stdout, stderr)"""
+    script_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), 'mainprogress'))
+    script_path = os.path.join(script_dir, f'{stage_runner.stage_module_name(script_name)}.py')
+
+    env = os.environ.copy()
+
+    config_path = os.path.join(app.static_folder, 'llm_config.json')
+    if os.path.exists(config_path):
+        with open(config_path, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+        api_key_value = config.get('api_key', '')
+
+        env_var_name = extract_env_var_name(api_key_value)
+        if env_var_name:
+            actual_api_key = os.environ.get(env_var_name, '')
+            env[env_var_name] = actual_api_key
+            env['DASHSCOPE_API_KEY'] = actual_api_key
+        else:
+            env['DASHSCOPE_API_KEY'] = api_key_value
+
+    env.update(stage_runner.build_stage_env(base_dir))
+
+    result = subprocess.run(
+        [sys.executable, script_path],
+        env=env,
+        cwd=script_dir,
+        capture_output=True,
+        text=True,
+        timeout=SCRIPT_TIMEOUT
+    )
+    return result.returncode, result.stdout, result.stderr
+
+def load_stage_llm_config():
+    """读取阶段使用的 LLM 配置（已解析 API Key，按文件修改时间缓存）"""
+    return stage_runner.load_llm_config(os.path.join(app.static_folder, 'llm_config.json'))
+
+def dispatch_stage(script_name, base_dir, llm_config):
+    """
+    执行单个阶段，返回 (returncode, stdout, stderr)。
+    默认在常驻工作线程中直接调用阶段入口；进程内模式不可用时回退到子进程模式。
+    """
+    if stage_runner.STAGE_RUN_MODE != 'subprocess':
+        try:
+            return stage_runner.run_stage_inprocess(script_name, base_dir, llm_config, timeout=SCRIPT_TIMEOUT)
+        except (ImportError, stage_runner.StagePoolExhausted) as e:
+            logger.error(f"进程内执行不可用，回退到子进程模式：{str(e)}")
+    return run_script_subprocess(script_name, base_dir)
+
+def execute_stage(script_name, base_dir):
+    """
+    按阶段清单执行单个阶段，返回 (returncode, stdout, stderr)。
+    输入（含模型与提示词版本）未变化且上次输出完好时直接沿用上次结果，不再重新执行。
+    """
+    llm_config = load_stage_llm_config()
+    manifest = StageManifest(base_dir)
+    extra = None
+    if script_name in stage_runner.LLM_STAGES:
+        extra = [llm_routes.models_fingerprint(llm_config), result_cache.prompt_fingerprint()]
+    try:
+        input_hash = manifest.stage_input_hash(script_name, extra)
+        if manifest.is_stage_current(script_name, input_hash):
+            return 0, f"[INFO] 阶段输入未变化，沿用上次结果：{script_name}\n", ''
+        manifest.begin_stage(script_name, input_hash)
+    except OSError as e:
+        logger.error(f"读写阶段清单失败，按无清单方式执行：{str(e)}")
+        return dispatch_stage(script_name, base_dir, llm_config)
+
+    returncode, stdout, stderr = dispatch_stage(script_name, base_dir, llm_config)
+    try:
+        if returncode == 0:
+            manifest.complete_stage(script_name)
+        else:
+            manifest.fail_stage(script_name, (stderr or '')[-500:])
+    except OSError as e:
+        logger.error(f"更新阶段清单失败：{str(e)}")
+    return returncode, stdout, stderr
+
 @app.route('/run_script/<session_id>/<int:script_index>/<int:retry_count>')
 def run_script(session_id, script_index, retry_count):
     script_sequence = QWEN_SCRIPT_SEQUENCE
@@ -193,83 +282,60 @@ def run_script(session_id, script_index, retry_count):
     
     script_name, script_desc = script_sequence[script_index]
     try:
-        script_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), 'mainprogress'))
-        script_path = os.path.join(script_dir, f'{script_name}.py')
         base_dir = os.path.abspath(os.path.join('data', session_id))
-        
-        env = os.environ.copy()
-        
-        config_path = os.path.join(app.static_folder, 'llm_config.json')
-        if os.path.exists(config_path):
-            with open(config_path, 'r', encoding='utf-8') as f:
-                config = json.load(f)
-            api_key_value = config.get('api_key', '')
-            
-            env_var_name = extract_env_var_name(api_key_value)
-            if env_var_name:
-                actual_api_key = os.environ.get(env_var_name, '')
-                env[env_var_name] = actual_api_key
-                env['DASHSCOPE_API_KEY'] = actual_api_key
-            else:
-                env['DASHSCOPE_API_KEY'] = api_key_value
-        
-        env.update({
-            'BASE_DIR': base_dir,
-            'PDF_METADATA_EXTRACTOR_INPUT': f"{base_dir}/input_pdf",
-            'PDF_METADATA_EXTRACTOR_OUTPUT': f"{base_dir}/input_pdf",
-            'PDF2JPG_INPUT': f"{base_dir}/input_pdf",
-            'PDF2JPG_OUTPUT': f"{base_dir}/mark/input_image",
-            'CONTENT_POSTPROCESSOR_INPUT': f"{base_dir}/raw_content",
-            'CONTENT_POSTPROCESSOR_OUTPUT': f"{base_dir}/level_adjusted_content",
-            'PDF_GENERATOR_INPUT_1': f"{base_dir}/level_adjusted_content",
-            'PDF_GENERATOR_INPUT_2': f"{base_dir}/input_pdf",
-            'PDF_GENERATOR_OUTPUT_1': f"{base_dir}/output_pdf",
-            'QWEN_VL_INPUT': f"{base_dir}/mark/input_image",
-            'QWEN_VL_OUTPUT': f"{base_dir}/automark_raw_data"
-        })
 
-        python_executable = sys.executable
-        
-        try:
-            result = subprocess.run(
-                [python_executable, script_path],
-                env=env,
-                cwd=script_dir,
-                capture_output=True,
-                text=True,
-                timeout=SCRIPT_TIMEOUT
-            )
-            
-            if result.returncode == 0:
+        if script_index == 0:
+            start_index, cache_message = prepare_job(base_dir)
+            if start_index > 0:
                 return jsonify({
                     'status': 'success',
                     'currentScript': script_desc,
-                    'message': f'{script_desc}执行成功',
-                    'nextIndex': script_index + 1,
+                    'message': cache_message,
+                    'nextIndex': start_index,
                     'totalScripts': total_scripts,
                     'retryCount': 0,
                     'session_id': session_id,
-                    'stdout': result.stdout,
-                    'stderr': result.stderr
-                })
-            else:
-                return jsonify({
-                    'status': 'error',
-                    'currentScript': script_desc,
-                    'message': f'{script_desc}执行失败',
-                    'stdout': result.stdout,
-                    'stderr': result.stderr,
-                    'retryCount': retry_count,
-                    'scriptIndex': script_index,
-                    'session_id': session_id
+                    'stdout': '',
+                    'stderr': ''
                 })
-        except subprocess.TimeoutExpired as e:
+
+        try:
+            returncode, stdout, stderr = execute_stage(script_name, base_dir)
+        except (subprocess.TimeoutExpired, FutureTimeoutError) as e:
+            stdout = getattr(e, 'stdout', None)
+            stderr = getattr(e, 'stderr', None)
             return jsonify({
                 'status': 'error',
                 'currentScript': script_desc,
                 'message': f'脚本执行超时（{SCRIPT_TIMEOUT}秒）',
-                'stdout': e.stdout.decode() if e.stdout else '',
-                'stderr': e.stderr.decode() if e.stderr else '',
+                'stdout': stdout.decode() if isinstance(stdout, bytes) else (stdout or ''),
+                'stderr': stderr.decode() if isinstance(stderr, bytes) else (stderr or ''),
+                'retryCount': retry_count,
+                'scriptIndex': script_index,
+                'session_id': session_id
+            })
+
+        if returncode == 0:
+            if script_index == total_scripts - 1:
+                on_job_completed(base_dir)
+            return jsonify({
+                'status': 'success',
+                'currentScript': script_desc,
+                'message': f'{script_desc}执行成功',
+                'nextIndex': script_index + 1,
+                'totalScripts': total_scripts,
+                'retryCount': 0,
+                'session_id': session_id,
+                'stdout': stdout,
+                'stderr': stderr
+            })
+        else:
+            return jsonify({
+                'status': 'error',
+                'currentScript': script_desc,
+                'message': f'{script_desc}执行失败',
+                'stdout': stdout,
+                'stderr': stderr,
                 'retryCount': retry_count,
                 'scriptIndex': script_index,
                 'session_id': session_id
@@ -286,6 +352,100 @@ def run_script(session_id, script_index, retry_count):
             'session_id': session_id
         })
 
+
+def prepare_job(base_dir):
+    """命中整书结果缓存或 PDF 已有可用书签时直接跳到 pdf_generator，返回 (起始阶段序号, 提示信息)"""
+    generator_index = [name for name, _ in QWEN_SCRIPT_SEQUENCE].index('pdf_generator')
+    try:
+        if result_cache.restore_session(base_dir, load_stage_llm_config()):
+            return generator_index, '命中结果缓存，跳过目录识别步骤，直接生成 PDF'
+    except Exception as e:
+        logger.error(f"读取结果缓存失败：{str(e)}")
+    try:
+        entry_count = pdf_fast_path.apply_outline_fast_path(base_dir)
+        if entry_count:
+            return generator_index, f'PDF 已有书签（{entry_count} 条），跳过目录识别步骤，直接生成 PDF'
+    except Exception as e:
+        logger.error(f"检查 PDF 已有书签失败：{str(e)}")
+    return 0, None
+
+def on_job_completed(base_dir):
+    """整条流水线成功后写入结果缓存"""
+    try:
+        result_cache.save_session(base_dir, load_stage_llm_config())
+    except Exception as e:
+        logger.error(f"写入结果缓存失败：{str(e)}")
+
+job_engine = JobEngine(QWEN_SCRIPT_SEQUENCE, execute_stage, prepare_job=prepare_job, on_completed=on_job_completed,
+                       stage_alive=stage_runner.stage_alive)
+
+def get_session_dir(session_id):
+    """返回 session 目录的绝对路径；session_id 非法或目录不存在时返回 None"""
+    if not re.fullmatch(r'[A-Za-z0-9_]+', session_id or ''):
+        return None
+    base_dir = os.path.abspath(os.path.join('data', session_id))
+    return base_dir if os.path.isdir(base_dir) else None
+
+@app.route('/jobs', methods=['POST'])
+def create_job():
+    data = request.get_json(silent=True) or {}
+    session_id = data.get('session_id', '')
+    base_dir = get_session_dir(session_id)
+    if not base_dir:
+        return jsonify({'status': 'error', 'message': f'session 不存在：{session_id}'}), 404
+
+    job = job_engine.submit(session_id, base_dir)
+    return jsonify({'status': 'success', 'message': '作业已提交', 'job': job})
+
+@app.route('/jobs/<session_id>')
+def get_job(session_id):
+    base_dir = get_session_dir(session_id)
+    job = job_engine.get(session_id, base_dir) if base_dir else None
+    if not job:
+        return jsonify({'status': 'error', 'message': f'未找到作业：{session_id}'}), 404
+    return jsonify({'status': 'success', 'job': job})
+
+@app.route('/jobs/<session_id>/result')
+def get_job_result(session_id):
+    base_dir = get_session_dir(session_id)
+    job = job_engine.get(session_id, base_dir) if base_dir else None
+    if not job:
+        return jsonify({'status': 'error', 'message': f'未找到作业：{session_id}'}), 404
+    if job['state'] != JOB_COMPLETED:
+        return jsonify({'status': 'error', 'message': f"作业尚未完成（当前状态：{job['state']}）", 'job': job}), 409
+    return download_result(session_id)
+
+@app.route('/llm_scheduler_stats')
+def llm_scheduler_stats():
+    """全局 LLM 调度器的并发上限、排队情况及各 session 的请求统计"""
+    return jsonify({'status': 'success', 'stats': llm_scheduler.stats()})
+
+@app.route('/llm_cache_stats')
+def llm_cache_stats():
+    """LLM 响应缓存的命中/未命中次数及占用空间（仅统计本进程）"""
+    return jsonify({'status': 'success', 'stats': llm_response_cache.stats()})
+
+@app.route('/clear_llm_cache', methods=['POST'])
+def clear_llm_cache():
+    removed = llm_response_cache.clear()
+    return jsonify({'status': 'success', 'message': f'已清除 {removed} 条缓存', 'removed': removed})
+
+@app.route('/render_cache_stats')
+def render_cache_stats():
+    """页面渲染缓存与编码页面存储的命中次数与内存占用（仅统计本进程）"""
+    return jsonify({'status': 'success', 'stats': {'render': render_cache.stats(), 'encoded_pages': page_store.stats()}})
+
+@app.route('/result_cache_stats')
+def result_cache_stats():
+    return jsonify({'status': 'success', 'stats': result_cache.result_cache.stats()})
+
+@app.route('/invalidate_result_cache', methods=['POST'])
+def invalidate_result_cache():
+    """清除整书结果缓存；only_stale=true 时仅清除提示词版本已过期的条目"""
+    data = request.get_json(silent=True) or {}
+    removed = result_cache.result_cache.invalidate(only_stale=bool(data.get('only_stale')))
+    return jsonify({'status': 'success', 'message': f'已清除 {removed} 条缓存', 'removed': removed})
+
 @app.route('/stream_log')
 def stream_log():
     def generate():
@@ -342,6 +502,12 @@ def save_llm_config():
             os.makedirs(static_dir)
             
         config_path = os.path.join(static_dir, 'llm_config.json')
+        # 前端只编辑顶层字段，保留已有的按调用类别路由配置
+        if 'routes' not in config and os.path.exists(config_path):
+            with open(config_path, 'r', encoding='utf-8') as f:
+                routes = json.load(f).get('routes')
+            if routes:
+                config['routes'] = routes
         with open(config_path, 'w', encoding='utf-8') as f:
             json.dump(config, f, ensure_ascii=False, indent=2)
             
@@ -470,6 +636,12 @@ if __name__ == '__main__':
             webbrowser.open_new(f'http://127.0.0.1:{port}')
             
         threading.Thread(target=open_browser).start()
+
+        if stage_runner.STAGE_RUN_MODE != 'subprocess':
+            try:
+                stage_runner.start_worker()
+            except ImportError as e:
+                print(f"进程内阶段执行不可用，将使用子进程模式：{e}")
         
         print(f"Starting server on port {port}")
         app.run(debug=True, port=port, use_reloader=False, threaded=True)
\ No newline at end of file
@@ -0,0 +1,128 @@
+import os
+import json
+import time
+import queue
+import logging
+import threading
+
+# 元数据提取阶段的调试产物（窗口拼接图、模型原始响应、解析结果、偏移量采样日志等）。
+# 写入全部交给后台线程，协程只负责入队；逐次调用的小记录合并写入 session 的 initial_data/artifacts.jsonl，
+# 不再每个窗口各写两三个 JSON 文件。ARTIFACT_LEVEL 控制写入内容：
+# - off：不写任何调试产物；
+# - summary：写汇总 JSON（偏移量采样、预筛选、目录搜索统计、文字层报告）与 JSONL 调用记录；
+# - full：在 summary 基础上保存送给模型的拼接图片（生产环境可关闭以节省磁盘 I/O）。
+ARTIFACT_LEVEL = os.getenv('ARTIFACT_LEVEL', 'full')
+
+LEVEL_OFF = 'off'
+LEVEL_SUMMARY = 'summary'
+LEVEL_FULL = 'full'
+LEVEL_RANKS = {LEVEL_OFF: 0, LEVEL_SUMMARY: 1, LEVEL_FULL: 2}
+RECORDS_FILENAME = 'artifacts.jsonl'
+
+logger = logging.getLogger(__name__)
+
+
+class _BackgroundWriter:
+    """单个后台线程按顺序执行写入；同一批次中追加到同一 JSONL 文件的记录合并为一次写入"""
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, op, path=None, payload=None):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='artifact-writer', daemon=True)
+                self._thread.start()
+        self._queue.put((op, path, payload))
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            lines = {}
+            flushed = []
+            for op, path, payload in batch:
+                if op == 'line':
+                    lines.setdefault(path, []).append(payload)
+                elif op == 'file':
+                    # 文件写入前先落盘已排队的记录，保持提交顺序
+                    self._write_lines(lines)
+                    lines = {}
+                    self._write_file(path, payload)
+                elif op == 'flush':
+                    flushed.append(payload)
+            self._write_lines(lines)
+            for event in flushed:
+                event.set()
+
+    @staticmethod
+    def _write_lines(lines):
+        for path, items in lines.items():
+            try:
+                with open(path, 'a', encoding='utf-8') as f:
+                    f.write(''.join(items))
+            except OSError as e:
+                logger.warning(f"调试记录写入失败 {path}: {e}")
+
+    @staticmethod
+    def _write_file(path, data):
+        try:
+            mode = 'wb' if isinstance(data, bytes) else 'w'
+            with open(path, mode, **({} if isinstance(data, bytes) else {'encoding': 'utf-8'})) as f:
+                f.write(data)
+        except OSError as e:
+            logger.warning(f"调试文件写入失败 {path}: {e}")
+
+
+_writer = _BackgroundWriter()
+
+
+class ArtifactSink:
+    """某个 session 的调试产物入口：方法只做序列化与入队，不阻塞调用方；close() 等待已提交的写入完成"""
+
+    def __init__(self, directory, level=None):
+        self.directory = directory
+        self.level = level or ARTIFACT_LEVEL
+        if self.level not in LEVEL_RANKS:
+            self.level = LEVEL_FULL
+        if self.enabled():
+            os.makedirs(directory, exist_ok=True)
+            # 重新执行阶段时从空记录开始，与原先逐个覆盖的 JSON 文件语义一致
+            records_path = os.path.join(directory, RECORDS_FILENAME)
+            if os.path.exists(records_path):
+                os.remove(records_path)
+
+    def enabled(self, level=LEVEL_SUMMARY) -> bool:
+        return LEVEL_RANKS[self.level] >= LEVEL_RANKS[level]
+
+    def image_path(self, filename):
+        """full 级别下图片的保存路径（由渲染进程直接写出），否则返回 None"""
+        return os.path.join(self.directory, filename) if self.enabled(LEVEL_FULL) else None
+
+    def record(self, kind, **fields):
+        """追加一条调用记录到 artifacts.jsonl"""
+        if not self.enabled():
+            return
+        line = json.dumps({'kind': kind, 'time': round(time.time(), 3), **fields}, ensure_ascii=False, default=str)
+        _writer.submit('line', os.path.join(self.directory, RECORDS_FILENAME), line + '\n')
+
+    def write_json(self, filename, data):
+        """写出汇总 JSON 文件（整体覆盖）"""
+        if not self.enabled():
+            return
+        text = json.dumps(data, ensure_ascii=False, indent=2, default=str)
+        _writer.submit('file', os.path.join(self.directory, filename), text)
+
+    def close(self, timeout=30):
+        """等待此前提交的所有写入落盘"""
+        if not self.enabled():
+            return
+        done = threading.Event()
+        _writer.submit('flush', payload=done)
+        done.wait(timeout)
@@ -0,0 +1,48 @@
+"""
+目录提取批量基准：在同一组目录页图片上比较每次请求打包 1、2、3、4 页时的请求次数、token 用量与耗时。
+
+用法：python mainprogress/benchmark_extract_batch.py <目录页图片目录> [批量大小 ...]
+图片目录通常为某个 session 的 mark/input_image；使用 static/llm_config.json 中 extract 类别的模型，运行期间关闭 LLM 响应缓存。
+"""
+import os
+import sys
+import asyncio
+import tempfile
+from pathlib import Path
+
+os.environ['LLM_CACHE_ENABLED'] = '0'
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mainprogress import qwen_vl_extract
+
+DEFAULT_SIZES = (1, 2, 3, 4)
+
+
+async def run_size(input_path, llm_config, batch_size):
+    qwen_vl_extract.EXTRACT_BATCH_SIZE = batch_size
+    with tempfile.TemporaryDirectory() as base_dir:
+        stats = await qwen_vl_extract.extract_csv(input_path, Path(base_dir) / "raw_content", llm_config)
+    total = stats['prompt_tokens'] + stats['completion_tokens']
+    print(f"N={batch_size}  请求 {stats['requests']:>3} 次（回退 {stats['batch_fallbacks']} 批）  "
+          f"输入 {stats['prompt_tokens']:>7}  输出 {stats['completion_tokens']:>6}  合计 {total:>7} token  {stats.get('elapsed', 0):7.2f}s")
+    return total, stats.get('elapsed', 0)
+
+
+async def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    input_path = Path(sys.argv[1]).resolve()
+    sizes = [int(arg) for arg in sys.argv[2:]] or DEFAULT_SIZES
+    llm_config = qwen_vl_extract.load_llm_config()
+    print(f"图片目录：{input_path}")
+    results = {size: await run_size(input_path, llm_config, size) for size in sizes}
+    base_tokens, base_time = results[sizes[0]]
+    for size in sizes[1:]:
+        tokens, elapsed = results[size]
+        print(f"N={sizes[0]} -> N={size}：token {base_tokens} -> {tokens}，耗时 {base_time:.2f}s -> {elapsed:.2f}s")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
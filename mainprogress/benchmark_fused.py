@@ -0,0 +1,60 @@
+"""
+合并模式基准：在同一组目录页图片上比较逐阶段（提取 + 层级判定两次请求）与合并模式（每页一次请求）的
+请求次数、输入 token（主要为图片）与耗时；合并模式分别测试附带与不附带首图示例图片两种情况。
+
+用法：python mainprogress/benchmark_fused.py <目录页图片目录>
+两种模式分别使用 static/llm_config.json 中 extract / levels 类别的模型（合并模式只使用 levels）；运行期间关闭 LLM 响应缓存。
+"""
+import os
+import sys
+import time
+import asyncio
+import tempfile
+from pathlib import Path
+
+os.environ['LLM_CACHE_ENABLED'] = '0'
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mainprogress import qwen_vl_extract, determine_toc_levels, fused_toc
+
+
+def report(label, requests, prompt_tokens, completion_tokens, elapsed):
+    print(f"{label:<14} 请求 {requests:>3} 次  输入 {prompt_tokens:>7}  输出 {completion_tokens:>6} token  {elapsed:6.2f}s")
+    return requests, prompt_tokens
+
+
+async def run_staged(input_path, llm_config):
+    started = time.perf_counter()
+    with tempfile.TemporaryDirectory() as base_dir:
+        output_path = Path(base_dir) / "raw_content"
+        extract_stats = await qwen_vl_extract.extract_csv(input_path, output_path, llm_config)
+        level_stats = await determine_toc_levels.determine_levels(input_path, output_path, llm_config)
+    return report("逐阶段", extract_stats['requests'] + level_stats['requests'],
+                  extract_stats['prompt_tokens'] + level_stats['prompt_tokens'],
+                  extract_stats['completion_tokens'] + level_stats['completion_tokens'], time.perf_counter() - started)
+
+
+async def run_fused(input_path, llm_config, example_image):
+    fused_toc.FUSED_EXAMPLE_IMAGE = example_image
+    started = time.perf_counter()
+    with tempfile.TemporaryDirectory() as base_dir:
+        stats = await fused_toc.extract_with_levels(input_path, Path(base_dir) / "raw_content", llm_config)
+    label = "合并（示例图）" if example_image else "合并（无示例图）"
+    return report(label, stats['requests'], stats['prompt_tokens'], stats['completion_tokens'], time.perf_counter() - started)
+
+
+async def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    input_path = Path(sys.argv[1]).resolve()
+    llm_config = qwen_vl_extract.load_llm_config()
+    staged = await run_staged(input_path, llm_config)
+    for example_image in (True, False):
+        requests, prompt_tokens = await run_fused(input_path, llm_config, example_image)
+        print(f"  相对逐阶段：请求 {requests / staged[0] * 100:.0f}%，输入 token {prompt_tokens / staged[1] * 100:.0f}%")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,50 @@
+"""
+请求对冲基准：在同一组目录页图片上多次执行目录数据提取，比较关闭与开启对冲时的阶段耗时分布（p50 / p99）。
+
+用法：python mainprogress/benchmark_hedging.py <目录页图片目录> [运行次数，默认 10]
+使用 static/llm_config.json 中 extract 类别的模型；运行期间关闭 LLM 响应缓存。每种模式开始前清空延迟样本，
+前几次运行用于积累样本（样本不足 LLM_HEDGE_MIN_SAMPLES 时不对冲），同样计入统计。
+"""
+import os
+import sys
+import asyncio
+import tempfile
+from pathlib import Path
+
+os.environ['LLM_CACHE_ENABLED'] = '0'
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mainprogress import qwen_vl_extract, llm_hedge, llm_routes
+from mainprogress.llm_hedge import quantile
+
+
+async def run_mode(input_path, llm_config, runs, enabled):
+    llm_hedge.LLM_HEDGE_ENABLED = enabled
+    llm_hedge.reset_policies()
+    elapsed = []
+    for _ in range(runs):
+        with tempfile.TemporaryDirectory() as base_dir:
+            stats = await qwen_vl_extract.extract_csv(input_path, Path(base_dir) / "raw_content", llm_config)
+        elapsed.append(stats['elapsed'])
+    hedge = llm_hedge.hedge_policy(llm_routes.EXTRACT).stats()
+    label = '对冲' if enabled else '无对冲'
+    print(f"{label:<6} 阶段耗时 p50 {quantile(elapsed, 0.5):6.2f}s  p99 {quantile(elapsed, 0.99):6.2f}s  "
+          f"请求 {hedge['calls']}，触发对冲 {hedge['hedged']}（胜出 {hedge['hedge_won']}）")
+    return quantile(elapsed, 0.99)
+
+
+async def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    input_path = Path(sys.argv[1]).resolve()
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    llm_config = qwen_vl_extract.load_llm_config()
+    base_p99 = await run_mode(input_path, llm_config, runs, False)
+    hedged_p99 = await run_mode(input_path, llm_config, runs, True)
+    print(f"p99 阶段耗时 {base_p99:.2f}s -> {hedged_p99:.2f}s，节省 {base_p99 - hedged_p99:.2f}s")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,57 @@
+"""
+层级判定投机执行基准：先对目录页图片提取一次 CSV，再分别在等待首图示例（LEVELS_SPECULATIVE=0）与投机执行两种方式下
+多次执行层级判定，比较阶段耗时、请求次数以及投机结果的采用与重判页数。
+
+用法：python mainprogress/benchmark_level_speculation.py <目录页图片目录> [运行次数，默认 3]
+使用 static/llm_config.json 中 extract / levels 类别的模型；运行期间关闭 LLM 响应缓存，每次运行使用新的输出目录（无阶段清单可沿用）。
+"""
+import os
+import sys
+import time
+import shutil
+import asyncio
+import tempfile
+from pathlib import Path
+
+os.environ['LLM_CACHE_ENABLED'] = '0'
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mainprogress import qwen_vl_extract, determine_toc_levels
+
+
+async def run_mode(input_path, csv_path, llm_config, runs, speculative):
+    determine_toc_levels.LEVELS_SPECULATIVE = speculative
+    elapsed, totals = [], {'requests': 0, 'speculative': 0, 'speculative_accepted': 0, 'speculative_rerun': 0}
+    for _ in range(runs):
+        with tempfile.TemporaryDirectory() as base_dir:
+            output_path = Path(base_dir) / "raw_content"
+            shutil.copytree(csv_path, output_path)
+            started = time.perf_counter()
+            stats = await determine_toc_levels.determine_levels(input_path, output_path, llm_config)
+            elapsed.append(time.perf_counter() - started)
+        for key in totals:
+            totals[key] += stats[key]
+    label = '投机执行' if speculative else '等待首图'
+    print(f"{label:<6} 平均耗时 {sum(elapsed) / runs:6.2f}s  每次请求 {totals['requests'] / runs:5.1f} 次  "
+          f"投机 {totals['speculative']} 页（采用 {totals['speculative_accepted']}，重判 {totals['speculative_rerun']}）")
+    return sum(elapsed) / runs
+
+
+async def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    input_path = Path(sys.argv[1]).resolve()
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    llm_config = qwen_vl_extract.load_llm_config()
+    with tempfile.TemporaryDirectory() as csv_dir:
+        csv_path = Path(csv_dir) / "raw_content"
+        await qwen_vl_extract.extract_csv(input_path, csv_path, llm_config)
+        waiting = await run_mode(input_path, csv_path, llm_config, runs, False)
+        speculative = await run_mode(input_path, csv_path, llm_config, runs, True)
+    print(f"层级判定平均耗时 {waiting:.2f}s -> {speculative:.2f}s")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,52 @@
+"""
+输出格式基准：在同一组目录页图片上依次执行目录数据提取与层级判定，比较 CSV 与结构化输出（json_schema）两种模式下
+每本书的请求次数与因内容不合格而重发的比例。
+
+用法：python mainprogress/benchmark_output_mode.py <目录页图片目录> [运行次数，默认 3]
+使用 static/llm_config.json 中 extract / levels 类别的模型，服务端须支持 response_format；运行期间关闭 LLM 响应缓存。
+"""
+import os
+import sys
+import asyncio
+import tempfile
+from pathlib import Path
+
+os.environ['LLM_CACHE_ENABLED'] = '0'
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mainprogress import qwen_vl_extract, determine_toc_levels, structured_output
+
+MODES = (structured_output.OUTPUT_MODE_CSV, structured_output.OUTPUT_MODE_JSON_SCHEMA)
+
+
+async def run_mode(input_path, llm_config, runs, mode):
+    structured_output.LLM_OUTPUT_MODE = mode
+    totals = {'pages': 0, 'requests': 0, 'retries': 0}
+    for _ in range(runs):
+        with tempfile.TemporaryDirectory() as base_dir:
+            output_path = Path(base_dir) / "raw_content"
+            extract_stats = await qwen_vl_extract.extract_csv(input_path, output_path, llm_config)
+            level_stats = await determine_toc_levels.determine_levels(input_path, output_path, llm_config)
+        for stats in (extract_stats, level_stats):
+            for key in totals:
+                totals[key] += stats[key]
+    retry_rate = totals['retries'] / totals['requests'] * 100 if totals['requests'] else 0.0
+    print(f"{mode:<12} 每本书请求 {totals['requests'] / runs:6.1f} 次（{totals['pages'] / runs:.0f} 页次），"
+          f"重发 {totals['retries']} 次，重发占比 {retry_rate:.1f}%")
+    return totals['requests'] / runs
+
+
+async def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    input_path = Path(sys.argv[1]).resolve()
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    llm_config = qwen_vl_extract.load_llm_config()
+    results = {mode: await run_mode(input_path, llm_config, runs, mode) for mode in MODES}
+    print(f"每本书请求次数 {results[MODES[0]]:.1f} -> {results[MODES[1]]:.1f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,79 @@
+"""
+pdf_to_image 光栅化基准：比较逐页串行渲染与多进程并行渲染的吞吐（页/秒）。
+
+用法：python mainprogress/benchmark_pdf_to_image.py <PDF 路径> [起始页] [结束页]
+页码从 1 开始，默认渲染全部页面（最多 60 页）；进程数依次测试 1、2、4 … 直到 RENDER_WORKERS（环境变量）。
+"""
+import os
+import sys
+import time
+import tempfile
+
+import fitz  # PyMuPDF
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mainprogress.page_render_cache import zoom_for_long_edge
+from mainprogress.render_pool import RENDER_WORKERS, get_render_pool, render_pages_to_jpeg
+
+TARGET_LONG_EDGE = 1500
+
+
+def run_serial(pdf_path, page_indices, output_dir):
+    """原有实现：单线程逐页渲染并以 pix.save 写出 JPG"""
+    doc = fitz.open(pdf_path)
+    try:
+        for page_index in page_indices:
+            page = doc[page_index]
+            zoom = zoom_for_long_edge(page, TARGET_LONG_EDGE)
+            if zoom is None:
+                continue
+            pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+            pix.save(os.path.join(output_dir, f"page_{page_index + 1}.jpg"))
+    finally:
+        doc.close()
+
+
+def run_pool(pdf_path, page_indices, output_dir, workers):
+    for page_index, (_, _, jpeg_bytes) in render_pages_to_jpeg(pdf_path, page_indices, TARGET_LONG_EDGE, workers).items():
+        with open(os.path.join(output_dir, f"page_{page_index + 1}.jpg"), 'wb') as f:
+            f.write(jpeg_bytes)
+
+
+def timed(label, page_count, func, *args):
+    started = time.perf_counter()
+    func(*args)
+    elapsed = time.perf_counter() - started
+    print(f"{label:<16} {elapsed:8.2f}s  {page_count / elapsed:8.2f} 页/秒")
+    return elapsed
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    pdf_path = os.path.abspath(sys.argv[1])
+    with fitz.open(pdf_path) as doc:
+        total_pages = len(doc)
+    start = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    end = int(sys.argv[3]) if len(sys.argv) > 3 else min(total_pages, 60)
+    max_workers = RENDER_WORKERS
+    page_indices = list(range(start - 1, min(end, total_pages)))
+    print(f"PDF: {pdf_path}  页码范围：{start}-{end}（{len(page_indices)} 页）  长边：{TARGET_LONG_EDGE}px  CPU：{os.cpu_count()}")
+
+    # 预先启动进程池，进程启动开销不计入吞吐（常驻服务中进程池只启动一次）
+    started = time.perf_counter()
+    list(get_render_pool().map(abs, range(max_workers)))
+    print(f"进程池启动耗时：{time.perf_counter() - started:.2f}s")
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        baseline = timed("串行（原实现）", len(page_indices), run_serial, pdf_path, page_indices, output_dir)
+        workers = 1
+        while workers <= max_workers:
+            elapsed = timed(f"{workers} 进程", len(page_indices), run_pool, pdf_path, page_indices, output_dir, workers)
+            print(f"{'':<16} 加速比 {baseline / elapsed:.2f}x")
+            workers *= 2
+
+
+if __name__ == "__main__":
+    main()
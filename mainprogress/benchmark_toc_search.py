@@ -0,0 +1,62 @@
+"""
+目录范围搜索基准：在同一批 PDF 上比较滑动窗口（sliding）与自适应搜索（adaptive）的模型调用次数与耗时。
+
+用法：python mainprogress/benchmark_toc_search.py <PDF 路径> [<PDF 路径> ...]
+使用 static/llm_config.json 中的模型；运行期间关闭 LLM 响应缓存，每种策略前重启渲染进程池（清空工作进程中的渲染缓存），保证两种策略条件一致。
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import tempfile
+
+os.environ['LLM_CACHE_ENABLED'] = '0'
+
+from openai import AsyncOpenAI
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mainprogress import pdf_metadata_extractor
+from mainprogress.artifact_sink import ArtifactSink, LEVEL_SUMMARY
+from mainprogress.render_pool import get_render_pool, shutdown_render_pool
+
+MODES = ('sliding', 'adaptive')
+
+
+async def run_mode(pdf_path, client, model, mode):
+    pdf_metadata_extractor.TOC_SEARCH_MODE = mode
+    shutdown_render_pool()
+    # 进程启动开销不计入耗时
+    await asyncio.get_running_loop().run_in_executor(get_render_pool(), abs, 0)
+    with tempfile.TemporaryDirectory() as initial_data_dir:
+        artifacts = ArtifactSink(initial_data_dir, LEVEL_SUMMARY)
+        started = time.perf_counter()
+        toc_range = await pdf_metadata_extractor.extract_toc_info(pdf_path, client, model, artifacts)
+        elapsed = time.perf_counter() - started
+        artifacts.close()
+        with open(os.path.join(initial_data_dir, "toc_search_stats.json"), 'r', encoding='utf-8') as f:
+            stats = json.load(f)
+    calls = stats['window_calls'] + stats['single_calls']
+    print(f"{mode:<10} {calls:>4} 次（窗口 {stats['window_calls']}，单页 {stats['single_calls']}，"
+          f"取消 {stats['cancelled_windows']}）  {elapsed:7.2f}s  目录页 {toc_range[0]}-{toc_range[1]}")
+    return calls, elapsed
+
+
+async def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    llm_config = pdf_metadata_extractor.load_llm_config()
+    client = AsyncOpenAI(api_key=llm_config["api_key"], base_url=llm_config["base_url"])
+    model = llm_config["model"]
+
+    for pdf_path in map(os.path.abspath, sys.argv[1:]):
+        print(f"PDF: {pdf_path}  模型：{model}")
+        results = {mode: await run_mode(pdf_path, client, model, mode) for mode in MODES}
+        (base_calls, base_time), (calls, elapsed) = results['sliding'], results['adaptive']
+        print(f"{'':<10} 调用次数 {base_calls} -> {calls}，耗时 {base_time:.2f}s -> {elapsed:.2f}s")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -9,6 +9,8 @@ import dotenv
 project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(project_root)
 
+from mainprogress.stage_manifest import atomic_write_json
+
 # 加载 .env 文件 (路径逻辑保持不变)
 dotenv.load_dotenv()
 
@@ -92,10 +94,10 @@ def normalize_levels(data: list) -> list:
     return data
 
 
-def main():
-    # 保持原始的环境变量读取逻辑
-    input_dir = Path(os.environ.get('CONTENT_POSTPROCESSOR_INPUT', 'input'))
-    output_dir = Path(os.environ.get('CONTENT_POSTPROCESSOR_OUTPUT', 'output'))
+def postprocess_contents(input_dir, output_dir):
+    """合并各页层级结果并归一化，输出 <书名>_final.json"""
+    input_dir = Path(input_dir)
+    output_dir = Path(output_dir)
     os.makedirs(input_dir, exist_ok=True)
     os.makedirs(output_dir, exist_ok=True)
 
@@ -134,11 +136,22 @@ def main():
 
     # 直接保存最终结果到输出目录
     final_output_file = output_dir / f"{book_title}_final.json"
-    with open(final_output_file, 'w', encoding='utf-8') as f:
-        json.dump(combined_data, f, ensure_ascii=False, indent=2)
+    atomic_write_json(final_output_file, combined_data)
     
     print(f"处理完成，结果已保存至：{final_output_file}")
 
 
+def run_stage(input_dir, output_dir):
+    """阶段入口：供 app.py 在常驻进程内直接调用"""
+    postprocess_contents(input_dir, output_dir)
+
+
+def main():
+    # 保持原始的环境变量读取逻辑
+    input_dir = os.environ.get('CONTENT_POSTPROCESSOR_INPUT', 'input')
+    output_dir = os.environ.get('CONTENT_POSTPROCESSOR_OUTPUT', 'output')
+    run_stage(input_dir, output_dir)
+
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
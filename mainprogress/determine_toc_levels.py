@@ -1,22 +1,43 @@
 import os
 import json
 import asyncio
-import base64
 import sys
 import re
 import csv
 from pathlib import Path
-from io import BytesIO, StringIO
-from PIL import Image
+from io import StringIO
 from dotenv import load_dotenv
 from openai import AsyncOpenAI, APIError, Timeout
 
+PROJECT_ROOT = str(Path(__file__).resolve().parent.parent)
+sys.path.append(PROJECT_ROOT)
+
+from mainprogress.stage_context import StageError, run_async, get_session_base_dir
+from mainprogress.llm_scheduler import chat_completion
+from mainprogress.image_prefetch import ImagePrefetcher
+from mainprogress.stage_manifest import StageManifest, atomic_write_json, file_sha256, hash_values
+from mainprogress import llm_routes, llm_hedge, structured_output
+from mainprogress.structured_output import LEVEL_FIELDS
+
 # 配置常量
 IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.webp'}
-MAX_IMAGE_DIMENSION = 1500
-CONCURRENT_LIMIT = 15
+CONCURRENT_LIMIT = 15  # 单个 session 同时处理的页数上限；LLM 请求的全局并发由 llm_scheduler 统一控制
 MAX_RETRIES = 5
 REQUEST_TIMEOUT = 180  # 秒
+STAGE_NAME = 'determine_toc_levels'
+# 投机执行：首图需要请求模型时，其余页面不再等待示例，先不带示例并发判定；首图完成后
+# 与其结果逐条比对编号样式对应的层级，一致的直接采用，不一致的带示例重新判定一次。
+# 设置 LEVELS_SPECULATIVE=0 恢复先等待首图示例再并发处理。
+LEVELS_SPECULATIVE = os.getenv('LEVELS_SPECULATIVE', '1') == '1'
+# 用于比对层级的标题编号样式：(正则, 样式名或由匹配结果生成样式名的函数)
+TITLE_STYLES = [
+    (re.compile(r'^第\s*[一二三四五六七八九十百零〇两\d]+\s*(篇|部分|编|章|节|讲|课|单元)'), lambda m: m.group(1)),
+    (re.compile(r'^(\d+(?:\.\d+)*)\.?(?!\d)'), lambda m: f"数字{m.group(1).count('.') + 1}级"),
+    (re.compile(r'^[一二三四五六七八九十]+\s*[、.．]'), '中文序号'),
+    (re.compile(r'^[（(]\s*[一二三四五六七八九十]+\s*[)）]'), '括号中文序号'),
+    (re.compile(r'^[（(]\s*\d+\s*[)）]'), '括号数字序号'),
+    (re.compile(r'^(part|chapter|section|appendix)\b', re.IGNORECASE), lambda m: m.group(1).lower()),
+]
 
 # 全局提示词
 # 明确要求输出 CSV 格式，并定义列含义
@@ -49,16 +70,16 @@ title,page_number,level
 - 一般来说，前言、推荐序、致谢、参考文献等，应该是第一层级。
 """
 
-LLM_CONFIG = {}
-IMAGE_CACHE = {}
-client = None
-
-# 用于存储首图的处理结果，作为全局 Few-shot 示例
-# 存储格式：{"image_base64": str, "result_csv_str": str}
-FIRST_PAGE_EXAMPLE = {
-    "image_base64": None,
-    "result_csv_str": None
-}
+def new_first_page_example() -> dict:
+    """
+    用于存储首图的处理结果，作为本批次的 Few-shot 示例。
+    每次运行单独创建，避免进程内多个 session 互相覆盖。
+    存储格式：{"image_base64": str, "result_csv_str": str}
+    """
+    return {
+        "image_base64": None,
+        "result_csv_str": None
+    }
 
 def write_log(message):
     try:
@@ -66,7 +87,7 @@ def write_log(message):
         timestamp = datetime.now().strftime("%H:%M:%S")
 
         # 优先写入 session 日志
-        base_dir = os.getenv("BASE_DIR")
+        base_dir = get_session_base_dir()
         if base_dir:
             session_log = Path(base_dir) / "session.log"
             session_log.parent.mkdir(parents=True, exist_ok=True)
@@ -101,30 +122,13 @@ def load_llm_config() -> dict:
     return {
         "api_key": resolve_value(config.get("api_key")),
         "base_url": resolve_value(config.get("base_url")),
-        "model": resolve_value(config.get("model"))
+        "model": resolve_value(config.get("model")),
+        "routes": llm_routes.resolve_routes(config, resolve_value)
     }
 
 def natural_sort_key(s):
     return [int(text) if text.isdigit() else text.lower() for text in re.split(r'(\d+)', str(s))]
 
-def resize_and_encode_image(image_path: Path) -> str:
-    with Image.open(image_path) as img:
-        if img.mode in ("RGBA", "P"):
-            img = img.convert("RGB")
-        width, height = img.size
-        max_dim = max(width, height)
-        if max_dim > MAX_IMAGE_DIMENSION:
-            ratio = MAX_IMAGE_DIMENSION / max_dim
-            img = img.resize((int(width * ratio), int(height * ratio)), Image.LANCZOS)
-        buffer = BytesIO()
-        img.save(buffer, format="JPEG", quality=85, optimize=True)
-        return f"data:image/jpeg;base64,{base64.b64encode(buffer.getvalue()).decode('utf-8')}"
-
-def get_encoded_image(image_path: Path) -> str:
-    if image_path not in IMAGE_CACHE:
-        IMAGE_CACHE[image_path] = resize_and_encode_image(image_path)
-    return IMAGE_CACHE[image_path]
-
 def validate_and_fix_csv_content(content: str) -> str:
     """
     验证并修复 CSV 内容（目标为 3 列：title, page_number, level）。
@@ -239,172 +243,343 @@ def parse_csv_response(csv_text: str, source_file: str) -> list:
         
     return result_data
 
-async def process_first_page(img_file: Path, csv_file: Path, output_path: Path) -> bool:
+def parse_level_content(content: str, source_file: str):
+    """
+    按当前输出模式解析层级响应，返回 (目标 JSON 结构, 标准 CSV 文本)。
+    结构化输出模式下按 Schema 做类型化解析（不合格时抛出 ValueError），CSV 文本供 Few-shot 示例使用；
+    CSV 模式下沿用 parse_csv_response，CSV 文本即模型原始输出。
+    """
+    if not structured_output.enabled():
+        return parse_csv_response(content, source_file), content
+    entries = structured_output.parse_entries(content, LEVEL_FIELDS)
+    result_data = []
+    for entry in entries:
+        if not entry['title']:
+            continue
+        if entry['page_number'] is None:
+            write_log(f"警告：跳过无效行 (页码为空)：{entry} in {source_file}")
+            continue
+        result_data.append({"text": entry['title'], "number": entry['page_number'], "level": entry['level']})
+    return result_data, structured_output.entries_to_csv(entries, LEVEL_FIELDS)
+
+def is_valid_level_response(content: str) -> bool:
+    """响应能否解析出有效的层级数据（用于决定是否写入响应缓存）"""
+    try:
+        return bool(parse_level_content(content, "响应缓存校验")[0])
+    except Exception:
+        return False
+
+def new_level_stats() -> dict:
+    """
+    pages: 发出层级请求的页数；requests: 请求次数；retries: 因解析失败或结果为空而重发的请求数；
+    speculative: 未等首图示例即判定的页数，其中 speculative_accepted 页与首图一致被直接采用，speculative_rerun 页带示例重新判定
+    """
+    return {'pages': 0, 'requests': 0, 'retries': 0, 'prompt_tokens': 0, 'completion_tokens': 0,
+            'speculative': 0, 'speculative_accepted': 0, 'speculative_rerun': 0}
+
+def record_level_usage(stats: dict, response):
+    """累计 token 用量（缓存命中的响应同样带有原始用量）"""
+    usage = getattr(response, 'usage', None)
+    if usage:
+        stats['prompt_tokens'] += usage.prompt_tokens or 0
+        stats['completion_tokens'] += usage.completion_tokens or 0
+
+def level_request_kwargs() -> dict:
+    """结构化输出模式下附加 response_format"""
+    if not structured_output.enabled():
+        return {}
+    return {"response_format": structured_output.response_format('toc_levels', LEVEL_FIELDS)}
+
+def level_input_values() -> list:
+    """逐页输入哈希中与输出模式相关的部分；CSV 模式下为空，沿用原有的键"""
+    return [structured_output.fingerprint()] if structured_output.fingerprint() else []
+
+def level_prompt() -> str:
+    return PROMPT_TEXT + structured_output.note(LEVEL_FIELDS) if structured_output.enabled() else PROMPT_TEXT
+
+async def process_first_page(img_file: Path, csv_file: Path, output_path: Path, client: AsyncOpenAI, model: str, first_page_example: dict, manifest: StageManifest, images: ImagePrefetcher, stats: dict = None, requesting: asyncio.Future = None) -> bool:
     """
     专门处理第一张图片，获取 CSV 格式的响应，并缓存为 Few-shot 示例。
+    stats: 可选，请求次数统计（见 new_level_stats）；requesting: 可选，确需请求模型（未能沿用上次结果）时置位
     """
     write_log(f"正在处理首图作为示例：{img_file.name}")
+    stats = stats if stats is not None else new_level_stats()
     
     if not csv_file.exists():
         write_log(f"缺少对应的 CSV 文件，跳过首图处理：{img_file.name}")
+        images.discard(img_file)
         return False
 
+    # 输入未变化时直接沿用上次的结果，并从阶段清单中恢复 Few-shot 示例
+    input_hash = hash_values(file_sha256(img_file), file_sha256(csv_file), model, PROMPT_TEXT, *level_input_values())
+    record = manifest.get_unit(STAGE_NAME, img_file.name, input_hash)
+    image_data_url = await images.get(img_file)
+    if record and (record.get('extra') or {}).get('result_csv'):
+        first_page_example["image_base64"] = image_data_url
+        first_page_example["result_csv_str"] = record['extra']['result_csv']
+        write_log(f"跳过已处理的首图，沿用上次结果作为示例：{img_file.name}")
+        return True
+
     csv_content = csv_file.read_text(encoding='utf-8')
+    stats['pages'] += 1
     
     content_list = [
         {"type": "text", "text": "当前页图片（需处理，作为后续页面的参考示例）："},
-        {"type": "text", "text": f"{PROMPT_TEXT}\n\n当前页提取的原始 CSV 数据如下：\n{csv_content}"},
-        {"type": "image_url", "image_url": {"url": get_encoded_image(img_file)}}
+        {"type": "text", "text": f"{level_prompt()}\n\n当前页提取的原始 CSV 数据如下：\n{csv_content}"},
+        {"type": "image_url", "image_url": {"url": image_data_url}}
     ]
 
     messages = [{"role": "user", "content": content_list}]
+    if requesting is not None and not requesting.done():
+        requesting.set_result(True)
 
-    try:
-        for attempt in range(MAX_RETRIES):
+    for attempt in range(MAX_RETRIES):
+        try:
+            stats['requests'] += 1
+            if attempt > 0:
+                stats['retries'] += 1
+            response = await chat_completion(client,
+                model=model,
+                messages=messages,
+                extra_body={"enable_thinking": False},
+                timeout=REQUEST_TIMEOUT,
+                temperature=0,
+                cache_validate=is_valid_level_response,
+                hedge=llm_routes.LEVELS,
+                **level_request_kwargs()
+            )
+            record_level_usage(stats, response)
+
+            content = response.choices[0].message.content.strip()
+
+            # 本地解析 CSV（或结构化输出）转为 JSON 保存
             try:
-                response = await client.chat.completions.create(
-                    model=LLM_CONFIG["model"],
-                    messages=messages,
-                    extra_body={"enable_thinking": False},
-                    timeout=REQUEST_TIMEOUT,
-                    temperature=0,
-                )
-
-                content = response.choices[0].message.content.strip()
-
-                # 本地解析 CSV 转为 JSON 保存
-                try:
-                    parsed_data = parse_csv_response(content, img_file.name)
-                except Exception as parse_err:
-                    write_log(f"首图 CSV 解析失败：{parse_err}")
-                    if attempt == MAX_RETRIES - 1:
-                        return False
-                    await asyncio.sleep(2 ** attempt)
-                    continue
-
-                if parsed_data:
-                    # 排序
-                    sorted_data = sorted(parsed_data, key=lambda x: x['number'])
+                parsed_data, result_csv = parse_level_content(content, img_file.name)
+            except Exception as parse_err:
+                write_log(f"首图 CSV 解析失败：{parse_err}")
+                if attempt == MAX_RETRIES - 1:
+                    return False
+                await asyncio.sleep(2 ** attempt)
+                continue
 
-                    # 保存首图结果文件
-                    output_file = output_path / f"{img_file.stem}_merged.json"
-                    with open(output_file, 'w', encoding='utf-8') as f:
-                        json.dump(sorted_data, f, ensure_ascii=False, indent=2)
+            if parsed_data:
+                # 排序
+                sorted_data = sorted(parsed_data, key=lambda x: x['number'])
 
-                    # 存入全局变量作为 Few-shot 示例 (存储原始 CSV 字符串)
-                    FIRST_PAGE_EXAMPLE["image_base64"] = get_encoded_image(img_file)
-                    FIRST_PAGE_EXAMPLE["result_csv_str"] = content
+                # 保存首图结果文件
+                output_file = output_path / f"{img_file.stem}_merged.json"
+                atomic_write_json(output_file, sorted_data)
+                manifest.record_unit(STAGE_NAME, img_file.name, input_hash, output_file,
+                                     extra={"result_csv": result_csv})
 
-                    print(f"首图处理完成并已缓存为示例：{img_file.name}")
-                    return True
-                else:
-                    write_log(f"首图解析结果为空：{img_file.name}")
-                    if attempt == MAX_RETRIES - 1:
-                        return False
-                    await asyncio.sleep(2 ** attempt)
+                # 存入全局变量作为 Few-shot 示例 (存储原始 CSV 字符串)
+                first_page_example["image_base64"] = image_data_url
+                first_page_example["result_csv_str"] = result_csv
 
-            except (APIError, Timeout) as e:
-                write_log(f"首图第 {attempt+1} 次 API 请求失败 ({type(e).__name__}): {str(e)}")
+                print(f"首图处理完成并已缓存为示例：{img_file.name}")
+                return True
+            else:
+                write_log(f"首图解析结果为空：{img_file.name}")
                 if attempt == MAX_RETRIES - 1:
                     return False
                 await asyncio.sleep(2 ** attempt)
-            except Exception as e:
-                write_log(f"首图处理异常 {img_file.name}: {str(e)}")
+
+        except (APIError, Timeout) as e:
+            write_log(f"首图第 {attempt+1} 次 API 请求失败 ({type(e).__name__}): {str(e)}")
+            if attempt == MAX_RETRIES - 1:
+                return False
+            await asyncio.sleep(2 ** attempt)
+        except Exception as e:
+            write_log(f"首图处理异常 {img_file.name}: {str(e)}")
+            if attempt == MAX_RETRIES - 1:
+                return False
+            await asyncio.sleep(2 ** attempt)
+
+    return False
+
+def level_page_hash(img_file: Path, csv_file: Path, model: str, first_page_example: dict) -> str:
+    """首图示例也是输入的一部分：首图结果变化（或首图失败、没有示例）后，其余页面需要重新判定"""
+    return hash_values(file_sha256(img_file), file_sha256(csv_file), model, PROMPT_TEXT,
+                       first_page_example["result_csv_str"], *level_input_values())
+
+def level_messages(image_data_url: str, csv_content: str, first_page_example: dict = None) -> list:
+    """first_page_example 为 None 或没有结果时不附带 Few-shot 示例"""
+    content_list = []
+
+    # 构建 Few-shot 上下文：首图 + 首图结果 (CSV 格式)
+    if first_page_example and first_page_example["image_base64"] and first_page_example["result_csv_str"]:
+        content_list.extend([
+            {"type": "text", "text": "参考示例（第一页图片及其正确的 CSV 格式层级分析结果）："},
+            {"type": "image_url", "image_url": {"url": first_page_example["image_base64"]}},
+            {"type": "text", "text": f"参考结果 (CSV 格式):\n{first_page_example['result_csv_str']}"},
+            {"type": "text", "text": "---\n请严格参照上述示例的 CSV 格式和层级判断标准，分析以下当前页图片："}
+        ])
+
+    # 添加当前页图片和提示词
+    content_list.extend([
+        {"type": "image_url", "image_url": {"url": image_data_url}},
+        {"type": "text", "text": f"{level_prompt()}\n\n当前页提取的原始 CSV 数据如下：\n{csv_content}"}
+    ])
+    return [{"role": "user", "content": content_list}]
+
+async def request_levels(img_file: Path, messages: list, client: AsyncOpenAI, model: str, stats: dict):
+    """发送层级请求并解析为目标 JSON 结构；全部重试失败时返回 None"""
+    for attempt in range(MAX_RETRIES):
+        try:
+            stats['requests'] += 1
+            if attempt > 0:
+                stats['retries'] += 1
+            response = await chat_completion(client,
+                model=model,
+                messages=messages,
+                extra_body={"enable_thinking": False},
+                timeout=REQUEST_TIMEOUT,
+                temperature=0,
+                cache_validate=is_valid_level_response,
+                hedge=llm_routes.LEVELS,
+                **level_request_kwargs()
+            )
+            record_level_usage(stats, response)
+
+            content = response.choices[0].message.content.strip()
+
+            # 本地解析 CSV（或结构化输出）转为 JSON
+            try:
+                parsed_data, _ = parse_level_content(content, img_file.name)
+            except Exception as parse_err:
+                write_log(f"第 {attempt+1} 次尝试解析 CSV 失败：{parse_err}")
                 if attempt == MAX_RETRIES - 1:
-                    return False
+                    return None
                 await asyncio.sleep(2 ** attempt)
+                continue
 
-        return False
-    finally:
-        IMAGE_CACHE.pop(img_file, None)
-
-async def process_level_async(semaphore: asyncio.Semaphore, img_file: Path, csv_file: Path, output_path: Path):
+            if parsed_data:
+                return parsed_data
+            write_log(f"解析结果为空：{img_file.name}")
+            if attempt == MAX_RETRIES - 1:
+                return None
+            await asyncio.sleep(2 ** attempt)
+
+        except (APIError, Timeout) as e:
+            write_log(f"第 {attempt+1} 次 API 请求失败 ({type(e).__name__}): {str(e)}")
+            if attempt == MAX_RETRIES - 1:
+                return None
+            await asyncio.sleep(2 ** attempt)
+        except Exception as e:
+            write_log(f"处理异常 {img_file.name}: {str(e)}")
+            if attempt == MAX_RETRIES - 1:
+                return None
+            await asyncio.sleep(2 ** attempt)
+
+    return None
+
+def save_level_page(img_file: Path, output_path: Path, parsed_data: list, input_hash: str, manifest: StageManifest):
+    sorted_data = sorted(parsed_data, key=lambda x: x['number'])
+    output_file = output_path / f"{img_file.stem}_merged.json"
+    atomic_write_json(output_file, sorted_data)
+    manifest.record_unit(STAGE_NAME, img_file.name, input_hash, output_file)
+    print(f"已判断层级：{img_file.name}")
+
+async def process_level_async(semaphore: asyncio.Semaphore, img_file: Path, csv_file: Path, output_path: Path, client: AsyncOpenAI, model: str, first_page_example: dict, manifest: StageManifest, images: ImagePrefetcher, stats: dict = None):
     """
-    处理除第一张以外的其他图片，使用首图的 CSV 结果作为 Few-shot 上下文。
+    处理除第一张以外的其他图片，使用首图的 CSV 结果作为 Few-shot 上下文（首图失败时无参考处理）。
+    stats: 可选，请求次数统计（见 new_level_stats）
     """
+    stats = stats if stats is not None else new_level_stats()
     async with semaphore:
-        output_file = output_path / f"{img_file.stem}_merged.json"
-        if output_file.exists():
-            write_log(f"跳过已处理文件：{img_file.name}")
-            return None
-
         if not csv_file.exists():
             write_log(f"缺少对应的 CSV 文件，跳过：{img_file.name}")
+            images.discard(img_file)
             return False
 
+        input_hash = level_page_hash(img_file, csv_file, model, first_page_example)
+        if manifest.get_unit(STAGE_NAME, img_file.name, input_hash):
+            write_log(f"跳过已处理文件：{img_file.name}")
+            images.discard(img_file)
+            return None
+
         csv_content = csv_file.read_text(encoding='utf-8')
-        content_list = []
-        
-        # 构建 Few-shot 上下文：首图 + 首图结果 (CSV 格式)
-        if FIRST_PAGE_EXAMPLE["image_base64"] and FIRST_PAGE_EXAMPLE["result_csv_str"]:
-            content_list.extend([
-                {"type": "text", "text": "参考示例（第一页图片及其正确的 CSV 格式层级分析结果）："},
-                {"type": "image_url", "image_url": {"url": FIRST_PAGE_EXAMPLE["image_base64"]}},
-                {"type": "text", "text": f"参考结果 (CSV 格式):\n{FIRST_PAGE_EXAMPLE['result_csv_str']}"},
-                {"type": "text", "text": "---\n请严格参照上述示例的 CSV 格式和层级判断标准，分析以下当前页图片："}
-            ])
-        else:
+        stats['pages'] += 1
+        if not first_page_example["result_csv_str"]:
             write_log(f"警告：未找到首图示例，将无参考处理 {img_file.name}")
-        
-        # 添加当前页图片和提示词
-        content_list.extend([
-            {"type": "image_url", "image_url": {"url": get_encoded_image(img_file)}},
-            {"type": "text", "text": f"{PROMPT_TEXT}\n\n当前页提取的原始 CSV 数据如下：\n{csv_content}"}
-        ])
-
-        messages = [{"role": "user", "content": content_list}]
-
-        try:
-            for attempt in range(MAX_RETRIES):
-                try:
-                    response = await client.chat.completions.create(
-                        model=LLM_CONFIG["model"],
-                        messages=messages,
-                        extra_body={"enable_thinking": False},
-                        timeout=REQUEST_TIMEOUT,
-                        temperature=0,
-                    )
-
-                    content = response.choices[0].message.content.strip()
-
-                    # 本地解析 CSV 转为 JSON
-                    try:
-                        parsed_data = parse_csv_response(content, img_file.name)
-                    except Exception as parse_err:
-                        write_log(f"第 {attempt+1} 次尝试解析 CSV 失败：{parse_err}")
-                        if attempt == MAX_RETRIES - 1:
-                            return False
-                        await asyncio.sleep(2 ** attempt)
-                        continue
-
-                    if parsed_data:
-                        sorted_data = sorted(parsed_data, key=lambda x: x['number'])
-
-                        with open(output_file, 'w', encoding='utf-8') as f:
-                            json.dump(sorted_data, f, ensure_ascii=False, indent=2)
-
-                        print(f"已判断层级：{img_file.name}")
-                        return True
-                    else:
-                        write_log(f"解析结果为空：{img_file.name}")
-                        if attempt == MAX_RETRIES - 1:
-                            return False
-                        await asyncio.sleep(2 ** attempt)
-
-                except (APIError, Timeout) as e:
-                    write_log(f"第 {attempt+1} 次 API 请求失败 ({type(e).__name__}): {str(e)}")
-                    if attempt == MAX_RETRIES - 1:
-                        return False
-                    await asyncio.sleep(2 ** attempt)
-                except Exception as e:
-                    write_log(f"处理异常 {img_file.name}: {str(e)}")
-                    if attempt == MAX_RETRIES - 1:
-                        return False
-                    await asyncio.sleep(2 ** attempt)
+        messages = level_messages(await images.get(img_file), csv_content, first_page_example)
+        parsed_data = await request_levels(img_file, messages, client, model, stats)
+        if not parsed_data:
+            return False
+        save_level_page(img_file, output_path, parsed_data, input_hash, manifest)
+        return True
+
+def title_style(title: str):
+    """目录项标题的编号样式（如 章、节、两级数字编号、中文序号），无法识别时返回 None"""
+    for pattern, style in TITLE_STYLES:
+        match = pattern.match(title)
+        if match:
+            return style(match) if callable(style) else style
+    return None
+
+def levels_consistent(parsed_data: list, example_data: list) -> bool:
+    """
+    投机结果与首图结果的层级是否一致：同一编号样式在首图中出现过的层级须包含本页判定的层级，
+    且至少有一个条目可以比较（无从比较的页面按不一致处理，带示例重新判定）
+    """
+    example_levels = {}
+    for item in example_data:
+        style = title_style(item['text'])
+        if style:
+            example_levels.setdefault(style, set()).add(item['level'])
+    compared = 0
+    for item in parsed_data:
+        levels = example_levels.get(title_style(item['text']))
+        if levels is None:
+            continue
+        if item['level'] not in levels:
+            return False
+        compared += 1
+    return compared > 0
 
+async def speculate_level_async(semaphore: asyncio.Semaphore, img_file: Path, csv_file: Path, output_path: Path, client: AsyncOpenAI, model: str, first_page_example: dict, first_done: asyncio.Future, manifest: StageManifest, images: ImagePrefetcher, stats: dict):
+    """
+    首图仍在请求时，先不带示例判定本页；首图完成后与其结果比对，层级一致则直接采用，
+    不一致（或投机请求失败）时带示例重新判定一次。首图失败时投机结果即为最终结果。
+    """
+    async with semaphore:
+        if not csv_file.exists():
+            write_log(f"缺少对应的 CSV 文件，跳过：{img_file.name}")
+            images.discard(img_file)
             return False
-        finally:
-            IMAGE_CACHE.pop(img_file, None)
+        csv_content = csv_file.read_text(encoding='utf-8')
+        image_data_url = await images.get(img_file)
+        stats['pages'] += 1
+        stats['speculative'] += 1
+        parsed_data = await request_levels(img_file, level_messages(image_data_url, csv_content), client, model, stats)
+
+    # 等待首图期间不占用并发名额
+    first_ok = await asyncio.shield(first_done)
+    input_hash = level_page_hash(img_file, csv_file, model, first_page_example)
+    if manifest.get_unit(STAGE_NAME, img_file.name, input_hash):
+        # 首图结果与上次相同，沿用上次带示例判定的结果
+        write_log(f"跳过已处理文件：{img_file.name}")
+        return None
+    if parsed_data and not first_ok:
+        save_level_page(img_file, output_path, parsed_data, input_hash, manifest)
+        return True
+    if parsed_data and levels_consistent(parsed_data, parse_csv_response(first_page_example["result_csv_str"], "首图示例")):
+        stats['speculative_accepted'] += 1
+        save_level_page(img_file, output_path, parsed_data, input_hash, manifest)
+        return True
+
+    stats['speculative_rerun'] += 1
+    if parsed_data:
+        write_log(f"投机结果与首图层级不一致，带示例重新判定：{img_file.name}")
+    else:
+        write_log(f"投机判定失败，重新判定：{img_file.name}")
+    async with semaphore:
+        parsed_data = await request_levels(img_file, level_messages(image_data_url, csv_content, first_page_example),
+                                           client, model, stats)
+    if not parsed_data:
+        return False
+    save_level_page(img_file, output_path, parsed_data, input_hash, manifest)
+    return True
 
 def post_process_levels(output_path: Path):
     write_log("开始执行后处理逻辑")
@@ -434,71 +609,152 @@ def post_process_levels(output_path: Path):
                 write_log(f"修正文件 {file.name}: 层级提升 {level_diff}")
                 for item in page_data:
                     item["level"] += level_diff
-                with open(file, 'w', encoding='utf-8') as f:
-                    json.dump(page_data, f, ensure_ascii=False, indent=2)
+                atomic_write_json(file, page_data)
     except Exception as e:
         write_log(f"后处理异常：{str(e)}")
 
-async def run_batch_processing(image_files: list, output_path: Path):
+async def all_pages_ready(image_files: list):
+    """逐阶段模式下所有页面的 CSV 均已就绪"""
+    for img_file in image_files:
+        yield img_file, True
+
+async def run_batch_processing(image_files: list, output_path: Path, client: AsyncOpenAI, model: str, manifest: StageManifest, ready_pages=None, stats: dict = None):
+    """
+    ready_pages: 异步迭代器，依次产出 (img_file, ok)，表示该页 CSV 已写出（ok=True）或提取失败。
+    为 None 时视为全部就绪（逐阶段模式）；流水线模式下由 qwen_vl_extract 边提取边产出，
+    首图 CSV 一就绪即开始生成示例，其余页面在自身 CSV 就绪后即发出请求：首图仍在请求模型时投机判定（见 LEVELS_SPECULATIVE），
+    否则等待示例。首图失败时其余页面不带示例判定，不再终止整个阶段。
+    stats: 可选，请求次数统计（见 new_level_stats）
+    """
     if not image_files:
         return
+    stats = stats if stats is not None else new_level_stats()
 
-    write_log(f"正在预处理并缓存 {len(image_files)} 张图片...")
-    for img in image_files:
-        get_encoded_image(img)
-        
+    # 目录页范围变化后，清理不再存在的页面遗留的结果，避免被 content_postprocessor 合并
+    manifest.prune_units(STAGE_NAME, [img.name for img in image_files])
     semaphore = asyncio.Semaphore(CONCURRENT_LIMIT)
+    first_page_example = new_first_page_example()
+    if ready_pages is None:
+        ready_pages = all_pages_ready(image_files)
     
-    # 1. 串行处理第一张图片
     first_img = image_files[0]
-    first_csv = output_path / f"{first_img.stem}.csv"
-    
-    write_log("阶段 1: 处理首图以生成 Few-shot 示例 (CSV 格式)")
-    success = await process_first_page(first_img, first_csv, output_path)
-    
-    if not success:
-        write_log("严重错误：首图处理失败，无法生成参考示例，终止后续并发处理。")
-        print("首图处理失败，脚本停止。请检查日志。")
-        return
+    first_done = asyncio.get_running_loop().create_future()
+    first_requesting = asyncio.get_running_loop().create_future()
+    # 图片按页序有界预取，首图请求无需等待全部页面编码完成
+    images = ImagePrefetcher(image_files).start()
+
+    # 1. 首图生成 Few-shot 示例
+    async def run_first_page():
+        write_log("阶段 1: 处理首图以生成 Few-shot 示例 (CSV 格式)")
+        first_csv = output_path / f"{first_img.stem}.csv"
+        success = False
+        try:
+            success = await process_first_page(first_img, first_csv, output_path, client, model, first_page_example, manifest, images, stats,
+                                               requesting=first_requesting)
+        finally:
+            if not success:
+                write_log("首图处理失败，无法生成参考示例，其余页面将不带示例判定层级。")
+                print("首图处理失败，其余页面将不带示例处理。请检查日志。")
+            if not first_done.done():
+                first_done.set_result(success)
+        return success
+
+    # 2. 其余页面：首图仍在请求模型时投机判定，否则等待示例（首图沿用上次结果时很快完成）后处理
+    async def run_other_page(img_file):
+        csv_file = output_path / f"{img_file.stem}.csv"
+        if LEVELS_SPECULATIVE and not first_done.done():
+            await asyncio.wait([first_done, first_requesting], return_when=asyncio.FIRST_COMPLETED)
+            if not first_done.done():
+                return await speculate_level_async(semaphore, img_file, csv_file, output_path, client, model, first_page_example,
+                                                   first_done, manifest, images, stats)
+        await asyncio.shield(first_done)
+        return await process_level_async(semaphore, img_file, csv_file, output_path, client, model, first_page_example, manifest, images, stats)
 
-    # 2. 并发处理剩余图片
-    if len(image_files) > 1:
-        write_log("阶段 2: 基于首图示例并发处理剩余图片")
+    try:
+        first_task = None
         tasks = []
-        for img_file in image_files[1:]:
-            csv_file = output_path / f"{img_file.stem}.csv"
-            tasks.append(process_level_async(semaphore, img_file, csv_file, output_path))
+        async for img_file, ok in ready_pages:
+            if img_file.name == first_img.name:
+                if ok:
+                    first_task = asyncio.create_task(run_first_page())
+                elif not first_done.done():
+                    first_done.set_result(False)
+            elif ok:
+                tasks.append(asyncio.create_task(run_other_page(img_file)))
+            else:
+                # 提取失败的页面不会发出层级请求
+                images.discard(img_file)
+        if first_task is None and not first_done.done():
+            first_done.set_result(False)
+
+        if first_task is not None:
+            await first_task
+
+        if len(image_files) > 1:
+            write_log("阶段 2: 并发处理剩余图片")
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+            success_count = sum(1 for r in results if r is True)
+            fail_count = sum(1 for r in results if r is False)
+            exception_count = sum(1 for r in results if isinstance(r, Exception))
+        
+            print(f"并发处理完成。成功：{success_count}, 失败/空结果：{fail_count}, 异常：{exception_count}")
+        else:
+            print("仅有一张图片，处理完毕。")
+    finally:
+        await images.close()
+        write_log(images.summary())
+        write_log(f"层级判定用量：{stats['pages']} 页，请求 {stats['requests']} 次，输出格式 {structured_output.LLM_OUTPUT_MODE}，"
+                  f"解析失败或结果为空重发 {stats['retries']} 次，输入 token {stats['prompt_tokens']}，输出 token {stats['completion_tokens']}")
+        if stats['speculative']:
+            write_log(f"投机判定：{stats['speculative']} 页未等首图示例，与首图一致直接采用 {stats['speculative_accepted']} 页，"
+                      f"带示例重新判定 {stats['speculative_rerun']} 页")
+        if llm_hedge.LLM_HEDGE_ENABLED:
+            write_log(llm_hedge.hedge_policy(llm_routes.LEVELS).summary())
+
+
+async def determine_levels(input_path: Path, output_path: Path, llm_config: dict, ready_pages=None):
+    """结合目录页图片与已提取的 CSV 判定每个目录项的层级，输出 *_merged.json（ready_pages 见 run_batch_processing），返回请求次数统计"""
+    input_path = Path(input_path)
+    output_path = Path(output_path)
+
+    # 初始化 OpenAI 客户端，模型按 routes 中的 levels 类别选择
+    client, model = llm_routes.routed_clients(
+        llm_config, (llm_routes.LEVELS,), timeout=REQUEST_TIMEOUT, max_retries=2
+    )[llm_routes.LEVELS]
+    
+    if not input_path.exists():
+        print(f"错误：输入路径不存在 {input_path}")
+        raise StageError(f"输入路径不存在 {input_path}")
         
-        results = await asyncio.gather(*tasks, return_exceptions=True)
-        success_count = sum(1 for r in results if r is True)
-        fail_count = sum(1 for r in results if r is False)
-        exception_count = sum(1 for r in results if isinstance(r, Exception))
+    if not output_path.exists():
+        output_path.mkdir(parents=True, exist_ok=True)
         
-        print(f"并发处理完成。成功：{success_count}, 失败/空结果：{fail_count}, 异常：{exception_count}")
+    image_files = sorted([f for f in input_path.iterdir() if f.is_file() and f.suffix.lower() in IMAGE_EXTENSIONS], key=lambda x: natural_sort_key(x.name))
+    
+    stats = new_level_stats()
+    if image_files:
+        manifest = StageManifest(get_session_base_dir() or output_path.parent)
+        await run_batch_processing(image_files, output_path, client, model, manifest, ready_pages, stats)
+        post_process_levels(output_path)
+        # 后处理可能改写了各页结果，同步清单中记录的输出哈希
+        manifest.refresh_units(STAGE_NAME)
     else:
-        print("仅有一张图片，处理完毕。")
+        print("未找到需要处理的图片。")
+    return stats
 
-    # 处理完成后清空图片缓存，释放内存
-    IMAGE_CACHE.clear()
+def run_stage(input_dir, output_dir, llm_config: dict):
+    """阶段入口：供 app.py 在常驻进程内直接调用"""
+    run_async(determine_levels(input_dir, output_dir, llm_config))
 
 async def main_async():
     load_dotenv()
     
-    global LLM_CONFIG, client
     try:
-        LLM_CONFIG = load_llm_config()
+        llm_config = load_llm_config()
     except Exception as e:
         print(f"加载 LLM 配置失败：{e}")
         sys.exit(1)
     
-    # 初始化 OpenAI 客户端
-    client = AsyncOpenAI(
-        api_key=LLM_CONFIG["api_key"],
-        base_url=LLM_CONFIG["base_url"],
-        timeout=REQUEST_TIMEOUT,
-        max_retries=2
-    )
-    
     base_dir = os.getenv("BASE_DIR")
     if base_dir:
         input_path = Path(base_dir) / "mark" / "input_image"
@@ -513,23 +769,13 @@ async def main_async():
             
         input_path = Path(input_path_str)
         output_path = Path(output_path_str)
-    
-    if not input_path.exists():
-        print(f"错误：输入路径不存在 {input_path}")
-        sys.exit(1)
-        
-    if not output_path.exists():
-        output_path.mkdir(parents=True, exist_ok=True)
-        
-    image_files = sorted([f for f in input_path.iterdir() if f.is_file() and f.suffix.lower() in IMAGE_EXTENSIONS], key=lambda x: natural_sort_key(x.name))
-    
-    if image_files:
-        await run_batch_processing(image_files, output_path)
-        post_process_levels(output_path)
-    else:
-        print("未找到需要处理的图片。")
+
+    await determine_levels(input_path, output_path, llm_config)
 
 if __name__ == "__main__":
     if sys.platform == 'win32':
         asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
-    asyncio.run(main_async())
\ No newline at end of file
+    try:
+        asyncio.run(main_async())
+    except StageError:
+        sys.exit(1)
\ No newline at end of file
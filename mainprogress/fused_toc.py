@@ -0,0 +1,298 @@
+import os
+import sys
+import csv
+import asyncio
+from io import StringIO
+from pathlib import Path
+from dotenv import load_dotenv
+from openai import AsyncOpenAI, APIError, Timeout
+
+PROJECT_ROOT = str(Path(__file__).resolve().parent.parent)
+sys.path.append(PROJECT_ROOT)
+
+from mainprogress.stage_context import StageError, run_async, get_session_base_dir
+from mainprogress.llm_scheduler import chat_completion
+from mainprogress.image_prefetch import ImagePrefetcher
+from mainprogress.stage_manifest import StageManifest, atomic_write_json, atomic_write_text, file_sha256, hash_values
+from mainprogress import qwen_vl_extract, determine_toc_levels, llm_routes, llm_hedge, structured_output
+from mainprogress.determine_toc_levels import (
+    write_log, natural_sort_key, new_first_page_example, parse_csv_response, validate_and_fix_csv_content, is_valid_level_response,
+    level_request_kwargs, level_input_values, new_level_stats, record_level_usage, post_process_levels,
+    IMAGE_EXTENSIONS, CONCURRENT_LIMIT, MAX_RETRIES, REQUEST_TIMEOUT,
+)
+from mainprogress.structured_output import LEVEL_FIELDS
+
+# 合并模式（TOC_PIPELINE_MODE=fused）：每个目录页只请求一次视觉模型，直接输出 title,page_number,level，
+# 不再先提取 title,page_number、再带着同一张图片和 CSV 判定层级。与层级判定阶段一样，
+# 首图结果作为 Few-shot 示例，其余页面在示例生成后并发处理；每页同时写出 {stem}.csv 与 {stem}_merged.json，
+# content_postprocessor 及阶段清单无需区分两种模式。模型按 routes 中的 levels 类别选择。
+# 文字层不参与合并模式（层级判定始终需要图片）。
+STAGE_NAME = 'fused_toc'
+# 其余页面的请求是否附带首图图片；为 0 时示例只保留首图的 CSV 结果，进一步减少图片 token
+FUSED_EXAMPLE_IMAGE = os.getenv('FUSED_EXAMPLE_IMAGE', '1') == '1'
+
+
+def prompt_section(text: str, heading: str) -> str:
+    """从提示词中截取以 heading 开头、到下一个一级标题之前的一节"""
+    start = text.index(heading)
+    end = text.find('\n# ', start + len(heading))
+    return text[start:end if end != -1 else len(text)].strip()
+
+
+# 提取规则与层级判定规则分别取自两个阶段的提示词，修改任一阶段的规则时合并模式同步生效
+FUSED_PROMPT_TEXT = f"""# 任务目标
+分析提供的目录页图片，提取每个目录项的标题和页码，并判断其所属的层级（level）。
+
+# 输出格式要求
+1. 数据格式：仅输出CSV格式数据，包含表头 `title,page_number,level`，禁止输出 Markdown 代码块标记或任何解释性文字。
+2. 分隔符：严格使用半角逗号 `,` 作为列分隔符，禁止使用全角逗号 `，`。
+3. page_number 与 level 列必须是整数。
+4. CSV 内容示例：
+title,page_number,level
+第一章 函数极限连续,1,1
+第一节 函数,1,2
+一、函数的概念,1,3
+
+{prompt_section(qwen_vl_extract.PROMPT_TEXT, '# 内容提取规则')}
+
+{prompt_section(qwen_vl_extract.PROMPT_TEXT, '# 页码处理规则')}
+
+{prompt_section(qwen_vl_extract.PROMPT_TEXT, '# 空格与排版规则')}
+
+{prompt_section(determine_toc_levels.PROMPT_TEXT, '# 层级判定规则')}
+
+# 注意事项：
+- 一般来说，前言、推荐序、致谢、参考文献等，应该是第一层级。
+{qwen_vl_extract.IMPORTANT_NOTE}"""
+
+
+def fused_prompt() -> str:
+    return FUSED_PROMPT_TEXT + structured_output.note(LEVEL_FIELDS) if structured_output.enabled() else FUSED_PROMPT_TEXT
+
+
+def fingerprint() -> str:
+    """参与整书结果缓存键，合并模式与逐阶段模式的结果互不复用"""
+    return f"fused|example_image={FUSED_EXAMPLE_IMAGE}|{FUSED_PROMPT_TEXT}"
+
+
+def parse_fused_content(content: str, source_file: str):
+    """
+    解析合并响应，返回 (目标 JSON 结构, 标准 CSV 文本)。与逐阶段模式一致，解析前先用 fix_null_page_numbers
+    填补页码为 null 的条目（无页码的篇、章标题），避免被当作无效行丢弃。结构化输出不合格时抛出 ValueError。
+    """
+    if structured_output.enabled():
+        csv_text = structured_output.entries_to_csv(structured_output.parse_entries(content, LEVEL_FIELDS), LEVEL_FIELDS)
+    else:
+        csv_text = validate_and_fix_csv_content(qwen_vl_extract.strip_code_fence(content))
+    csv_text = qwen_vl_extract.fix_null_page_numbers(csv_text)
+    return parse_csv_response(csv_text, source_file), csv_text
+
+
+def write_page_outputs(img_file: Path, output_path: Path, parsed_data: list) -> Path:
+    """写出与逐阶段模式相同的 {stem}.csv（title,page_number）和 {stem}_merged.json，返回后者"""
+    sorted_data = sorted(parsed_data, key=lambda x: x['number'])
+    buffer = StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(['title', 'page_number'])
+    writer.writerows([item['text'], item['number']] for item in sorted_data)
+    atomic_write_text(output_path / f"{img_file.stem}.csv", buffer.getvalue().strip())
+    output_file = output_path / f"{img_file.stem}_merged.json"
+    atomic_write_json(output_file, sorted_data)
+    return output_file
+
+
+async def request_page(img_file: Path, content_list: list, client: AsyncOpenAI, model: str, stats: dict):
+    """发送合并请求并解析，返回 (目标 JSON 结构, 标准 CSV 文本)；全部重试失败时返回 (None, None)"""
+    messages = [{"role": "user", "content": content_list}]
+    for attempt in range(MAX_RETRIES):
+        try:
+            stats['requests'] += 1
+            if attempt > 0:
+                stats['retries'] += 1
+            response = await chat_completion(client,
+                model=model,
+                messages=messages,
+                extra_body={"enable_thinking": False},
+                timeout=REQUEST_TIMEOUT,
+                temperature=0,
+                cache_validate=is_valid_level_response,
+                hedge=llm_routes.LEVELS,
+                **level_request_kwargs()
+            )
+            record_level_usage(stats, response)
+
+            content = response.choices[0].message.content.strip()
+            try:
+                parsed_data, result_csv = parse_fused_content(content, img_file.name)
+            except Exception as parse_err:
+                write_log(f"第 {attempt+1} 次尝试解析失败 {img_file.name}：{parse_err}")
+                parsed_data = None
+
+            if parsed_data:
+                return parsed_data, result_csv
+            write_log(f"解析结果为空或无效：{img_file.name} (尝试 {attempt+1}/{MAX_RETRIES})")
+        except (APIError, Timeout) as e:
+            write_log(f"第 {attempt+1} 次 API 请求失败 ({type(e).__name__}): {str(e)}")
+        except Exception as e:
+            write_log(f"处理异常 {img_file.name}: {str(e)}")
+        if attempt < MAX_RETRIES - 1:
+            await asyncio.sleep(2 ** attempt)
+    return None, None
+
+
+async def process_first_page(img_file: Path, output_path: Path, client: AsyncOpenAI, model: str, first_page_example: dict, manifest: StageManifest, images: ImagePrefetcher, stats: dict) -> bool:
+    """首图一次请求得到 title,page_number,level，并缓存为 Few-shot 示例"""
+    write_log(f"正在处理首图作为示例：{img_file.name}")
+    input_hash = hash_values(file_sha256(img_file), model, FUSED_PROMPT_TEXT, *level_input_values())
+    record = manifest.get_unit(STAGE_NAME, img_file.name, input_hash)
+    image_data_url = await images.get(img_file)
+    if record and (record.get('extra') or {}).get('result_csv'):
+        first_page_example["image_base64"] = image_data_url
+        first_page_example["result_csv_str"] = record['extra']['result_csv']
+        write_log(f"跳过已处理的首图，沿用上次结果作为示例：{img_file.name}")
+        return True
+
+    stats['pages'] += 1
+    content_list = [
+        {"type": "text", "text": "当前页图片（需处理，作为后续页面的参考示例）："},
+        {"type": "image_url", "image_url": {"url": image_data_url}},
+        {"type": "text", "text": fused_prompt()},
+    ]
+    parsed_data, result_csv = await request_page(img_file, content_list, client, model, stats)
+    if not parsed_data:
+        return False
+
+    output_file = write_page_outputs(img_file, output_path, parsed_data)
+    manifest.record_unit(STAGE_NAME, img_file.name, input_hash, output_file, extra={"result_csv": result_csv})
+    first_page_example["image_base64"] = image_data_url
+    first_page_example["result_csv_str"] = result_csv
+    print(f"首图处理完成并已缓存为示例：{img_file.name}")
+    return True
+
+
+async def process_page_async(semaphore: asyncio.Semaphore, img_file: Path, output_path: Path, client: AsyncOpenAI, model: str, first_page_example: dict, manifest: StageManifest, images: ImagePrefetcher, stats: dict):
+    """其余页面以首图及其结果为 Few-shot 上下文（首图失败时无参考处理），一次请求得到 title,page_number,level"""
+    async with semaphore:
+        # 首图示例也是输入的一部分：首图结果变化后，其余页面需要重新处理
+        input_hash = hash_values(file_sha256(img_file), model, FUSED_PROMPT_TEXT, FUSED_EXAMPLE_IMAGE,
+                                 first_page_example["result_csv_str"], *level_input_values())
+        if manifest.get_unit(STAGE_NAME, img_file.name, input_hash):
+            write_log(f"跳过已处理文件：{img_file.name}")
+            images.discard(img_file)
+            return None
+
+        stats['pages'] += 1
+        content_list = []
+        if first_page_example["result_csv_str"]:
+            content_list.append({"type": "text", "text": "参考示例（第一页图片及其正确的 CSV 格式提取与层级分析结果）："})
+            if FUSED_EXAMPLE_IMAGE and first_page_example["image_base64"]:
+                content_list.append({"type": "image_url", "image_url": {"url": first_page_example["image_base64"]}})
+            content_list.extend([
+                {"type": "text", "text": f"参考结果 (CSV 格式):\n{first_page_example['result_csv_str']}"},
+                {"type": "text", "text": "---\n请严格参照上述示例的格式和层级判断标准，分析以下当前页图片："},
+            ])
+        else:
+            write_log(f"警告：未找到首图示例，将无参考处理 {img_file.name}")
+        content_list.extend([
+            {"type": "image_url", "image_url": {"url": await images.get(img_file)}},
+            {"type": "text", "text": fused_prompt()},
+        ])
+        parsed_data, _ = await request_page(img_file, content_list, client, model, stats)
+        if not parsed_data:
+            return False
+
+        output_file = write_page_outputs(img_file, output_path, parsed_data)
+        manifest.record_unit(STAGE_NAME, img_file.name, input_hash, output_file)
+        print(f"已提取目录并判断层级：{img_file.name}")
+        return True
+
+
+async def run_batch_processing(image_files: list, output_path: Path, client: AsyncOpenAI, model: str, manifest: StageManifest, stats: dict):
+    if not image_files:
+        return
+
+    # 目录页范围变化后，清理不再存在的页面遗留的结果，避免被 content_postprocessor 合并
+    manifest.prune_units(STAGE_NAME, [img.name for img in image_files])
+    semaphore = asyncio.Semaphore(CONCURRENT_LIMIT)
+    first_page_example = new_first_page_example()
+    images = ImagePrefetcher(image_files).start()
+    try:
+        write_log("阶段 1: 处理首图以生成 Few-shot 示例 (合并模式)")
+        if not await process_first_page(image_files[0], output_path, client, model, first_page_example, manifest, images, stats):
+            write_log("首图处理失败，无法生成参考示例，其余页面将不带示例处理。")
+            print("首图处理失败，其余页面将不带示例处理。请检查日志。")
+
+        if len(image_files) > 1:
+            write_log("阶段 2: 并发处理剩余图片 (合并模式)")
+            results = await asyncio.gather(
+                *[process_page_async(semaphore, img_file, output_path, client, model, first_page_example, manifest, images, stats)
+                  for img_file in image_files[1:]],
+                return_exceptions=True)
+            success_count = sum(1 for r in results if r is True)
+            fail_count = sum(1 for r in results if r is False)
+            exception_count = sum(1 for r in results if isinstance(r, Exception))
+            print(f"并发处理完成。成功：{success_count}, 失败/空结果：{fail_count}, 异常：{exception_count}")
+        else:
+            print("仅有一张图片，处理完毕。")
+    finally:
+        await images.close()
+        write_log(images.summary())
+        write_log(f"合并模式用量：{stats['pages']} 页，请求 {stats['requests']} 次，输出格式 {structured_output.LLM_OUTPUT_MODE}，"
+                  f"解析失败或结果为空重发 {stats['retries']} 次，输入 token {stats['prompt_tokens']}，输出 token {stats['completion_tokens']}")
+        if llm_hedge.LLM_HEDGE_ENABLED:
+            write_log(llm_hedge.hedge_policy(llm_routes.LEVELS).summary())
+
+
+async def extract_with_levels(input_path: Path, output_path: Path, llm_config: dict):
+    """每个目录页一次请求提取 title,page_number,level，输出 {stem}.csv 与 *_merged.json，返回请求次数与 token 用量统计"""
+    input_path = Path(input_path)
+    output_path = Path(output_path)
+
+    client, model = llm_routes.routed_clients(
+        llm_config, (llm_routes.LEVELS,), timeout=REQUEST_TIMEOUT, max_retries=2
+    )[llm_routes.LEVELS]
+
+    if not input_path.exists():
+        print(f"错误：输入路径不存在 {input_path}")
+        raise StageError(f"输入路径不存在 {input_path}")
+    output_path.mkdir(parents=True, exist_ok=True)
+
+    image_files = sorted([f for f in input_path.iterdir() if f.is_file() and f.suffix.lower() in IMAGE_EXTENSIONS], key=lambda x: natural_sort_key(x.name))
+
+    stats = new_level_stats()
+    if image_files:
+        manifest = StageManifest(get_session_base_dir() or output_path.parent)
+        await run_batch_processing(image_files, output_path, client, model, manifest, stats)
+        post_process_levels(output_path)
+        # 后处理可能改写了各页结果，同步清单中记录的输出哈希
+        manifest.refresh_units(STAGE_NAME)
+    else:
+        print("未找到需要处理的图片。")
+    return stats
+
+
+def run_stage(input_dir, output_dir, llm_config: dict):
+    """
+    阶段入口：合并模式下替代 qwen_vl_extract 与 determine_toc_levels 的阶段入口。
+    第二次调用（层级判定阶段）时各页均按阶段清单跳过，只重新执行层级后处理。
+    """
+    run_async(extract_with_levels(input_dir, output_dir, llm_config))
+
+
+async def main_async():
+    load_dotenv()
+    input_dir = os.getenv("QWEN_VL_EXTRACT_INPUT")
+    output_dir = os.getenv("QWEN_VL_EXTRACT_OUTPUT")
+    if not input_dir or not output_dir:
+        print("错误：未设置必要的环境变量 QWEN_VL_EXTRACT_INPUT 或 QWEN_VL_EXTRACT_OUTPUT")
+        sys.exit(1)
+    await extract_with_levels(input_dir, output_dir, qwen_vl_extract.load_llm_config())
+
+
+if __name__ == "__main__":
+    if sys.platform == 'win32':
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+    try:
+        asyncio.run(main_async())
+    except StageError:
+        sys.exit(1)
@@ -0,0 +1,121 @@
+import os
+import time
+import asyncio
+
+from mainprogress.page_artifacts import page_store
+
+# 请求图片的有界预取：按处理顺序在线程中提前编码页面的 data URL，
+# 已编码但尚未被请求取走的图片最多 IMAGE_PREFETCH_AHEAD 张、IMAGE_PREFETCH_MAX_BYTES 字节，
+# 取走或放弃后立即释放。第一个请求无需等待全部页面编码完成，多个 session 并发时
+# 每个 session 只在内存中保留少量待发送的图片。
+IMAGE_PREFETCH_AHEAD = int(os.getenv('IMAGE_PREFETCH_AHEAD', '4'))
+IMAGE_PREFETCH_MAX_BYTES = int(os.getenv('IMAGE_PREFETCH_MAX_BYTES', str(32 * 1024 * 1024)))
+
+
+def encode_image(image_path) -> str:
+    """编码页面存储中已有的直接复用，未命中时读取文件编码，但不登记到进程级的页面存储"""
+    return page_store.get_data_url(image_path, cache=False)
+
+
+class ImagePrefetcher:
+    """
+    image_files 为预计的请求顺序。get() 取走预取结果（尚未预取到的页面当场在线程中编码），
+    跳过请求的页面应调用 discard() 让出预取名额。
+    """
+
+    def __init__(self, image_files, ahead=IMAGE_PREFETCH_AHEAD, max_bytes=IMAGE_PREFETCH_MAX_BYTES):
+        self.ahead = max(1, ahead)
+        self.max_bytes = max_bytes
+        self._files = list(image_files)
+        self._ready = {}
+        self._claimed = set()
+        self._held_bytes = 0
+        self._space = asyncio.Event()
+        self._task = None
+        self._started = None
+        self._stats = {'prefetched': 0, 'on_demand': 0, 'discarded': 0, 'peak_items': 0, 'peak_bytes': 0,
+                       'first_image_ms': None}
+
+    def start(self):
+        self._started = time.perf_counter()
+        if self._files:
+            self._task = asyncio.create_task(self._produce())
+        return self
+
+    async def _produce(self):
+        for image_path in self._files:
+            key = str(image_path)
+            # 已编码未取走的图片达到张数或字节上限时，等待请求取走
+            while key not in self._claimed and (len(self._ready) >= self.ahead or self._held_bytes >= self.max_bytes):
+                self._space.clear()
+                await self._space.wait()
+            if key in self._claimed:
+                continue
+            future = asyncio.get_running_loop().create_future()
+            self._ready[key] = future
+            self._stats['peak_items'] = max(self._stats['peak_items'], len(self._ready))
+            try:
+                data_url = await asyncio.to_thread(encode_image, image_path)
+            except Exception as e:
+                future.set_exception(e)
+                if self._ready.get(key) is future:
+                    # 无人等待时由请求方按需重新编码，这里只标记异常已处理
+                    del self._ready[key]
+                    future.exception()
+                continue
+            future.set_result(data_url)
+            if self._ready.get(key) is future:
+                self._held_bytes += len(data_url)
+                self._stats['peak_bytes'] = max(self._stats['peak_bytes'], self._held_bytes)
+
+    def _release(self, key):
+        self._claimed.add(key)
+        future = self._ready.pop(key, None)
+        if future is not None and future.done() and not future.cancelled() and not future.exception():
+            self._held_bytes -= len(future.result())
+        self._space.set()
+        return future
+
+    async def get(self, image_path) -> str:
+        future = self._release(str(image_path))
+        data_url = None
+        if future is not None:
+            try:
+                data_url = await future
+                self._stats['prefetched'] += 1
+            except Exception:
+                data_url = None
+        if data_url is None:
+            self._stats['on_demand'] += 1
+            data_url = await asyncio.to_thread(encode_image, image_path)
+        if self._stats['first_image_ms'] is None:
+            self._stats['first_image_ms'] = round((time.perf_counter() - self._started) * 1000, 1)
+        return data_url
+
+    def discard(self, image_path):
+        """该页不再发送请求（已跳过或缺少输入）"""
+        future = self._release(str(image_path))
+        if future is not None:
+            self._stats['discarded'] += 1
+            future.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+    async def close(self) -> dict:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        for future in self._ready.values():
+            future.cancel()
+        self._ready.clear()
+        self._held_bytes = 0
+        return self.stats()
+
+    def stats(self) -> dict:
+        return dict(self._stats, total=len(self._files), ahead=self.ahead, max_bytes=self.max_bytes)
+
+    def summary(self) -> str:
+        stats = self.stats()
+        return (f"图片预取：{stats['total']} 张，预取命中 {stats['prefetched']}，按需编码 {stats['on_demand']}，"
+                f"放弃 {stats['discarded']}；缓冲峰值 {stats['peak_items']} 张 / {stats['peak_bytes'] / 1024 / 1024:.1f} MB"
+                f"（上限 {stats['ahead']} 张 / {stats['max_bytes'] / 1024 / 1024:.0f} MB），"
+                f"首张就绪 {stats['first_image_ms']}ms")
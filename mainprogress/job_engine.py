@@ -0,0 +1,205 @@
+import os
+import json
+import time
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+# 服务端作业引擎：一次提交即在后台顺序执行全部阶段，并在服务端完成重试，
+# 不再依赖浏览器逐个调用 /run_script 推进流程（关闭页面后作业也会继续执行）。
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '4'))
+JOB_MAX_RETRIES = int(os.getenv('JOB_MAX_RETRIES', '3'))  # 每个阶段的最大尝试次数
+JOB_RETRY_DELAY = float(os.getenv('JOB_RETRY_DELAY', '1'))  # 重试间隔（秒）
+# 上一次尝试（超时后仍未退出的进程内阶段）仍在写同一 session 目录时，重试前最多等待的秒数，超过则不再重试
+JOB_ATTEMPT_WAIT = float(os.getenv('JOB_ATTEMPT_WAIT', '600'))
+# 内存中最多保留的已结束作业数（按结束时间淘汰最早的），被淘汰的作业仍可由 get() 从状态文件读取
+JOB_MAX_FINISHED = int(os.getenv('JOB_MAX_FINISHED', '200'))
+JOB_STATUS_FILENAME = 'job_status.json'
+LOG_TAIL_CHARS = 4000
+
+# 作业状态
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_COMPLETED = 'completed'
+JOB_FAILED = 'failed'
+
+
+class JobEngine:
+    """
+    stage_sequence: [(script_name, script_desc), ...]
+    execute_stage: callable(script_name, base_dir) -> (returncode, stdout, stderr)，超时时抛出异常
+    prepare_job: 可选，callable(base_dir) -> (start_index, message)，用于跳过已有结果的阶段
+    on_completed: 可选，callable(base_dir)，全部阶段成功后调用
+    stage_alive: 可选，callable(base_dir) -> bool，上一次尝试是否仍在执行（重试前等待其结束）
+    """
+
+    def __init__(self, stage_sequence, execute_stage, max_workers=JOB_WORKERS,
+                 max_retries=JOB_MAX_RETRIES, retry_delay=JOB_RETRY_DELAY,
+                 prepare_job=None, on_completed=None, stage_alive=None, attempt_wait=JOB_ATTEMPT_WAIT):
+        self.stage_sequence = stage_sequence
+        self.execute_stage = execute_stage
+        self.prepare_job = prepare_job
+        self.on_completed = on_completed
+        self.stage_alive = stage_alive
+        self.attempt_wait = attempt_wait
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job-worker')
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, session_id, base_dir):
+        """提交作业。若该 session 已在排队或执行中，直接返回现有作业状态"""
+        with self._lock:
+            job = self._jobs.get(session_id)
+            if job and job['state'] in (JOB_QUEUED, JOB_RUNNING):
+                return dict(job)
+            job = {
+                'session_id': session_id,
+                'state': JOB_QUEUED,
+                'current_index': 0,
+                'current_stage': None,
+                'total_stages': len(self.stage_sequence),
+                'attempt': 0,
+                'message': '已加入队列',
+                'stages': [],
+                'submitted_at': time.time(),
+                'started_at': None,
+                'finished_at': None,
+            }
+            self._jobs[session_id] = job
+            self._save(base_dir, job)
+        self._executor.submit(self._run_job, session_id, base_dir)
+        return dict(job)
+
+    def get(self, session_id, base_dir=None):
+        """
+        获取作业状态；内存中不存在时（例如服务重启后）尝试读取 session 目录中的状态文件。
+        状态文件中仍为排队或执行中的作业已随上一个进程中断，标记为失败后返回。
+        """
+        with self._lock:
+            job = self._jobs.get(session_id)
+            if job:
+                return dict(job)
+            if not base_dir:
+                return None
+            status_path = os.path.join(base_dir, JOB_STATUS_FILENAME)
+            if not os.path.exists(status_path):
+                return None
+            try:
+                with open(status_path, 'r', encoding='utf-8') as f:
+                    job = json.load(f)
+            except (OSError, json.JSONDecodeError):
+                return None
+            if job.get('state') in (JOB_QUEUED, JOB_RUNNING):
+                job.update(state=JOB_FAILED, interrupted=True, finished_at=time.time(),
+                           message='服务已重启，作业执行中断，请重新提交')
+                self._save(base_dir, job)
+            return job
+
+    def _update(self, session_id, base_dir, **fields):
+        with self._lock:
+            job = self._jobs[session_id]
+            job.update(fields)
+            self._save(base_dir, job)
+            if job['state'] in (JOB_COMPLETED, JOB_FAILED):
+                self._prune_locked()
+
+    def _prune_locked(self):
+        finished = [job for job in self._jobs.values() if job['state'] in (JOB_COMPLETED, JOB_FAILED)]
+        if len(finished) <= JOB_MAX_FINISHED:
+            return
+        finished.sort(key=lambda job: job['finished_at'] or 0)
+        for job in finished[:len(finished) - JOB_MAX_FINISHED]:
+            del self._jobs[job['session_id']]
+
+    def _append_stage(self, session_id, base_dir, record):
+        with self._lock:
+            job = self._jobs[session_id]
+            job['stages'].append(record)
+            self._save(base_dir, job)
+
+    @staticmethod
+    def _save(base_dir, job):
+        """将作业状态写入 session 目录（先写临时文件再替换，避免读到半写入的文件）"""
+        try:
+            status_path = os.path.join(base_dir, JOB_STATUS_FILENAME)
+            tmp_path = status_path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(job, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, status_path)
+        except OSError:
+            pass
+
+    def _wait_attempt_finished(self, session_id, base_dir, script_desc) -> bool:
+        """等待上一次尝试真正结束，避免重试与其同时写入 session 目录和阶段清单；超时返回 False"""
+        if not self.stage_alive or not self.stage_alive(base_dir):
+            return True
+        self._update(session_id, base_dir, message=f'{script_desc}执行超时，等待上一次尝试结束后重试')
+        deadline = time.time() + self.attempt_wait
+        while self.stage_alive(base_dir):
+            if time.time() >= deadline:
+                return False
+            time.sleep(min(self.retry_delay, 1) or 0.1)
+        return True
+
+    def _run_job(self, session_id, base_dir):
+        self._update(session_id, base_dir, state=JOB_RUNNING, started_at=time.time(), message='开始执行')
+
+        start_index = 0
+        if self.prepare_job:
+            try:
+                start_index, message = self.prepare_job(base_dir)
+                if message:
+                    self._update(session_id, base_dir, message=message, skipped_stages=start_index)
+            except Exception:
+                traceback.print_exc()
+                start_index = 0
+
+        for index, (script_name, script_desc) in enumerate(self.stage_sequence):
+            if index < start_index:
+                continue
+            succeeded = False
+            for attempt in range(1, self.max_retries + 1):
+                self._update(session_id, base_dir, current_index=index, current_stage=script_desc,
+                             attempt=attempt, message=f'正在执行：{script_desc} ({index + 1}/{len(self.stage_sequence)})')
+                started = time.time()
+                try:
+                    returncode, stdout, stderr = self.execute_stage(script_name, base_dir)
+                except Exception as e:
+                    returncode, stdout, stderr = 1, '', f'{type(e).__name__}: {e}\n{traceback.format_exc()}'
+
+                self._append_stage(session_id, base_dir, {
+                    'script': script_name,
+                    'desc': script_desc,
+                    'attempt': attempt,
+                    'returncode': returncode,
+                    'elapsed': round(time.time() - started, 3),
+                    'stdout': (stdout or '')[-LOG_TAIL_CHARS:],
+                    'stderr': (stderr or '')[-LOG_TAIL_CHARS:],
+                })
+
+                if returncode == 0:
+                    succeeded = True
+                    break
+                if attempt < self.max_retries:
+                    if not self._wait_attempt_finished(session_id, base_dir, script_desc):
+                        self._update(session_id, base_dir, state=JOB_FAILED, finished_at=time.time(),
+                                     message=f'{script_desc}执行超时，上一次尝试在{self.attempt_wait:g}秒内仍未结束，不再重试')
+                        return
+                    self._update(session_id, base_dir, message=f'{script_desc}执行失败，{self.retry_delay:g}秒后进行第{attempt}次重试')
+                    time.sleep(self.retry_delay)
+
+            if not succeeded:
+                self._update(session_id, base_dir, state=JOB_FAILED, finished_at=time.time(),
+                             message=f'{script_desc}执行失败，已重试{self.max_retries - 1}次')
+                return
+
+        if self.on_completed:
+            try:
+                self.on_completed(base_dir)
+            except Exception:
+                traceback.print_exc()
+
+        self._update(session_id, base_dir, state=JOB_COMPLETED, current_index=len(self.stage_sequence),
+                     current_stage=None, finished_at=time.time(), message='所有脚本执行完成')
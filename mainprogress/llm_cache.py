@@ -0,0 +1,130 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+# 持久化 LLM 响应缓存：各阶段的请求均为 temperature=0 的确定性请求，
+# 崩溃后重跑或前端重试时会发送完全相同的图片和提示词，命中缓存即可免去 token 与等待时间。
+# 键为 model + base_url + 请求参数（含 base64 图片）的哈希；值为完整的 ChatCompletion JSON。
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LLM_CACHE_ENABLED = os.getenv('LLM_CACHE_ENABLED', '1') == '1'
+LLM_CACHE_PATH = os.getenv('LLM_CACHE_PATH', os.path.join(PROJECT_ROOT, 'data', 'llm_cache.sqlite3'))
+LLM_CACHE_TTL = float(os.getenv('LLM_CACHE_TTL', str(7 * 24 * 3600)))  # 秒
+LLM_CACHE_MAX_BYTES = int(os.getenv('LLM_CACHE_MAX_BYTES', str(256 * 1024 * 1024)))
+
+# 不影响模型输出的参数不参与计算缓存键（流式与非流式请求共用同一条缓存）
+IGNORED_KWARGS = {'timeout', 'extra_headers', 'stream', 'stream_options'}
+
+
+def compute_request_key(model, base_url, kwargs) -> str:
+    payload = {k: v for k, v in kwargs.items() if k not in IGNORED_KWARGS}
+    raw = json.dumps(payload, ensure_ascii=False, sort_keys=True, default=str)
+    digest = hashlib.sha256()
+    digest.update(f"{model}|{base_url}|".encode('utf-8'))
+    digest.update(raw.encode('utf-8'))
+    return digest.hexdigest()
+
+
+class LLMResponseCache:
+    """基于 SQLite 的响应缓存，支持 TTL、总字节上限（按最近访问时间 LRU 淘汰）和命中统计"""
+
+    def __init__(self, path=LLM_CACHE_PATH, ttl=LLM_CACHE_TTL, max_bytes=LLM_CACHE_MAX_BYTES):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = None
+        self._stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0, 'expired': 0}
+
+    def _connect(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS responses ('
+                'key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, '
+                'created REAL NOT NULL, last_access REAL NOT NULL)'
+            )
+            self._conn.execute('CREATE INDEX IF NOT EXISTS idx_last_access ON responses(last_access)')
+            self._conn.commit()
+        return self._conn
+
+    def get(self, key):
+        """命中返回响应 JSON 字符串，否则返回 None"""
+        with self._lock:
+            try:
+                conn = self._connect()
+                row = conn.execute('SELECT value, created FROM responses WHERE key = ?', (key,)).fetchone()
+                now = time.time()
+                if row and now - row[1] > self.ttl:
+                    conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+                    conn.commit()
+                    self._stats['expired'] += 1
+                    row = None
+                if not row:
+                    self._stats['misses'] += 1
+                    return None
+                conn.execute('UPDATE responses SET last_access = ? WHERE key = ?', (now, key))
+                conn.commit()
+                self._stats['hits'] += 1
+                return row[0]
+            except sqlite3.Error:
+                self._stats['misses'] += 1
+                return None
+
+    def put(self, key, value: str):
+        with self._lock:
+            try:
+                conn = self._connect()
+                now = time.time()
+                conn.execute(
+                    'INSERT OR REPLACE INTO responses (key, value, size, created, last_access) VALUES (?, ?, ?, ?, ?)',
+                    (key, value, len(value.encode('utf-8')), now, now)
+                )
+                self._stats['stores'] += 1
+                self._evict_locked(conn, now)
+                conn.commit()
+            except sqlite3.Error:
+                pass
+
+    def _evict_locked(self, conn, now):
+        cursor = conn.execute('DELETE FROM responses WHERE created < ?', (now - self.ttl,))
+        self._stats['expired'] += cursor.rowcount
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in conn.execute('SELECT key, size FROM responses ORDER BY last_access').fetchall():
+            if total <= self.max_bytes:
+                break
+            conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+            total -= size
+            self._stats['evictions'] += 1
+
+    def clear(self) -> int:
+        with self._lock:
+            try:
+                conn = self._connect()
+                cursor = conn.execute('DELETE FROM responses')
+                conn.commit()
+                return cursor.rowcount
+            except sqlite3.Error:
+                return 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            lookups = stats['hits'] + stats['misses']
+            stats['hit_rate'] = round(stats['hits'] / lookups, 3) if lookups else None
+            try:
+                entries, total = self._connect().execute(
+                    'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses').fetchone()
+                stats.update({'entries': entries, 'total_bytes': total, 'max_bytes': self.max_bytes})
+            except sqlite3.Error:
+                pass
+            return stats
+
+
+response_cache = LLMResponseCache()
@@ -0,0 +1,132 @@
+import os
+import time
+import asyncio
+import threading
+from collections import deque
+
+# 请求对冲（hedged requests）：逐页请求运行时间超过近期延迟的 p90 仍未返回时，再发出一份相同的请求，
+# 先返回者胜出，另一份立即取消。整本书的完成时间取决于最慢的一页，对冲用少量额外请求压低长尾。
+# - 延迟样本按调用类别（extract / levels）分别统计，样本不足 LLM_HEDGE_MIN_SAMPLES 时不对冲；
+# - 对冲请求总数不超过原始请求的 LLM_HEDGE_MAX_RATIO，调度器因 429 暂停派发期间不对冲；
+# - 对冲请求同样经过全局调度器排队，受速率与并发限制。
+LLM_HEDGE_ENABLED = os.getenv('LLM_HEDGE', '0') == '1'
+LLM_HEDGE_QUANTILE = float(os.getenv('LLM_HEDGE_QUANTILE', '0.9'))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv('LLM_HEDGE_MIN_SAMPLES', '8'))
+LLM_HEDGE_MAX_RATIO = float(os.getenv('LLM_HEDGE_MAX_RATIO', '0.1'))
+LLM_HEDGE_WINDOW = 200  # 参与分位数计算的最近样本数
+
+
+def quantile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+class HedgePolicy:
+    """单个调用类别的对冲策略；线程安全，进程内所有 session 共用延迟样本"""
+
+    def __init__(self, name, q=LLM_HEDGE_QUANTILE, min_samples=LLM_HEDGE_MIN_SAMPLES,
+                 max_ratio=LLM_HEDGE_MAX_RATIO, window=LLM_HEDGE_WINDOW):
+        self.name = name
+        self.q = q
+        self.min_samples = min_samples
+        self.max_ratio = max_ratio
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=window)
+        self._stats = {'calls': 0, 'hedged': 0, 'hedge_won': 0, 'capped': 0}
+
+    def threshold(self):
+        """当前的对冲等待时间（秒）；样本不足时为 None"""
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return None
+            return quantile(self._latencies, self.q)
+
+    def _record(self, latency):
+        with self._lock:
+            self._latencies.append(latency)
+
+    def _try_hedge(self, throttled) -> bool:
+        with self._lock:
+            if throttled or self._stats['hedged'] + 1 > self.max_ratio * self._stats['calls']:
+                self._stats['capped'] += 1
+                return False
+            self._stats['hedged'] += 1
+            return True
+
+    async def run(self, make_call, throttled=lambda: False):
+        """
+        make_call: 无参 callable，返回一次请求的协程；throttled: 返回 True 时本次不对冲。
+        返回先成功的结果；两份请求都失败时抛出主请求的异常。
+        """
+        with self._lock:
+            self._stats['calls'] += 1
+        started = time.monotonic()
+        delay = self.threshold()
+        tasks = [asyncio.ensure_future(make_call())]
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done and self._try_hedge(throttled()):
+                    tasks.append(asyncio.ensure_future(make_call()))
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        self._record(time.monotonic() - started)
+                        if task is not tasks[0]:
+                            with self._lock:
+                                self._stats['hedge_won'] += 1
+                        return task.result()
+            # 全部失败
+            return tasks[0].result()
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def summary(self) -> str:
+        stats = self.stats()
+        extra = stats['hedged'] / stats['calls'] * 100 if stats['calls'] else 0.0
+        return (f"请求对冲[{self.name}]：累计 {stats['calls']} 次请求，触发对冲 {stats['hedged']} 次（对冲胜出 {stats['hedge_won']}），"
+                f"因上限或限流未对冲 {stats['capped']} 次，额外请求占比 {extra:.1f}%；"
+                f"近期延迟 p50 {stats['p50']}s，p99 {stats['p99']}s，对冲阈值 {stats['threshold']}s")
+
+    def stats(self) -> dict:
+        with self._lock:
+            latencies = list(self._latencies)
+            stats = dict(self._stats)
+        stats.update({
+            'name': self.name,
+            'samples': len(latencies),
+            'threshold': round(quantile(latencies, self.q), 3) if len(latencies) >= self.min_samples else None,
+            'p50': round(quantile(latencies, 0.5), 3) if latencies else None,
+            'p99': round(quantile(latencies, 0.99), 3) if latencies else None,
+        })
+        return stats
+
+
+_policies = {}
+_policies_lock = threading.Lock()
+
+
+def hedge_policy(name) -> HedgePolicy:
+    with _policies_lock:
+        if name not in _policies:
+            _policies[name] = HedgePolicy(name)
+        return _policies[name]
+
+
+def reset_policies():
+    """清空全部延迟样本与计数（供基准测试在不同模式之间调用）"""
+    with _policies_lock:
+        _policies.clear()
+
+
+def hedge_stats() -> dict:
+    with _policies_lock:
+        policies = list(_policies.values())
+    return {policy.name: policy.stats() for policy in policies}
@@ -0,0 +1,61 @@
+from openai import AsyncOpenAI
+
+# 按调用类别路由模型：llm_config.json 可选的 routes 字段为每类调用单独指定 model / base_url / api_key，
+# 未指定的字段沿用顶层配置。目录页判定、偏移量读数、书名识别这类分类调用可交给小模型，
+# 目录提取与层级判定继续使用顶层的大模型。例如：
+# {
+#   "api_key": "$DASHSCOPE_API_KEY$",
+#   "base_url": "https://dashscope.aliyuncs.com/compatible-mode/v1",
+#   "model": "qwen3.5-397b-a17b",
+#   "routes": {"toc_detect": {"model": "qwen3-vl-flash"}, "offset": {"model": "qwen3-vl-flash"}}
+# }
+TOC_DETECT = 'toc_detect'  # 目录窗口识别与冲突页单页投票
+OFFSET = 'offset'          # 偏移量采样（单页印刷页码读数）
+BOOK_NAME = 'book_name'    # 封面书名识别
+EXTRACT = 'extract'        # 目录页 title,page_number 提取
+LEVELS = 'levels'          # 目录层级判定
+CALL_CLASSES = (TOC_DETECT, OFFSET, BOOK_NAME, EXTRACT, LEVELS)
+ROUTE_FIELDS = ('api_key', 'base_url', 'model')
+
+
+def resolve_routes(config: dict, resolve_value) -> dict:
+    """解析原始配置中的 routes（值同样支持 $ENV_NAME$ 形式），忽略未知的调用类别与空值"""
+    routes = {}
+    for call_class, route in (config.get('routes') or {}).items():
+        if call_class not in CALL_CLASSES or not isinstance(route, dict):
+            continue
+        resolved = {field: resolve_value(route[field]) for field in ROUTE_FIELDS if route.get(field)}
+        if resolved:
+            routes[call_class] = resolved
+    return routes
+
+
+def route_for(llm_config: dict, call_class: str) -> dict:
+    """该类调用实际使用的 {api_key, base_url, model}"""
+    route = {field: llm_config.get(field) for field in ROUTE_FIELDS}
+    route.update((llm_config.get('routes') or {}).get(call_class, {}))
+    return route
+
+
+def models_fingerprint(llm_config: dict) -> str:
+    """参与阶段清单与结果缓存键的模型标识；未配置 routes 时即顶层 model，与原有的键保持一致"""
+    llm_config = llm_config or {}
+    parts = [llm_config.get('model') or '']
+    for call_class in CALL_CLASSES:
+        if call_class in (llm_config.get('routes') or {}):
+            route = route_for(llm_config, call_class)
+            parts.append(f"{call_class}={route['model']}@{route['base_url']}")
+    return '|'.join(parts)
+
+
+def routed_clients(llm_config: dict, call_classes, **client_kwargs) -> dict:
+    """返回 {调用类别: (AsyncOpenAI 客户端, 模型名)}，api_key 与 base_url 相同的类别共用一个客户端"""
+    clients = {}
+    result = {}
+    for call_class in call_classes:
+        route = route_for(llm_config, call_class)
+        key = (route['api_key'], route['base_url'])
+        if key not in clients:
+            clients[key] = AsyncOpenAI(api_key=route['api_key'], base_url=route['base_url'], **client_kwargs)
+        result[call_class] = (clients[key], route['model'])
+    return result
@@ -0,0 +1,416 @@
+import os
+import time
+import math
+import random
+import asyncio
+import threading
+from collections import OrderedDict, deque, defaultdict
+from email.utils import parsedate_to_datetime
+
+from openai import RateLimitError, APIConnectionError, APITimeoutError, InternalServerError
+from openai.types.chat import ChatCompletion
+from openai.types.chat.chat_completion import Choice
+from openai.types.chat.chat_completion_message import ChatCompletionMessage
+
+from mainprogress.stage_context import get_session_base_dir
+from mainprogress.llm_cache import LLM_CACHE_ENABLED, compute_request_key, response_cache
+from mainprogress import llm_hedge
+
+# 全局 LLM 请求调度器：所有 chat.completions.create 调用都经过这里。
+# - 令牌桶限制请求速率（LLM_RPS / LLM_BURST）
+# - AIMD 自适应并发：成功且延迟正常时缓慢加一，遇到 429 或延迟明显升高时按比例收缩
+# - 遵守 Retry-After：收到 429 后全局暂停派发，到期后由调度器自动重试
+# - 按 session 轮询派发，避免单本书的大量请求饿死其他 session
+# 进程内模式下所有阶段、所有 session 共用同一个调度器；子进程模式下每个进程各自一个。
+LLM_RPS = float(os.getenv('LLM_RPS', '10'))  # 令牌桶每秒补充的请求数
+LLM_BURST = float(os.getenv('LLM_BURST', '20'))  # 令牌桶容量
+LLM_INITIAL_CONCURRENCY = float(os.getenv('LLM_INITIAL_CONCURRENCY', '8'))
+LLM_MIN_CONCURRENCY = float(os.getenv('LLM_MIN_CONCURRENCY', '1'))
+LLM_MAX_CONCURRENCY = float(os.getenv('LLM_MAX_CONCURRENCY', '48'))
+LLM_LATENCY_FACTOR = float(os.getenv('LLM_LATENCY_FACTOR', '2.0'))  # 平均延迟超过基线的倍数时收缩并发
+RATE_LIMIT_RETRIES = int(os.getenv('LLM_RATE_LIMIT_RETRIES', '6'))
+DEFAULT_RETRY_AFTER = 2.0  # 429 未携带 Retry-After 时的暂停秒数
+MAX_RETRY_AFTER = 60.0
+# 按 session 统计只保留最近有请求的若干个 session（常驻进程会处理大量 session）
+LLM_STATS_MAX_SESSIONS = int(os.getenv('LLM_STATS_MAX_SESSIONS', '100'))
+
+DECREASE_FACTOR = 0.5  # 429 时的乘性收缩比例
+LATENCY_DECREASE_FACTOR = 0.9  # 延迟升高时的乘性收缩比例
+DECREASE_COOLDOWN = 2.0  # 两次收缩之间的最小间隔（秒），避免同一批失败连续收缩
+EWMA_ALPHA = 0.2
+BASELINE_DECAY = 1.01  # 延迟基线缓慢上浮，避免一次极快的响应永久压低基线
+
+DEFAULT_SESSION = 'default'
+
+
+class StreamAborted(Exception):
+    """流式响应的消费方判定输出已不可用而提前中止；content 为中止前收到的内容，chunks 为收到的片段数"""
+
+    def __init__(self, reason, content='', chunks=0):
+        super().__init__(reason)
+        self.reason = reason
+        self.content = content
+        self.chunks = chunks
+
+
+def parse_retry_after(error) -> float:
+    """从 429 响应头中解析 Retry-After（支持 retry-after-ms、秒数和 HTTP 日期）"""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    try:
+        retry_after_ms = headers.get('retry-after-ms')
+        if retry_after_ms:
+            return min(float(retry_after_ms) / 1000, MAX_RETRY_AFTER)
+        retry_after = headers.get('retry-after')
+        if retry_after:
+            try:
+                return min(float(retry_after), MAX_RETRY_AFTER)
+            except ValueError:
+                retry_at = parsedate_to_datetime(retry_after).timestamp()
+                return min(max(retry_at - time.time(), 0), MAX_RETRY_AFTER)
+    except (TypeError, ValueError):
+        pass
+    return DEFAULT_RETRY_AFTER
+
+
+class LLMScheduler:
+    """
+    线程安全的请求调度器。各阶段在各自线程的事件循环中运行，
+    因此等待者以 (loop, future) 形式登记，放行时通过 call_soon_threadsafe 唤醒。
+    """
+
+    def __init__(self, rate=LLM_RPS, burst=LLM_BURST, initial_concurrency=LLM_INITIAL_CONCURRENCY,
+                 min_concurrency=LLM_MIN_CONCURRENCY, max_concurrency=LLM_MAX_CONCURRENCY,
+                 latency_factor=LLM_LATENCY_FACTOR):
+        self.rate = rate
+        self.burst = burst
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.latency_factor = latency_factor
+
+        self._lock = threading.Lock()
+        self._limit = initial_concurrency
+        self._in_flight = 0
+        self._tokens = burst
+        self._last_refill = time.monotonic()
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._latency_ewma = None
+        self._latency_baseline = None
+        self._timer = None
+
+        # session -> deque[(loop, future)]，以及轮询顺序
+        self._queues = defaultdict(deque)
+        self._round_robin = deque()
+
+        self._stats = {
+            'requests': 0,
+            'succeeded': 0,
+            'failed': 0,
+            'rate_limited': 0,
+            'cancelled': 0,
+            'aborted': 0,
+            'per_session': OrderedDict(),
+        }
+
+    # ---------- 派发 ----------
+
+    def _refill_locked(self, now):
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        self._tokens = min(self.burst, self._tokens + elapsed * self.rate)
+
+    def _schedule_timer_locked(self, delay):
+        if self._timer is not None:
+            return
+        self._timer = threading.Timer(max(delay, 0.01), self._on_timer)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _on_timer(self):
+        with self._lock:
+            self._timer = None
+            self._dispatch_locked()
+
+    def _dispatch_locked(self):
+        while self._round_robin and self._in_flight < max(1, math.floor(self._limit)):
+            now = time.monotonic()
+            if now < self._paused_until:
+                self._schedule_timer_locked(self._paused_until - now)
+                return
+            self._refill_locked(now)
+            if self._tokens < 1:
+                self._schedule_timer_locked((1 - self._tokens) / self.rate)
+                return
+
+            session = self._round_robin.popleft()
+            queue = self._queues[session]
+            loop, future = queue.popleft()
+            if queue:
+                self._round_robin.append(session)
+            else:
+                del self._queues[session]
+
+            self._tokens -= 1
+            self._in_flight += 1
+            try:
+                loop.call_soon_threadsafe(self._grant, future)
+            except RuntimeError:
+                # 等待者所在的事件循环已关闭
+                self._in_flight -= 1
+
+    def _grant(self, future):
+        if future.done():
+            # 等待者已被取消，归还名额
+            self._release()
+        else:
+            future.set_result(None)
+
+    def _release(self):
+        with self._lock:
+            self._in_flight -= 1
+            self._dispatch_locked()
+
+    async def acquire(self, session=DEFAULT_SESSION):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._lock:
+            if session not in self._queues:
+                self._round_robin.append(session)
+            self._queues[session].append((loop, future))
+            self._dispatch_locked()
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self._lock:
+                queue = self._queues.get(session)
+                if queue and (loop, future) in queue:
+                    queue.remove((loop, future))
+                    if not queue:
+                        del self._queues[session]
+                        self._round_robin.remove(session)
+                    raise
+            # 已被放行但在唤醒前取消：由 _grant 归还名额
+            if future.done() and not future.cancelled():
+                self._release()
+            raise
+
+    # ---------- AIMD ----------
+
+    def _on_success(self, latency):
+        with self._lock:
+            self._stats['succeeded'] += 1
+            if self._latency_ewma is None:
+                self._latency_ewma = latency
+            else:
+                self._latency_ewma = EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * self._latency_ewma
+            if self._latency_baseline is None or self._latency_ewma < self._latency_baseline:
+                self._latency_baseline = self._latency_ewma
+            else:
+                self._latency_baseline *= BASELINE_DECAY
+
+            now = time.monotonic()
+            if (self._latency_ewma > self._latency_baseline * self.latency_factor
+                    and now - self._last_decrease > DECREASE_COOLDOWN):
+                self._limit = max(self.min_concurrency, self._limit * LATENCY_DECREASE_FACTOR)
+                self._last_decrease = now
+            else:
+                # 加性增长：每个并发窗口的请求全部成功后并发数约加 1
+                self._limit = min(self.max_concurrency, self._limit + 1 / max(self._limit, 1))
+
+    def _on_rate_limited(self, retry_after):
+        with self._lock:
+            self._stats['rate_limited'] += 1
+            now = time.monotonic()
+            self._paused_until = max(self._paused_until, now + retry_after)
+            if now - self._last_decrease > DECREASE_COOLDOWN:
+                self._limit = max(self.min_concurrency, self._limit * DECREASE_FACTOR)
+                self._last_decrease = now
+
+    # ---------- 对外接口 ----------
+
+    async def create_chat_completion(self, client, session=None, consume=None, **kwargs):
+        """
+        经调度器发送 chat.completions.create 请求。
+        429 与临时性错误（连接失败、超时、5xx）由调度器自行重试，其余异常原样抛出。
+        consume: 可选，流式请求时 async callable(stream) -> ChatCompletion；读取完毕前持续占用并发名额，
+        读取中途的临时性错误同样整体重试。
+        """
+        session = session or get_session_base_dir() or DEFAULT_SESSION
+        # 关闭 SDK 内置重试，使 429 能被调度器感知并统一退避
+        transient_retries = client.max_retries
+        raw_client = client.with_options(max_retries=0)
+        rate_limit_attempts = 0
+        transient_attempts = 0
+
+        while True:
+            wait_start = time.monotonic()
+            await self.acquire(session)
+            started = time.monotonic()
+            with self._lock:
+                self._stats['requests'] += 1
+                session_stats = self._session_stats_locked(session)
+                session_stats['requests'] += 1
+                session_stats['wait_time'] += started - wait_start
+            try:
+                response = await raw_client.chat.completions.create(**kwargs)
+                if consume is not None:
+                    response = await consume(response)
+            except StreamAborted:
+                self._release()
+                with self._lock:
+                    self._stats['aborted'] += 1
+                raise
+            except RateLimitError as e:
+                self._release()
+                self._on_rate_limited(parse_retry_after(e))
+                rate_limit_attempts += 1
+                if rate_limit_attempts > RATE_LIMIT_RETRIES:
+                    with self._lock:
+                        self._stats['failed'] += 1
+                    raise
+                continue
+            except (APIConnectionError, APITimeoutError, InternalServerError):
+                self._release()
+                transient_attempts += 1
+                if transient_attempts > transient_retries:
+                    with self._lock:
+                        self._stats['failed'] += 1
+                    raise
+                await asyncio.sleep(min(0.5 * 2 ** transient_attempts, 8) * (0.75 + random.random() / 2))
+                continue
+            except asyncio.CancelledError:
+                # 调用方主动取消（如偏移量采样已达成一致），不计为失败
+                self._release()
+                with self._lock:
+                    self._stats['cancelled'] += 1
+                raise
+            except BaseException:
+                self._release()
+                with self._lock:
+                    self._stats['failed'] += 1
+                raise
+
+            self._release()
+            self._on_success(time.monotonic() - started)
+            return response
+
+    def _session_stats_locked(self, session):
+        """取出 session 的统计项并移到最近位置，超过 LLM_STATS_MAX_SESSIONS 时丢弃最久未请求的 session"""
+        per_session = self._stats['per_session']
+        session_stats = per_session.get(session)
+        if session_stats is None:
+            session_stats = per_session[session] = {'requests': 0, 'wait_time': 0.0}
+            while len(per_session) > LLM_STATS_MAX_SESSIONS:
+                per_session.popitem(last=False)
+        else:
+            per_session.move_to_end(session)
+        return session_stats
+
+    def is_throttled(self) -> bool:
+        """因 429 暂停派发或已有请求在排队时不再追加对冲请求"""
+        with self._lock:
+            return time.monotonic() < self._paused_until or any(self._queues.values())
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'concurrency_limit': round(self._limit, 2),
+                'in_flight': self._in_flight,
+                'tokens': round(self._tokens, 2),
+                'paused_for': round(max(self._paused_until - time.monotonic(), 0), 2),
+                'latency_ewma': round(self._latency_ewma, 3) if self._latency_ewma else None,
+                'latency_baseline': round(self._latency_baseline, 3) if self._latency_baseline else None,
+                'waiting': {session: len(queue) for session, queue in self._queues.items()},
+                'requests': self._stats['requests'],
+                'succeeded': self._stats['succeeded'],
+                'failed': self._stats['failed'],
+                'rate_limited': self._stats['rate_limited'],
+                'cancelled': self._stats['cancelled'],
+                'aborted': self._stats['aborted'],
+                'per_session': {k: dict(v) for k, v in self._stats['per_session'].items()},
+                'hedge': llm_hedge.hedge_stats(),
+            }
+
+
+scheduler = LLMScheduler()
+
+
+def _is_cacheable(content, cache_validate) -> bool:
+    if not content or not content.strip():
+        return False
+    if cache_validate is None:
+        return True
+    try:
+        return bool(cache_validate(content))
+    except Exception:
+        return False
+
+
+def stream_consumer(on_text=None):
+    """
+    生成 create_chat_completion 的 consume 参数：逐片段累积流式响应并组装为 ChatCompletion。
+    on_text: 可选，callable(delta)，按到达顺序传入增量文本；抛出 StreamAborted 时立即关闭连接，不再接收剩余输出。
+    """
+    async def consume(stream):
+        parts = []
+        chunks = 0
+        response_id, model, created, usage, finish_reason = None, None, 0, None, None
+        try:
+            async for chunk in stream:
+                response_id, model, created = chunk.id, chunk.model, chunk.created
+                if chunk.usage:
+                    usage = chunk.usage
+                if not chunk.choices:
+                    continue
+                choice = chunk.choices[0]
+                finish_reason = choice.finish_reason or finish_reason
+                if choice.delta and choice.delta.content:
+                    chunks += 1
+                    parts.append(choice.delta.content)
+                    if on_text is not None:
+                        try:
+                            on_text(choice.delta.content)
+                        except StreamAborted as e:
+                            e.content, e.chunks = ''.join(parts), chunks
+                            raise
+        finally:
+            await stream.close()
+        return ChatCompletion(
+            id=response_id or 'stream', object='chat.completion', created=created or int(time.time()), model=model or '',
+            choices=[Choice(index=0, finish_reason=finish_reason or 'stop',
+                            message=ChatCompletionMessage(role='assistant', content=''.join(parts)))],
+            usage=usage,
+        )
+    return consume
+
+
+async def chat_completion(client, cache_validate=None, consume=None, hedge=None, **kwargs):
+    """
+    所有阶段统一使用的 LLM 调用入口：确定性请求（temperature=0）先查响应缓存，未命中再经调度器发送。
+    cache_validate: 可选，callable(content) -> bool；仅当响应内容通过校验时才写入缓存，
+    避免格式错误的响应被缓存后，阶段内的重试永远拿到同一个错误结果。
+    consume: 流式请求（stream=True）的读取函数，见 stream_consumer；组装后的完整响应同样可以缓存，
+    缓存命中时直接返回完整响应，不再经过 consume。
+    hedge: 可选，调用类别名；启用 LLM_HEDGE 时按该类别的近期延迟对慢请求发出对冲请求（见 llm_hedge），
+    流式请求不对冲。
+    响应缓存的 SQLite 读写（锁等待最长 30 秒）放到线程中执行，不阻塞事件循环。
+    """
+    use_cache = LLM_CACHE_ENABLED and kwargs.get('temperature') == 0 and (not kwargs.get('stream') or consume is not None)
+    if use_cache:
+        key = compute_request_key(kwargs.get('model'), str(client.base_url), kwargs)
+        cached = await asyncio.to_thread(response_cache.get, key)
+        if cached is not None:
+            return ChatCompletion.model_validate_json(cached)
+
+    if hedge and llm_hedge.LLM_HEDGE_ENABLED and consume is None:
+        response = await llm_hedge.hedge_policy(hedge).run(
+            lambda: scheduler.create_chat_completion(client, **kwargs), scheduler.is_throttled)
+    else:
+        response = await scheduler.create_chat_completion(client, consume=consume, **kwargs)
+
+    if use_cache:
+        content = response.choices[0].message.content if response.choices else None
+        if _is_cacheable(content, cache_validate):
+            await asyncio.to_thread(response_cache.put, key, response.model_dump_json())
+    return response
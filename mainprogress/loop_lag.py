@@ -0,0 +1,44 @@
+import os
+import asyncio
+
+# 事件循环延迟监测：后台任务按固定间隔 sleep，记录实际唤醒时间比预期晚了多少。
+# 协程中直接执行的同步渲染、编码会让延迟明显升高，期间其他请求的响应都得不到处理。
+LOOP_LAG_INTERVAL = float(os.getenv('LOOP_LAG_INTERVAL', '0.02'))
+
+
+class LoopLagMonitor:
+
+    def __init__(self, interval=LOOP_LAG_INTERVAL):
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - expected))
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    async def stop(self) -> dict:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        return self.summary()
+
+    def summary(self) -> dict:
+        """延迟统计（毫秒）：样本数、平均、p95、最大"""
+        if not self.samples:
+            return {'samples': 0, 'mean_ms': 0.0, 'p95_ms': 0.0, 'max_ms': 0.0}
+        ordered = sorted(self.samples)
+        return {
+            'samples': len(ordered),
+            'mean_ms': round(sum(ordered) / len(ordered) * 1000, 1),
+            'p95_ms': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 1),
+            'max_ms': round(ordered[-1] * 1000, 1),
+        }
@@ -0,0 +1,117 @@
+import os
+import base64
+import threading
+from io import BytesIO
+from collections import OrderedDict
+
+from PIL import Image
+
+# 编码后页面图片的共享存储：pdf_to_image 渲染时直接编码出请求所需的 JPEG（长边不超过 1500、质量 85），
+# 写入磁盘的同时登记其 data URL；qwen_vl_extract 与 determine_toc_levels 直接复用，
+# 不再各自解码 JPG、缩放、重新编码（既省 CPU，也避免二次有损压缩）。
+# 进程内模式下所有阶段共用内存中的 data URL；子进程模式或内存已淘汰时，
+# 符合要求的 JPEG 文件只读取字节做 base64，不再解码。
+REQUEST_IMAGE_MAX_DIMENSION = 1500
+REQUEST_JPEG_QUALITY = 85
+PAGE_STORE_MAX_BYTES = int(os.getenv('PAGE_STORE_MAX_BYTES', str(256 * 1024 * 1024)))
+
+
+def encode_request_jpeg(img: Image.Image) -> bytes:
+    """将 PIL 图片转换为请求使用的 JPEG 字节（必要时转 RGB 并等比缩小到长边 1500）"""
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    width, height = img.size
+    max_dim = max(width, height)
+    if max_dim > REQUEST_IMAGE_MAX_DIMENSION:
+        ratio = REQUEST_IMAGE_MAX_DIMENSION / max_dim
+        img = img.resize((int(width * ratio), int(height * ratio)), Image.LANCZOS)
+    buffer = BytesIO()
+    img.save(buffer, format="JPEG", quality=REQUEST_JPEG_QUALITY, optimize=True)
+    return buffer.getvalue()
+
+
+def to_data_url(jpeg_bytes: bytes) -> str:
+    return f"data:image/jpeg;base64,{base64.b64encode(jpeg_bytes).decode('utf-8')}"
+
+
+def is_request_ready(image_path) -> bool:
+    """文件已是长边不超过上限的 RGB JPEG 时可直接发送（只读取文件头，不解码像素）"""
+    try:
+        with Image.open(image_path) as img:
+            return (img.format == "JPEG" and img.mode == "RGB"
+                    and max(img.size) <= REQUEST_IMAGE_MAX_DIMENSION)
+    except OSError:
+        return False
+
+
+class EncodedPageStore:
+    """按 (路径, 大小, 修改时间) 缓存页面的 data URL，总大小超过上限时按 LRU 淘汰"""
+
+    def __init__(self, max_bytes=PAGE_STORE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        self._stats = {'hits': 0, 'passthrough': 0, 'reencoded': 0, 'registered': 0, 'evictions': 0}
+
+    @staticmethod
+    def _key(image_path):
+        path = os.path.abspath(image_path)
+        stat = os.stat(path)
+        return path, stat.st_size, stat.st_mtime_ns
+
+    def _put_locked(self, key, data_url):
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._total_bytes -= len(old)
+        self._entries[key] = data_url
+        self._total_bytes += len(data_url)
+        while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+            _, evicted = self._entries.popitem(last=False)
+            self._total_bytes -= len(evicted)
+            self._stats['evictions'] += 1
+
+    def write_jpeg(self, image_path, jpeg_bytes: bytes):
+        """原子写入请求用 JPEG 并登记（供 pdf_to_image 调用）"""
+        image_path = str(image_path)
+        tmp_path = f"{image_path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(jpeg_bytes)
+        os.replace(tmp_path, image_path)
+        with self._lock:
+            self._stats['registered'] += 1
+            self._put_locked(self._key(image_path), to_data_url(jpeg_bytes))
+
+    def get_data_url(self, image_path, cache=True) -> str:
+        """cache=False 时未命中的页面编码后不登记（供只使用一次的请求方使用，见 image_prefetch）"""
+        key = self._key(image_path)
+        with self._lock:
+            data_url = self._entries.get(key)
+            if data_url is not None:
+                self._entries.move_to_end(key)
+                self._stats['hits'] += 1
+                return data_url
+
+        if is_request_ready(image_path):
+            with open(image_path, 'rb') as f:
+                data_url = to_data_url(f.read())
+            stat_key = 'passthrough'
+        else:
+            with Image.open(image_path) as img:
+                data_url = to_data_url(encode_request_jpeg(img))
+            stat_key = 'reencoded'
+
+        with self._lock:
+            self._stats[stat_key] += 1
+            if cache:
+                self._put_locked(key, data_url)
+        return data_url
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({'entries': len(self._entries), 'total_bytes': self._total_bytes, 'max_bytes': self.max_bytes})
+            return stats
+
+
+page_store = EncodedPageStore()
@@ -0,0 +1,121 @@
+import os
+from dataclasses import dataclass, asdict
+
+import numpy as np
+
+from mainprogress.page_render_cache import render_cache
+from mainprogress.render_pool import worker_document, worker_render_cache
+
+# 目录检测前的页面预筛选：在低分辨率灰度图上用 NumPy 向量化统计墨迹覆盖率与行/列投影，
+# 空白页、整页图片（封面、插图）不再拼进滑动窗口发给模型；
+# 行尾带有右对齐数字列（"标题 …… 页码"）的页面疑似目录，所在窗口优先发出请求。
+# 每页统计写入 initial_data/page_prefilter.json，便于按语料调整阈值。
+PAGE_PREFILTER = os.getenv('PAGE_PREFILTER', '1') == '1'
+PREFILTER_LONG_EDGE = int(os.getenv('PREFILTER_LONG_EDGE', '800'))
+BLANK_INK_RATIO = float(os.getenv('PREFILTER_BLANK_INK_RATIO', '0.0005'))
+PICTURE_COVERAGE = float(os.getenv('PREFILTER_PICTURE_COVERAGE', '0.4'))
+PICTURE_MAX_TEXT_LINES = int(os.getenv('PREFILTER_PICTURE_MAX_TEXT_LINES', '5'))
+
+ROW_INK_MIN = 0.002      # 行内墨迹占比超过该值视为有墨迹的像素行
+MIN_LINE_HEIGHT = 3      # 文字行的最小像素高度，过滤噪点
+SEGMENT_GAP = 0.015      # 行内水平空白超过页宽的该比例即切分为不同片段（大于字间距）
+STROKE_MIN_HEIGHT = 0.3  # 列内墨迹高度不足行高该比例的列（引导点、下划线）不参与切分
+NUMBER_MAX_WIDTH = 0.06  # 行尾页码片段的最大宽度（页宽比例）
+ALIGN_TOLERANCE = 0.02   # 行尾右对齐的容差（页宽比例）
+
+SKIP_BLANK = 'blank'
+SKIP_PICTURE = 'picture'
+
+
+@dataclass
+class PageStats:
+    page: int
+    ink_ratio: float = 0.0        # 深色（文字）像素占比
+    tone_ratio: float = 0.0       # 中间调像素占比，与 ink_ratio 之和即非纸张覆盖率，整页图片明显偏高
+    text_lines: int = 0           # 行投影中的文字行数
+    number_lines: int = 0         # 以窄数字片段结尾且右对齐的行数
+    toc_score: float = 0.0        # number_lines / text_lines
+    skip: str = None              # 'blank' / 'picture' / None
+
+    def to_dict(self) -> dict:
+        data = asdict(self)
+        for key in ('ink_ratio', 'tone_ratio', 'toc_score'):
+            data[key] = round(data[key], 4)
+        return data
+
+
+def gray_array(pix) -> np.ndarray:
+    """灰度 Pixmap -> (高, 宽) uint8 数组"""
+    samples = np.frombuffer(pix.samples, dtype=np.uint8)
+    return samples.reshape(pix.height, pix.stride)[:, :pix.width * pix.n][:, ::pix.n]
+
+
+def find_runs(mask: np.ndarray):
+    """布尔序列中连续 True 的区间 [(起点, 终点)]（终点不含）"""
+    padded = np.concatenate(([False], mask, [False]))
+    edges = np.flatnonzero(padded[1:] != padded[:-1])
+    return list(zip(edges[::2], edges[1::2]))
+
+
+def analyze_gray(gray: np.ndarray, page: int) -> PageStats:
+    stats = PageStats(page=page)
+    height, width = gray.shape
+    if not height or not width:
+        stats.skip = SKIP_BLANK
+        return stats
+
+    # 以纸张亮度（90 分位）为基准定义阈值，灰底扫描件也能正确区分墨迹与背景
+    paper = max(float(np.percentile(gray, 90)), 64.0)
+    ink = gray < paper * 0.6
+    tone = (gray < paper - 30) & ~ink
+    stats.ink_ratio = float(ink.mean())
+    stats.tone_ratio = float(tone.mean())
+
+    lines = [(top, bottom) for top, bottom in find_runs(ink.mean(axis=1) > ROW_INK_MIN)
+             if bottom - top >= MIN_LINE_HEIGHT]
+    stats.text_lines = len(lines)
+
+    gap = max(2, int(width * SEGMENT_GAP))
+    right_edges = []
+    for top, bottom in lines:
+        # 只看笔画足够高的列：引导点只占基线附近一两个像素，去掉后标题与页码之间才会出现空白
+        column_heights = ink[top:bottom].sum(axis=0)
+        columns = np.flatnonzero(column_heights >= max(2, (bottom - top) * STROKE_MIN_HEIGHT))
+        if not len(columns):
+            continue
+        splits = np.flatnonzero(np.diff(columns) > gap)
+        last_start = columns[splits[-1] + 1] if len(splits) else columns[0]
+        # 行尾片段足够窄、且左侧还有标题内容时，视为"标题 …… 页码"行的页码
+        if columns[-1] - last_start <= width * NUMBER_MAX_WIDTH and last_start - columns[0] > width * 0.2:
+            right_edges.append(columns[-1])
+    if right_edges:
+        median_edge = np.median(right_edges)
+        stats.number_lines = int(np.sum(np.abs(np.array(right_edges) - median_edge) <= width * ALIGN_TOLERANCE))
+    if stats.text_lines:
+        stats.toc_score = stats.number_lines / stats.text_lines
+
+    if stats.ink_ratio < BLANK_INK_RATIO or stats.text_lines == 0:
+        stats.skip = SKIP_BLANK
+    elif (stats.ink_ratio + stats.tone_ratio > PICTURE_COVERAGE and stats.text_lines < PICTURE_MAX_TEXT_LINES
+          and stats.number_lines == 0):
+        stats.skip = SKIP_PICTURE
+    return stats
+
+
+def analyze_pages(doc, page_numbers, cache=render_cache) -> dict:
+    """按物理页码（从 1 开始）分析页面，返回 {页码: PageStats}；灰度渲染结果进入 cache（默认为共享渲染缓存）"""
+    results = {}
+    for page_num in page_numbers:
+        if not 1 <= page_num <= len(doc):
+            continue
+        pix = cache.render_long_edge(doc, page_num - 1, PREFILTER_LONG_EDGE, colorspace='gray')
+        if pix is None:
+            results[page_num] = PageStats(page=page_num, skip=SKIP_BLANK)
+            continue
+        results[page_num] = analyze_gray(gray_array(pix), page_num)
+    return results
+
+
+def analyze_pdf_pages(pdf_path, page_numbers) -> dict:
+    """渲染进程池中执行：用工作进程持有的 Document 分析页面"""
+    return analyze_pages(worker_document(pdf_path), page_numbers, worker_render_cache())
@@ -0,0 +1,187 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+import fitz  # PyMuPDF
+
+# 页面渲染缓存：pdf_metadata_extractor 的滑动窗口（宽 4 页、步长 2）会把大部分页面渲染两次，
+# 冲突页投票、偏移量采样和 pdf_to_image 又会各自重新渲染。这里按 (PDF, 页序号, 缩放比例, 色彩空间)
+# 缓存原始像素，同一 session 中每页在每种分辨率下只光栅化一次。
+# 进程内模式下所有阶段共用同一个缓存；超出内存上限时按 LRU 淘汰，
+# 开启 RENDER_CACHE_SPILL 后被淘汰的页面写入 PDF 同目录下的 render_cache/，子进程模式下后续阶段也能复用。
+RENDER_CACHE_MAX_BYTES = int(os.getenv('RENDER_CACHE_MAX_BYTES', str(512 * 1024 * 1024)))
+RENDER_CACHE_SPILL = os.getenv('RENDER_CACHE_SPILL', '0') == '1'
+# 渲染进程池中光栅化的页面以请求 JPEG 的形式交回主进程（见 render_pool.concat_pages），
+# 单独按该上限 LRU 淘汰，pdf_to_image 直接复用，不再重新光栅化
+RENDER_CACHE_ENCODED_MAX_BYTES = int(os.getenv('RENDER_CACHE_ENCODED_MAX_BYTES', str(64 * 1024 * 1024)))
+SPILL_DIRNAME = 'render_cache'
+
+COLORSPACES = {'rgb': fitz.csRGB, 'gray': fitz.csGRAY}
+
+
+def zoom_for_long_edge(page, target_long_edge):
+    """让页面长边等于 target_long_edge 的缩放比例；页面尺寸为 0 时返回 None"""
+    rect = page.rect
+    max_dim = max(rect.width, rect.height)
+    if max_dim == 0:
+        return None
+    return target_long_edge / max_dim
+
+
+class PageRenderCache:
+
+    def __init__(self, max_bytes=RENDER_CACHE_MAX_BYTES, spill=RENDER_CACHE_SPILL, encoded_max_bytes=RENDER_CACHE_ENCODED_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.spill = spill
+        self.encoded_max_bytes = encoded_max_bytes
+        self._lock = threading.Lock()
+        # key -> (width, height, n, samples)
+        self._entries = OrderedDict()
+        self._spill_dirs = {}
+        self._total_bytes = 0
+        # (pdf_key, 页序号, 缩放比例) -> (width, height, 请求 JPEG 字节)
+        self._encoded = OrderedDict()
+        self._encoded_bytes = 0
+        self._stats = {'hits': 0, 'misses': 0, 'spill_hits': 0, 'evictions': 0, 'spills': 0,
+                       'encoded_stored': 0, 'encoded_hits': 0}
+
+    @staticmethod
+    def _path_key(pdf_path):
+        path = os.path.abspath(pdf_path)
+        stat = os.stat(path)
+        return f"{path}|{stat.st_size}|{stat.st_mtime_ns}"
+
+    @classmethod
+    def _pdf_key(cls, doc):
+        return cls._path_key(doc.name)
+
+    @staticmethod
+    def _spill_path(spill_dir, key):
+        return os.path.join(spill_dir, hashlib.sha1(repr(key).encode('utf-8')).hexdigest() + '.raw')
+
+    def _spill_locked(self, key, entry):
+        spill_dir = self._spill_dirs.get(key[0])
+        if not spill_dir:
+            return
+        width, height, n, samples = entry
+        try:
+            path = self._spill_path(spill_dir, key)
+            if os.path.exists(path):
+                return
+            os.makedirs(spill_dir, exist_ok=True)
+            tmp_path = f"{path}.tmp{threading.get_ident()}"
+            with open(tmp_path, 'wb') as f:
+                f.write(f"{width} {height} {n}\n".encode('ascii'))
+                f.write(samples)
+            os.replace(tmp_path, path)
+            self._stats['spills'] += 1
+        except OSError:
+            pass
+
+    def _load_spilled(self, spill_dir, key):
+        try:
+            with open(self._spill_path(spill_dir, key), 'rb') as f:
+                width, height, n = (int(v) for v in f.readline().split())
+                samples = f.read()
+        except (OSError, ValueError):
+            return None
+        if len(samples) != width * height * n:
+            return None
+        return width, height, n, samples
+
+    def _put_locked(self, key, entry):
+        if key in self._entries:
+            return
+        self._entries[key] = entry
+        self._total_bytes += len(entry[3])
+        while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+            old_key, old_entry = self._entries.popitem(last=False)
+            self._total_bytes -= len(old_entry[3])
+            self._stats['evictions'] += 1
+            if self.spill:
+                self._spill_locked(old_key, old_entry)
+
+    def get_pixmap(self, doc, page_index, zoom, colorspace='rgb'):
+        """返回该页在指定缩放比例下的 Pixmap（不含 alpha），命中缓存时不再重新渲染"""
+        pdf_key = self._pdf_key(doc)
+        key = (pdf_key, page_index, round(zoom, 6), colorspace)
+        spill_dir = os.path.join(os.path.dirname(os.path.abspath(doc.name)), SPILL_DIRNAME)
+
+        with self._lock:
+            self._spill_dirs[pdf_key] = spill_dir
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self._stats['hits'] += 1
+
+        if entry is None and self.spill:
+            entry = self._load_spilled(spill_dir, key)
+            if entry is not None:
+                with self._lock:
+                    self._stats['spill_hits'] += 1
+                    self._put_locked(key, entry)
+
+        if entry is None:
+            pix = doc[page_index].get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=COLORSPACES[colorspace], alpha=False)
+            entry = (pix.width, pix.height, pix.n, bytes(pix.samples))
+            with self._lock:
+                self._stats['misses'] += 1
+                self._put_locked(key, entry)
+            return pix
+
+        width, height, _, samples = entry
+        return fitz.Pixmap(COLORSPACES[colorspace], width, height, samples, 0)
+
+    def contains(self, doc, page_index, zoom, colorspace='rgb') -> bool:
+        """该页是否已在缓存（内存或溢出文件）中，不触发渲染"""
+        pdf_key = self._pdf_key(doc)
+        key = (pdf_key, page_index, round(zoom, 6), colorspace)
+        with self._lock:
+            if key in self._entries:
+                return True
+        spill_dir = os.path.join(os.path.dirname(os.path.abspath(doc.name)), SPILL_DIRNAME)
+        return self.spill and os.path.exists(self._spill_path(spill_dir, key))
+
+    def render_long_edge(self, doc, page_index, target_long_edge, colorspace='rgb'):
+        """按目标长边像素渲染；页面尺寸为 0 时返回 None"""
+        zoom = zoom_for_long_edge(doc[page_index], target_long_edge)
+        if zoom is None:
+            return None
+        return self.get_pixmap(doc, page_index, zoom, colorspace)
+
+    def put_encoded(self, pdf_path, page_index, zoom, width, height, jpeg_bytes):
+        """登记在其他进程中渲染并编码好的请求 JPEG"""
+        key = (self._path_key(pdf_path), page_index, round(zoom, 6))
+        with self._lock:
+            old = self._encoded.pop(key, None)
+            if old is not None:
+                self._encoded_bytes -= len(old[2])
+            self._encoded[key] = (width, height, jpeg_bytes)
+            self._encoded_bytes += len(jpeg_bytes)
+            self._stats['encoded_stored'] += 1
+            while self._encoded_bytes > self.encoded_max_bytes and len(self._encoded) > 1:
+                _, (_, _, old_bytes) = self._encoded.popitem(last=False)
+                self._encoded_bytes -= len(old_bytes)
+
+    def get_encoded(self, doc, page_index, zoom):
+        """返回 (width, height, 请求 JPEG 字节)，未登记时返回 None"""
+        key = (self._pdf_key(doc), page_index, round(zoom, 6))
+        with self._lock:
+            entry = self._encoded.get(key)
+            if entry is not None:
+                self._encoded.move_to_end(key)
+                self._stats['encoded_hits'] += 1
+            return entry
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({'entries': len(self._entries), 'total_bytes': self._total_bytes,
+                          'max_bytes': self.max_bytes, 'spill': self.spill,
+                          'encoded_entries': len(self._encoded), 'encoded_bytes': self._encoded_bytes,
+                          'encoded_max_bytes': self.encoded_max_bytes})
+            return stats
+
+
+render_cache = PageRenderCache()
@@ -0,0 +1,106 @@
+import os
+import re
+import json
+
+import fitz  # PyMuPDF
+
+from mainprogress.stage_manifest import atomic_write_json
+
+# 已有结构快速通道：在任何 LLM 调用之前检查 PDF 自带的书签（大纲）与 /PageLabels。
+# - 已有可用书签：直接生成 level_adjusted_content/*_final.json，由 app.prepare_job 跳到 pdf_generator；
+# - 存在阿拉伯数字页码标签：直接换算出正文偏移量 content_start，替代 calculate_offset 的多次 LLM 采样。
+# 触发的快速通道记录在 input_pdf 下信息 JSON 的 fast_paths 字段中。
+OUTLINE_FAST_PATH = os.getenv('OUTLINE_FAST_PATH', '1') == '1'
+OUTLINE_MIN_ENTRIES = int(os.getenv('OUTLINE_MIN_ENTRIES', '3'))
+PAGE_LABEL_MIN_COVERAGE = 0.5  # 阿拉伯数字页码区段至少覆盖全书的比例
+
+FAST_PATH_OUTLINE = 'outline'
+FAST_PATH_PAGE_LABELS = 'page_labels'
+FAST_PATH_TEXT_LAYER = 'text_layer_toc'
+
+
+def read_outline(doc) -> list:
+    """读取书签为 [{'text', 'number'(物理页码), 'level'}]；条目过少或多数页码无效时返回 None"""
+    toc = doc.get_toc(simple=True)
+    entries = [{'text': title.strip(), 'number': page, 'level': level}
+               for level, title, page in toc if title and title.strip() and 1 <= page <= len(doc)]
+    if len(entries) < OUTLINE_MIN_ENTRIES or len(entries) < len(toc) * 0.8:
+        return None
+    return entries
+
+
+def offset_from_page_labels(doc):
+    """
+    按 /PageLabels 换算正文偏移量（物理页码 - 印刷页码），与 calculate_offset 的定义一致。
+    取覆盖页数最多的阿拉伯数字（无前缀）区段；该区段覆盖不足全书一半时返回 None。
+    """
+    rules = sorted(doc.get_page_labels(), key=lambda r: r.get('startpage', 0))
+    total_pages = len(doc)
+    best = None
+    for i, rule in enumerate(rules):
+        if rule.get('style') != 'D' or rule.get('prefix'):
+            continue
+        start = rule.get('startpage', 0)
+        end = rules[i + 1]['startpage'] if i + 1 < len(rules) else total_pages
+        if best is None or end - start > best[1] - best[0]:
+            best = (start, end, rule.get('firstpagenum', 1))
+    if best is None or (best[1] - best[0]) < total_pages * PAGE_LABEL_MIN_COVERAGE:
+        return None
+    start, _, first_number = best
+    return start + 1 - first_number
+
+
+def find_pdf_and_info(base_dir):
+    """返回 session 中唯一的 PDF 与信息 JSON 路径"""
+    input_dir = os.path.join(base_dir, 'input_pdf')
+    pdf_files = [f for f in os.listdir(input_dir) if f.lower().endswith('.pdf')]
+    if len(pdf_files) != 1:
+        return None, None
+    pdf_path = os.path.join(input_dir, pdf_files[0])
+    info_path = os.path.splitext(pdf_path)[0] + '.json'
+    return pdf_path, (info_path if os.path.exists(info_path) else None)
+
+
+def record_fast_path(info_data: dict, name: str):
+    fast_paths = info_data.setdefault('fast_paths', [])
+    if name not in fast_paths:
+        fast_paths.append(name)
+
+
+def apply_outline_fast_path(base_dir) -> int:
+    """
+    PDF 已有可用书签时写出 pdf_generator 所需的 *_final.json 与信息 JSON，返回书签条目数；否则返回 0。
+    pdf_generator 按 印刷页码 + content_start 计算物理页，这里令 content_start 为 0、number 取物理页码。
+    """
+    if not OUTLINE_FAST_PATH:
+        return 0
+    pdf_path, info_path = find_pdf_and_info(base_dir)
+    if not pdf_path or not info_path:
+        return 0
+    with fitz.open(pdf_path) as doc:
+        entries = read_outline(doc)
+        title = (doc.metadata or {}).get('title', '').strip()
+    if not entries:
+        return 0
+
+    with open(info_path, 'r', encoding='utf-8') as f:
+        info_data = json.load(f)
+    # pdf_generator 会在 toc_start 处插入"目录"书签；原书签中已有"目录"时保留其位置
+    toc_entry = next((item for item in entries if item['text'] == '目录'), None)
+    info_data['toc_start'] = toc_entry['number'] if toc_entry else 0
+    info_data['toc_end'] = info_data['toc_start']
+    info_data['content_start'] = 0
+    if not info_data.get('book_name'):
+        fallback = os.path.splitext(info_data.get('original_filename') or os.path.basename(pdf_path))[0]
+        info_data['book_name'] = re.sub(r'[\\/:*?"<>|]', '_', title or fallback)
+    record_fast_path(info_data, FAST_PATH_OUTLINE)
+
+    output_dir = os.path.join(base_dir, 'level_adjusted_content')
+    os.makedirs(output_dir, exist_ok=True)
+    for name in os.listdir(output_dir):
+        if name.endswith('_final.json'):
+            os.remove(os.path.join(output_dir, name))
+    stem = os.path.splitext(os.path.basename(pdf_path))[0]
+    atomic_write_json(os.path.join(output_dir, f"{stem}_final.json"), entries)
+    atomic_write_json(info_path, info_data, indent=4)
+    return len(entries)
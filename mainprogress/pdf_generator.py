@@ -9,20 +9,14 @@ import pikepdf
 import dotenv
 dotenv.load_dotenv()
 
-def process_pdf_with_bookmarks():
+def process_pdf_with_bookmarks(input_dir_1, input_dir_2, output_dir):
+    """
+    input_dir_1: 存放 *_final.json 的目录
+    input_dir_2: 存放原始 PDF 及其 info JSON 的目录
+    output_dir: 输出带书签 PDF 的目录
+    """
     # 确保输出目录存在
-    output_dir = os.getenv('PDF_GENERATOR_OUTPUT_1')
-    if not output_dir:
-        print("错误：未设置环境变量 PDF_GENERATOR_OUTPUT_1")
-        return
     os.makedirs(output_dir, exist_ok=True)
-    
-    input_dir_1 = os.getenv('PDF_GENERATOR_INPUT_1')
-    input_dir_2 = os.getenv('PDF_GENERATOR_INPUT_2')
-    
-    if not input_dir_1 or not input_dir_2:
-        print("错误：未设置环境变量 PDF_GENERATOR_INPUT_1 或 PDF_GENERATOR_INPUT_2")
-        return
 
     # 直接查找 PDF_GENERATOR_INPUT_1 下唯一的_final.json 文件
     try:
@@ -86,13 +80,14 @@ def process_pdf_with_bookmarks():
             if 'number' in item and isinstance(item['number'], (int, float)):
                 item['number'] = item['number'] + 1
         
-        # 添加硬编码的"目录"条目，作为第一个 L1 标题
-        toc_entry = {
-            'text': '目录',
-            'number': toc_start,
-            'level': 1
-        }
-        toc_data.insert(0, toc_entry)
+        # 添加硬编码的"目录"条目，作为第一个 L1 标题（沿用原书签时可能没有目录页，toc_start 为 0）
+        if toc_start and toc_start >= 1:
+            toc_entry = {
+                'text': '目录',
+                'number': toc_start,
+                'level': 1
+            }
+            toc_data.insert(0, toc_entry)
         
         # 验证并调整页码，收集有效条目（保留所有有效项，不再删除孤立标题）
         valid_items = []
@@ -216,5 +211,24 @@ def process_pdf_with_bookmarks():
         import traceback
         print(traceback.format_exc())
 
+def run_stage(content_dir, pdf_dir, output_dir):
+    """阶段入口：供 app.py 在常驻进程内直接调用"""
+    process_pdf_with_bookmarks(content_dir, pdf_dir, output_dir)
+
+def main():
+    output_dir = os.getenv('PDF_GENERATOR_OUTPUT_1')
+    if not output_dir:
+        print("错误：未设置环境变量 PDF_GENERATOR_OUTPUT_1")
+        return
+
+    input_dir_1 = os.getenv('PDF_GENERATOR_INPUT_1')
+    input_dir_2 = os.getenv('PDF_GENERATOR_INPUT_2')
+
+    if not input_dir_1 or not input_dir_2:
+        print("错误：未设置环境变量 PDF_GENERATOR_INPUT_1 或 PDF_GENERATOR_INPUT_2")
+        return
+
+    run_stage(input_dir_1, input_dir_2, output_dir)
+
 if __name__ == '__main__':
-    process_pdf_with_bookmarks()
\ No newline at end of file
+    main()
\ No newline at end of file
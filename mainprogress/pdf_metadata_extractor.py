@@ -1,18 +1,16 @@
 import os
 import sys
-import io
 import json
-import base64
 import re
 import random
 import asyncio
 import logging
+import time
 import threading
 import traceback
 from collections import Counter
 from pathlib import Path
 import fitz  # PyMuPDF
-from PIL import Image, ImageDraw, ImageFont
 from openai import AsyncOpenAI
 import dotenv
 
@@ -23,6 +21,24 @@ SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
 sys.path.append(PROJECT_ROOT)
 
+from mainprogress.stage_context import StageError, run_async, resolve_config_value
+from mainprogress.llm_scheduler import chat_completion
+from mainprogress.stage_manifest import atomic_write_json
+from mainprogress.render_pool import run_in_pool, concat_pages, render_page_b64
+from mainprogress.loop_lag import LoopLagMonitor
+from mainprogress.artifact_sink import ArtifactSink
+from mainprogress import text_layer, pdf_fast_path, page_prefilter, llm_routes
+
+# 单个 session 同时处理的目录窗口与偏移量采样数上限；LLM 请求的全局并发由 llm_scheduler 统一控制
+SESSION_CONCURRENT_LIMIT = 8
+OFFSET_SAMPLE_SIZE = 5  # 每轮偏移量采样页数
+OFFSET_CONSENSUS = 4  # 达到该数量的一致样本即停止采样
+# 目录范围搜索策略：adaptive 先用互不重叠的 4 页窗口定位目录，只在与窗口边缘重合的目录首尾补做单页投票，
+# 识别到目录结束后取消其后仍在进行的窗口；sliding 为原有的宽 4 页、步长 2 滑动窗口（每页判定两次）
+TOC_SEARCH_MODE = os.getenv('TOC_SEARCH_MODE', 'adaptive')
+TOC_WINDOW_SIZE = 4
+TOC_SCAN_MAX_PAGE = 60
+
 def write_log(message):
     """写入日志到项目根目录的 log.txt"""
     try:
@@ -43,81 +59,8 @@ def get_api_key(raw_key: str) -> str:
         return os.environ.get(env_var_name, "")
     return raw_key
 
-def create_concat_image_b64(doc: fitz.Document, start_p: int, end_p: int, save_path: str = None) -> str:
-    """将指定范围的 PDF 页面转换为横向拼接的 JPG，并在底部追加页码。"""
-    images = []
-    page_nums = []
-    
-    # 定义目标长边像素，确保小页面也能被放大到清晰程度
-    TARGET_LONG_EDGE = 1500
-    
-    for p in range(start_p - 1, end_p):
-        if p >= len(doc): 
-            break
-        page = doc[p]
-        rect = page.rect
-        max_dim = max(rect.width, rect.height)
-        
-        # 修正逻辑：始终计算缩放比例，不再判断是否大于目标值
-        # 如果 max_dim 为 0，跳过该页以防出错
-        if max_dim == 0:
-            continue
-            
-        zoom = TARGET_LONG_EDGE / max_dim
-        mat = fitz.Matrix(zoom, zoom)
-        pix = page.get_pixmap(matrix=mat)
-        
-        img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-        images.append(img)
-        page_nums.append(p + 1)
-
-    if not images:
-        return None
-
-    max_h = max(img.height for img in images)
-    total_w = sum(img.width for img in images)
-    new_h = int(max_h * 1.2)
-
-    combined = Image.new("RGB", (total_w, new_h), "white")
-    draw = ImageDraw.Draw(combined)
-
-    try:
-        font_size = max(40, int(max_h * 0.05))
-        font = ImageFont.load_default(size=font_size)
-    except TypeError:
-        font = ImageFont.load_default()
-
-    current_x = 0
-    for img, p_num in zip(images, page_nums):
-        combined.paste(img, (current_x, 0))
-        text = f"PDFNumber {p_num}"
-        
-        if hasattr(font, 'getbbox'):
-            bbox = font.getbbox(text)
-            text_w = bbox[2] - bbox[0]
-            text_h = bbox[3] - bbox[1]
-        else:
-            bbox = draw.textbbox((0, 0), text, font=font)
-            text_w = bbox[2] - bbox[0]
-            text_h = bbox[3] - bbox[1]
-
-        text_x = current_x + (img.width - text_w) // 2
-        text_y = max_h + (new_h - max_h) // 2 - text_h // 2
-        
-        draw.text((text_x, text_y), text, fill="black", font=font)
-        current_x += img.width
-
-    if save_path:
-        combined.save(save_path, format="JPEG", quality=85)
-        logger.debug(f"拼接图片已保存至：{save_path}")
-        write_log(f"拼接图片已保存至：{save_path}")
-
-    buffered = io.BytesIO()
-    combined.save(buffered, format="JPEG", quality=85)
-    return base64.b64encode(buffered.getvalue()).decode('utf-8')
-
-async def fetch_toc_from_image(client: AsyncOpenAI, model: str, b64_img: str, start_p: int, end_p: int, raw_save_path: str = None) -> str:
-    """调用 LLM 识别拼接图片中的目录范围，并保存原始响应"""
+async def fetch_toc_from_image(client: AsyncOpenAI, model: str, b64_img: str, start_p: int, end_p: int, artifacts: ArtifactSink = None) -> str:
+    """调用 LLM 识别拼接图片中的目录范围，并记录原始响应"""
     prompt = f"""这是一张由几个连续的 PDF 页面横向拼接而成的图片。每张图片下方标注了它的物理页码（例如 PDFNumber {start_p}）。
 请找出这几页中，属于目录的起始页码和结束页码。
 
@@ -134,7 +77,7 @@ async def fetch_toc_from_image(client: AsyncOpenAI, model: str, b64_img: str, st
 3. 如果这几页中没有任何一页是目录，输出格式为：{{"toc_start": null, "toc_end": null}}"""
 
     try:
-        completion = await client.chat.completions.create(
+        completion = await chat_completion(client,
             model=model,
             messages=[
                 {
@@ -148,30 +91,32 @@ async def fetch_toc_from_image(client: AsyncOpenAI, model: str, b64_img: str, st
             ],
             extra_body={"enable_thinking": False},
             temperature=0,
+            cache_validate=is_json_response,
         )
         raw_content = completion.choices[0].message.content.strip()
         
-        if raw_save_path:
-            response_data = {
-                "page_range": f"{start_p}-{end_p}",
-                "raw_response": raw_content,
-                "model": model
-            }
-            with open(raw_save_path, 'w', encoding='utf-8') as f:
-                json.dump(response_data, f, ensure_ascii=False, indent=2)
-            logger.debug(f"原始响应已保存至：{raw_save_path}")
-            write_log(f"原始响应已保存至：{raw_save_path}")
+        if artifacts:
+            artifacts.record("toc_response", page_range=f"{start_p}-{end_p}", raw_response=raw_content, model=model)
             
         return raw_content
     except Exception as e:
         error_msg = f"获取目录范围失败 ({start_p}-{end_p}): {e}"
         logger.error(error_msg)
         write_log(error_msg)
-        if raw_save_path:
-            with open(raw_save_path, 'w', encoding='utf-8') as f:
-                json.dump({"error": str(e), "page_range": f"{start_p}-{end_p}"}, f, ensure_ascii=False, indent=2)
+        if artifacts:
+            artifacts.record("toc_response", page_range=f"{start_p}-{end_p}", error=str(e), model=model)
         return ""
 
+def is_json_response(text: str) -> bool:
+    """响应剥离 Markdown 标记后是否为合法 JSON（用于决定是否写入响应缓存）"""
+    try:
+        clean_text = re.sub(r'^```(?:json)?\s*', '', text.strip(), flags=re.MULTILINE)
+        clean_text = re.sub(r'\s*```$', '', clean_text, flags=re.MULTILINE)
+        json.loads(clean_text)
+        return True
+    except ValueError:
+        return False
+
 def parse_toc_json(text: str) -> tuple:
     """安全解析 LLM 输出的 JSON，剥离 Markdown 标记"""
     if not text:
@@ -229,66 +174,120 @@ def merge_continuous_ranges(page_list: list) -> tuple:
         
     return best_start, best_end
 
-async def extract_toc_info(pdf_path: str, client: AsyncOpenAI, model: str, initial_data_dir: str) -> tuple:
-    """使用滑动窗口提取目录，并对冲突页进行单页投票"""
-    doc = fitz.open(pdf_path)
-    total_pages = len(doc)
+def detect_toc_from_text_layer(pdf_path: str, artifacts: ArtifactSink) -> tuple:
+    """PDF 自带可信的 OCR 文字层时直接在本地定位目录页范围，否则返回 (None, None)"""
+    if not text_layer.enabled():
+        return None, None
+    try:
+        report = text_layer.detect_toc_range(pdf_path)
+    except Exception as e:
+        write_log(f"文字层目录检测失败，改用视觉模型：{e}")
+        return None, None
+
+    artifacts.write_json("text_layer_toc.json", report)
+    if not report["confident"]:
+        if report["toc_start"] is not None:
+            write_log(f"文字层疑似目录页 {report['toc_start']}-{report['toc_end']} 置信度不足，改用视觉模型")
+        return None, None
+
+    info_msg = f"文字层识别到目录页：{report['toc_start']}-{report['toc_end']}，跳过视觉模型滑动窗口"
+    print(f"[INFO] {info_msg}")
+    write_log(info_msg)
+    return report["toc_start"], report["toc_end"]
+
+async def extract_toc_info(pdf_path: str, client: AsyncOpenAI, model: str, artifacts: ArtifactSink, semaphore: asyncio.Semaphore = None) -> tuple:
+    """按 TOC_SEARCH_MODE 定位目录页范围，并对冲突页（自适应模式下还包括边界页）进行单页投票"""
+    with fitz.open(pdf_path) as doc:
+        total_pages = len(doc)
+    started = time.perf_counter()
     
-    write_log(f"开始提取目录信息，总页数：{total_pages}")
+    write_log(f"开始提取目录信息，总页数：{total_pages}，搜索策略：{TOC_SEARCH_MODE}")
     
-    # 控制并发度为 8
-    semaphore = asyncio.Semaphore(8)
+    semaphore = semaphore or asyncio.Semaphore(SESSION_CONCURRENT_LIMIT)
     # 记录每一页被判定为目录和非目录的次数
     page_votes = {i: {"is_toc": 0, "not_toc": 0} for i in range(1, total_pages + 1)}
+    # 预筛选结果：空白页与整页图片不拼入窗口，疑似目录页所在窗口优先发出
+    page_stats = {}
+    # 每个送检页面的窗口判定：页码 -> (所在窗口的页面列表, 是否目录)，仅记录模型返回了合法 JSON 的窗口
+    window_verdicts = {}
+    search_stats = {"mode": TOC_SEARCH_MODE, "window_calls": 0, "single_calls": 0, "cancelled_windows": 0}
+
+    async def prefilter(page_numbers):
+        pending = [p for p in page_numbers if p not in page_stats]
+        if not page_prefilter.PAGE_PREFILTER or not pending:
+            return
+        page_stats.update(await run_in_pool(page_prefilter.analyze_pdf_pages, pdf_path, pending))
+        for p in pending:
+            stats = page_stats.get(p)
+            if stats and stats.skip:
+                write_log(f"预筛选跳过第 {p} 页（{stats.skip}）：墨迹 {stats.ink_ratio:.4f}，中间调 {stats.tone_ratio:.4f}，文字行 {stats.text_lines}")
+
+    def window_pages(start_p, end_p):
+        return [p for p in range(start_p, end_p + 1) if not (p in page_stats and page_stats[p].skip)]
+
+    def window_priority(pages):
+        return max((page_stats[p].toc_score for p in pages if p in page_stats), default=0)
+
+    def is_skipped(p):
+        return p in page_stats and page_stats[p].skip is not None
     
-    async def process_window(start_p, end_p):
+    async def process_window(start_p, end_p, pages):
         async with semaphore:
             img_filename = f"concat_pages_{start_p}_{end_p}.jpg"
-            img_save_path = os.path.join(initial_data_dir, img_filename)
-            raw_filename = f"toc_response_{start_p}_{end_p}.json"
-            raw_save_path = os.path.join(initial_data_dir, raw_filename)
             
-            b64_img = create_concat_image_b64(doc, start_p, end_p, save_path=img_save_path)
+            # 图片仅在 full 级别由渲染进程直接写出
+            b64_img = await concat_pages(pdf_path, pages or list(range(start_p, end_p + 1)),
+                                         artifacts.image_path(img_filename))
             if not b64_img:
-                return start_p, end_p, None, None, None
+                return start_p, end_p, pages, None, None, None
                 
-            raw_res = await fetch_toc_from_image(client, model, b64_img, start_p, end_p, raw_save_path)
+            search_stats["window_calls"] += 1
+            raw_res = await fetch_toc_from_image(client, model, b64_img, start_p, end_p, artifacts)
             toc_start, toc_end = parse_toc_json(raw_res)
             
-            detail_filename = f"toc_detail_{start_p}_{end_p}.json"
-            detail_save_path = os.path.join(initial_data_dir, detail_filename)
-            detail_data = {
-                "page_range": f"{start_p}-{end_p}",
-                "parsed_result": {"toc_start": toc_start, "toc_end": toc_end},
-                "raw_response": raw_res,
-                "image_saved_as": img_filename
-            }
-            with open(detail_save_path, 'w', encoding='utf-8') as f:
-                json.dump(detail_data, f, ensure_ascii=False, indent=2)
+            artifacts.record("toc_window", page_range=f"{start_p}-{end_p}", pages=pages,
+                             parsed_result={"toc_start": toc_start, "toc_end": toc_end},
+                             image_saved_as=img_filename if artifacts.image_path(img_filename) else None)
                 
-            return start_p, end_p, toc_start, toc_end, raw_res
+            return start_p, end_p, pages, toc_start, toc_end, raw_res
+
+    def apply_window_result(result):
+        """被预筛选排除的页面不参与投票"""
+        _, _, pages, t_start, t_end, raw_res = result
+        if raw_res and is_json_response(raw_res):
+            for p in pages:
+                window_verdicts[p] = (pages, t_start is not None and t_start <= p <= t_end)
+        if t_start is None:
+            return
+        for p in pages:
+            if t_start <= p <= t_end:
+                page_votes[p]["is_toc"] += 1
+            else:
+                page_votes[p]["not_toc"] += 1
 
     async def run_batch(start_page, end_page_limit):
         """执行一个批次的滑动窗口扫描"""
         windows = []
-        for i in range(start_page, end_page_limit, 2):
-            if i > total_pages:
-                break
-            windows.append((i, min(i + 3, total_pages)))
+        skipped_windows = 0
+        ranges = [(i, min(i + 3, total_pages)) for i in range(start_page, min(end_page_limit, total_pages + 1), 2)]
+        if ranges:
+            await prefilter(range(ranges[0][0], ranges[-1][1] + 1))
+        for i, end_p in ranges:
+            pages = window_pages(i, end_p)
+            if not pages:
+                skipped_windows += 1
+                continue
+            windows.append((i, end_p, pages))
+        if skipped_windows:
+            write_log(f"预筛选：{skipped_windows} 个窗口全部为空白页或图片页，未发送请求")
             
         if not windows:
             return
+        windows.sort(key=lambda w: window_priority(w[2]), reverse=True)
             
-        tasks = [process_window(s, e) for s, e in windows]
-        results = await asyncio.gather(*tasks)
-        
-        for s, e, t_start, t_end, _ in results:
-            if t_start is None: continue
-            for p in range(s, e + 1):
-                if t_start <= p <= t_end:
-                    page_votes[p]["is_toc"] += 1
-                else:
-                    page_votes[p]["not_toc"] += 1
+        tasks = [process_window(s, e, pages) for s, e, pages in windows]
+        for result in await asyncio.gather(*tasks):
+            apply_window_result(result)
 
     def has_toc_in_range(votes_dict, start_p, end_p):
         """检查指定范围内是否有被投票为目录的页"""
@@ -297,84 +296,199 @@ async def extract_toc_info(pdf_path: str, client: AsyncOpenAI, model: str, initi
                 return True
         return False
 
-    # 动态扫描与拓展逻辑
-    current_limit = min(20, total_pages)
-    last_scanned = 0
-    retry_count = 0
-    max_retries = 2
-    toc_found = False
+    async def sliding_scan():
+        """原有策略：宽 4 页、步长 2 的滑动窗口，每页由相邻两个窗口各判定一次"""
+        current_limit = min(20, total_pages)
+        last_scanned = 0
+        retry_count = 0
+        max_retries = 2
+        toc_found = False
 
-    info_msg = f"正在分析目录范围：第 1 到 {current_limit} 页 (滑动窗口)"
-    print(f"[INFO] {info_msg}")
-    write_log(info_msg)
+        info_msg = f"正在分析目录范围：第 1 到 {current_limit} 页 (滑动窗口)"
+        print(f"[INFO] {info_msg}")
+        write_log(info_msg)
 
-    while current_limit < 100 and current_limit < total_pages:
-        # 执行当前批次的扫描
-        await run_batch(last_scanned + 1, current_limit + 1)
-        last_scanned = current_limit
-
-        if not toc_found:
-            # 尚未发现目录，检查当前已扫描范围
-            if has_toc_in_range(page_votes, 1, current_limit):
-                toc_found = True
-                info_msg = f"在第 1-{current_limit} 页范围内发现目录，开始边界拓展检测"
-                print(f"[INFO] {info_msg}")
-                write_log(info_msg)
-            else:
-                # 未发现目录，触发向后搜索机制
-                if retry_count < max_retries:
-                    retry_count += 1
+        while current_limit < 100 and current_limit < total_pages:
+            # 执行当前批次的扫描
+            await run_batch(last_scanned + 1, current_limit + 1)
+            last_scanned = current_limit
+
+            if not toc_found:
+                # 尚未发现目录，检查当前已扫描范围
+                if has_toc_in_range(page_votes, 1, current_limit):
+                    toc_found = True
+                    info_msg = f"在第 1-{current_limit} 页范围内发现目录，开始边界拓展检测"
+                    print(f"[INFO] {info_msg}")
+                    write_log(info_msg)
+                else:
+                    # 未发现目录，触发向后搜索机制
+                    if retry_count < max_retries:
+                        retry_count += 1
+                        next_limit = min(current_limit + 10, 60)
+                        info_msg = f"前 {current_limit} 页未找到目录，尝试向后搜索至第 {next_limit} 页 (尝试 {retry_count}/{max_retries})"
+                        print(f"[INFO] {info_msg}")
+                        write_log(info_msg)
+                        current_limit = next_limit
+                        continue
+                    else:
+                        break # 重试耗尽，停止搜索
+
+            # 已发现目录，检查当前边界页是否仍为目录
+            if toc_found:
+                if page_votes.get(current_limit, {}).get("is_toc", 0) > 0:
+                    # 边界页是目录，继续向后拓展
                     next_limit = min(current_limit + 10, 60)
-                    info_msg = f"前 {current_limit} 页未找到目录，尝试向后搜索至第 {next_limit} 页 (尝试 {retry_count}/{max_retries})"
+                    if next_limit <= current_limit:
+                        break
+                    info_msg = f"第 {current_limit} 页确认为目录，拓展扫描范围至第 {next_limit} 页"
                     print(f"[INFO] {info_msg}")
                     write_log(info_msg)
                     current_limit = next_limit
                     continue
                 else:
-                    break # 重试耗尽，停止搜索
-
-        # 已发现目录，检查当前边界页是否仍为目录
-        if toc_found:
-            if page_votes.get(current_limit, {}).get("is_toc", 0) > 0:
-                # 边界页是目录，继续向后拓展
-                next_limit = min(current_limit + 10, 60)
-                if next_limit <= current_limit:
+                    # 边界页不是目录，说明目录已结束
                     break
-                info_msg = f"第 {current_limit} 页确认为目录，拓展扫描范围至第 {next_limit} 页"
-                print(f"[INFO] {info_msg}")
-                write_log(info_msg)
-                current_limit = next_limit
+
+    def detected_toc_end(pending_starts):
+        """
+        按 merge_continuous_ranges 取当前最长的连续目录区间；其后的下一个送检页已被判定为非目录，
+        且起始页在区间之前的窗口都已返回（它们仍可能给出更长的区间）时，返回区间末页。
+        """
+        toc_start, toc_end = merge_continuous_ranges([p for p, (_, is_toc) in window_verdicts.items() if is_toc])
+        if toc_start is None or any(start < toc_start for start in pending_starts):
+            return None
+        following = next((p for p in range(toc_end + 1, total_pages + 1) if not is_skipped(p)), None)
+        if following in window_verdicts and not window_verdicts[following][1]:
+            return toc_end
+        return None
+
+    async def scan_block(start_page, end_page):
+        """
+        以互不重叠的窗口扫描 [start_page, end_page]，确认目录结束后取消其后仍未完成的窗口；
+        预筛选评分为正（疑似目录页）的窗口不取消，照常参与最长区间的比较
+        """
+        windows = []
+        skipped_windows = 0
+        await prefilter(range(start_page, end_page + 1))
+        for i in range(start_page, end_page + 1, TOC_WINDOW_SIZE):
+            end_p = min(i + TOC_WINDOW_SIZE - 1, end_page)
+            pages = window_pages(i, end_p)
+            if not pages:
+                skipped_windows += 1
                 continue
-            else:
-                # 边界页不是目录，说明目录已结束
+            windows.append((i, end_p, pages))
+        if skipped_windows:
+            write_log(f"预筛选：{skipped_windows} 个窗口全部为空白页或图片页，未发送请求")
+        windows.sort(key=lambda w: window_priority(w[2]), reverse=True)
+
+        tasks = {asyncio.create_task(process_window(s, e, pages)): (s, pages) for s, e, pages in windows}
+        pending = set(tasks)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    apply_window_result(task.result())
+                toc_end = detected_toc_end([tasks[task][0] for task in pending])
+                if toc_end is None:
+                    continue
+                late = {task for task in pending if tasks[task][0] > toc_end and window_priority(tasks[task][1]) <= 0}
+                for task in late:
+                    task.cancel()
+                if late:
+                    search_stats["cancelled_windows"] += len(late)
+                    write_log(f"目录在第 {toc_end} 页结束，取消其后 {len(late)} 个窗口：{sorted(tasks[t][0] for t in late)}")
+                    await asyncio.gather(*late, return_exceptions=True)
+                pending -= late
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def adaptive_scan():
+        """先用不重叠窗口定位目录（每页只判定一次），目录延伸到本批次末尾时再向后拓展"""
+        scan_limit = min(TOC_SCAN_MAX_PAGE, total_pages)
+        current_limit = min(20, scan_limit)
+        last_scanned = 0
+        retry_count = 0
+        max_retries = 2
+
+        info_msg = f"正在分析目录范围：第 1 到 {current_limit} 页 (自适应搜索)"
+        print(f"[INFO] {info_msg}")
+        write_log(info_msg)
+
+        while True:
+            await scan_block(last_scanned + 1, current_limit)
+            last_scanned = current_limit
+            if current_limit >= scan_limit:
+                break
+
+            toc_pages = [p for p, votes in page_votes.items() if votes["is_toc"] > 0]
+            _, run_end = merge_continuous_ranges(toc_pages)
+            if not toc_pages:
+                if retry_count >= max_retries:
+                    break
+                retry_count += 1
+                next_limit = min(current_limit + 10, scan_limit)
+                info_msg = f"前 {current_limit} 页未找到目录，尝试向后搜索至第 {next_limit} 页 (尝试 {retry_count}/{max_retries})"
+            elif any(not is_skipped(p) for p in range(run_end + 1, current_limit + 1)):
                 break
+            else:
+                next_limit = min(current_limit + 10, scan_limit)
+                info_msg = f"目录延伸到第 {current_limit} 页，拓展扫描范围至第 {next_limit} 页"
+            print(f"[INFO] {info_msg}")
+            write_log(info_msg)
+            current_limit = next_limit
+
+    def boundary_pages():
+        """
+        目录首（尾）页恰好是窗口的第一（最后）页时，模型没有在同一张图中看到它与相邻页的过渡，
+        对该页及窗口外侧的相邻送检页补做单页投票；边界落在窗口内部时直接采信窗口判定。
+        """
+        toc_start, toc_end = merge_continuous_ranges([p for p, (_, is_toc) in window_verdicts.items() if is_toc])
+        if toc_start is None:
+            return []
+        pages = set()
+        before = next((p for p in range(toc_start - 1, 0, -1) if not is_skipped(p)), None)
+        if before in window_verdicts and before not in window_verdicts[toc_start][0]:
+            pages.update((before, toc_start))
+        after = next((p for p in range(toc_end + 1, total_pages + 1) if not is_skipped(p)), None)
+        if after in window_verdicts and after not in window_verdicts[toc_end][0]:
+            pages.update((toc_end, after))
+        return sorted(pages)
+
+    if TOC_SEARCH_MODE == 'sliding':
+        await sliding_scan()
+        refine_pages = []
+    else:
+        await adaptive_scan()
+        refine_pages = boundary_pages()
+
+    if page_stats:
+        artifacts.write_json("page_prefilter.json", [page_stats[p].to_dict() for p in sorted(page_stats)])
 
     # 冲突检测与单页投票
     conflict_pages = []
     final_toc_pages = []
     
     for p, votes in page_votes.items():
-        if votes["is_toc"] > 0 and votes["not_toc"] > 0:
+        if p in refine_pages or (votes["is_toc"] > 0 and votes["not_toc"] > 0):
             conflict_pages.append(p)
         elif votes["is_toc"] > 0:
             final_toc_pages.append(p)
             
     if conflict_pages:
-        info_msg = f"发现冲突页，进行单页投票：{conflict_pages}"
+        info_msg = f"发现冲突页或待确认的边界页，进行单页投票：{conflict_pages}"
         print(f"[INFO] {info_msg}")
         write_log(info_msg)
         
         async def resolve_conflict(p):
             async with semaphore:
                 img_filename = f"single_page_{p}.jpg"
-                img_save_path = os.path.join(initial_data_dir, img_filename)
-                raw_filename = f"single_toc_response_{p}.json"
-                raw_save_path = os.path.join(initial_data_dir, raw_filename)
                 
-                b64_img = create_concat_image_b64(doc, p, p, save_path=img_save_path)
+                b64_img = await concat_pages(pdf_path, [p], artifacts.image_path(img_filename))
                 if not b64_img:
                     return p, False, None
                     
+                search_stats["single_calls"] += 1
                 prompt = f"""这是一张 PDF 页面的图片，物理页码为 {p}。
 请判断这一页是否是目录。目录的严格定义为：这张图中是否能提取出多个标题 - 页码对。
 【输出要求】：
@@ -383,7 +497,7 @@ async def extract_toc_info(pdf_path: str, client: AsyncOpenAI, model: str, initi
 3. 如果不是目录，输出：{{"is_toc": false}}"""
 
                 try:
-                    completion = await client.chat.completions.create(
+                    completion = await chat_completion(client,
                         model=model,
                         messages=[
                             {
@@ -396,27 +510,18 @@ async def extract_toc_info(pdf_path: str, client: AsyncOpenAI, model: str, initi
                         ],
                         extra_body={"enable_thinking": False},
                         temperature=0,
+                        cache_validate=is_json_response,
                     )
                     raw_content = completion.choices[0].message.content.strip()
-                    
-                    with open(raw_save_path, 'w', encoding='utf-8') as f:
-                        json.dump({"page": p, "raw_response": raw_content}, f, ensure_ascii=False, indent=2)
+                    artifacts.record("single_toc_response", page=p, raw_response=raw_content, model=model)
                         
                     clean_text = re.sub(r'^```(?:json)?\s*', '', raw_content, flags=re.MULTILINE)
                     clean_text = re.sub(r'\s*```$', '', clean_text, flags=re.MULTILINE)
                     data = json.loads(clean_text)
                     is_toc = data.get("is_toc", False)
                     
-                    detail_filename = f"single_vote_detail_{p}.json"
-                    detail_save_path = os.path.join(initial_data_dir, detail_filename)
-                    detail_data = {
-                        "page": p,
-                        "parsed_result": {"is_toc": is_toc},
-                        "raw_response": raw_content,
-                        "image_saved_as": img_filename
-                    }
-                    with open(detail_save_path, 'w', encoding='utf-8') as f:
-                        json.dump(detail_data, f, ensure_ascii=False, indent=2)
+                    artifacts.record("single_vote", page=p, parsed_result={"is_toc": is_toc},
+                                     image_saved_as=img_filename if artifacts.image_path(img_filename) else None)
                         
                     return p, is_toc, raw_content
                 except Exception as e:
@@ -430,7 +535,11 @@ async def extract_toc_info(pdf_path: str, client: AsyncOpenAI, model: str, initi
             if is_toc:
                 final_toc_pages.append(p)
 
-    doc.close()
+    search_stats["elapsed"] = round(time.perf_counter() - started, 3)
+    search_stats["toc_pages"] = sorted(final_toc_pages)
+    artifacts.write_json("toc_search_stats.json", search_stats)
+    write_log(f"目录搜索（{TOC_SEARCH_MODE}）：窗口请求 {search_stats['window_calls']} 次，单页投票 {search_stats['single_calls']} 次，"
+              f"取消窗口 {search_stats['cancelled_windows']} 个，耗时 {search_stats['elapsed']:.2f}s")
 
     if not final_toc_pages:
         warn_msg = "未识别到任何目录页"
@@ -458,30 +567,16 @@ async def extract_toc_info(pdf_path: str, client: AsyncOpenAI, model: str, initi
 async def extract_book_name(pdf_path: str, original_filename: str, client: AsyncOpenAI, model: str) -> str:
     """提取 PDF 第一页并调用 LLM 识别书名"""
     try:
-        doc = fitz.open(pdf_path)
-        try:
-            page = doc[0]
-            rect = page.rect
-            max_dim = max(rect.width, rect.height)
-
-            # 修正逻辑：始终计算缩放比例，确保小封面也能清晰识别
-            TARGET_LONG_EDGE = 1000
-            if max_dim == 0:
-                return ""
-
-            zoom = TARGET_LONG_EDGE / max_dim
-            mat = fitz.Matrix(zoom, zoom)
-            pix = page.get_pixmap(matrix=mat)
-            img_data = pix.tobytes("jpeg")
-        finally:
-            doc.close()
-        
-        base64_image = base64.b64encode(img_data).decode('utf-8')
+        # 修正逻辑：始终计算缩放比例，确保小封面也能清晰识别
+        TARGET_LONG_EDGE = 1000
+        base64_image = await run_in_pool(render_page_b64, pdf_path, 0, TARGET_LONG_EDGE)
+        if base64_image is None:
+            return ""
         image_data_url = f"data:image/jpeg;base64,{base64_image}"
         
         prompt = f"这是 PDF 文件的第一页。该文件的原始文件名为：{original_filename}。请结合图片内容和原始文件名，识别并输出这本书的书名。只需输出书名文本，不要包含任何其他说明、标点或多余内容。"
         
-        completion = await client.chat.completions.create(
+        completion = await chat_completion(client,
             model=model,
             messages=[
                 {
@@ -537,7 +632,7 @@ async def fetch_single_offset(client: AsyncOpenAI, model: str, page_num: int, b6
 
 请仔细观察图片，找到印刷页码，并严格按照上述格式，仅输出计算后的正文偏移量数字。不要输出任何解释。"""
     try:
-        completion = await client.chat.completions.create(
+        completion = await chat_completion(client,
             model=model,
             messages=[
                 {
@@ -558,18 +653,22 @@ async def fetch_single_offset(client: AsyncOpenAI, model: str, page_num: int, b6
         write_log(error_msg)
         return "Error"
 
-async def calculate_offset(pdf_path: str, client: AsyncOpenAI, model: str, initial_data_dir: str) -> int:
+async def calculate_offset(pdf_path: str, client: AsyncOpenAI, model: str, artifacts: ArtifactSink, semaphore: asyncio.Semaphore = None) -> int:
     """
     自动计算正文偏移量。
     逻辑优化：
-    1. 先随机取 5 页。
-    2. 统计众数，若众数数量 < 4，则再随机取 5 页（不重复），共 10 页一起统计。
-    3. 将所有过程的图片、原始响应、解析结果保存到 initial_data/offset_log.json。
+    1. 先随机取 5 页，并发发出请求（经由 session 共用的信号量），页面渲染在渲染进程池中执行。
+    2. 已有 4 个样本一致时立即取消仍在进行的请求；第一轮众数数量 < 4（投票分散）时，
+       再随机取 5 页（不重复），第二轮中领先值已不可能被剩余样本反超时同样提前结束。
+    3. 将采样过程与解析结果汇总到 initial_data/offset_calculation_log.json。
     """
+    semaphore = semaphore or asyncio.Semaphore(SESSION_CONCURRENT_LIMIT)
     log_entries = []
+    votes = Counter()
+    cancelled_count = 0
     try:
-        doc = fitz.open(pdf_path)
-        total_pages = len(doc)
+        with fitz.open(pdf_path) as doc:
+            total_pages = len(doc)
         start_idx = int(total_pages * 0.2)
         end_idx = int(total_pages * 0.8)
         if end_idx <= start_idx:
@@ -577,119 +676,90 @@ async def calculate_offset(pdf_path: str, client: AsyncOpenAI, model: str, initi
             start_idx = 0
 
         pool = list(range(start_idx, end_idx + 1))
-        if len(pool) < 5:
-            doc.close()
+        if len(pool) < OFFSET_SAMPLE_SIZE:
             return None
 
         # 第一轮：取 5 页
-        selected_pages_1 = random.sample(pool, 5)
+        selected_pages_1 = random.sample(pool, OFFSET_SAMPLE_SIZE)
         remaining_pool = [p for p in pool if p not in selected_pages_1]
         
-        all_selected_indices = selected_pages_1[:]
-        
-        # 如果需要第二轮
-        need_second_round = False
-        
-        # 临时存储第一轮结果用于判断
-        first_round_results = []
-        
         # 定义目标长边像素
         TARGET_LONG_EDGE = 1500
 
-        for p in selected_pages_1:
-            page = doc[p]
-            rect = page.rect
-            max_dim = max(rect.width, rect.height)
-            
-            # 修正逻辑：始终计算缩放比例
-            if max_dim == 0:
-                continue
-            zoom = TARGET_LONG_EDGE / max_dim
-            
-            mat = fitz.Matrix(zoom, zoom)
-            pix = page.get_pixmap(matrix=mat)
-            img_data = pix.tobytes("jpeg")
-            base64_image = base64.b64encode(img_data).decode('utf-8')
-            
-            raw_res = await fetch_single_offset(client, model, p + 1, base64_image)
-            
+        async def sample(p, round_no):
+            async with semaphore:
+                base64_image = await run_in_pool(render_page_b64, pdf_path, p, TARGET_LONG_EDGE)
+                if base64_image is None:
+                    return None
+                raw_res = await fetch_single_offset(client, model, p + 1, base64_image)
+
             # 记录日志数据
             entry = {
                 "physical_page": p + 1,
                 "raw_response": raw_res,
                 "parsed_offset": None,
+                "round": round_no,
                 "image_base64_preview": base64_image[:100] + "..." # 仅存预览，避免 JSON 过大，实际图片可单独存如需
             }
-            
             if raw_res.isdigit() or (raw_res.startswith('-') and raw_res[1:].isdigit()):
-                val = int(raw_res)
-                entry["parsed_offset"] = val
-                first_round_results.append(val)
+                entry["parsed_offset"] = int(raw_res)
             else:
                 entry["parsed_offset"] = "Error"
-            
-            log_entries.append(entry)
-
-        # 检查众数逻辑
-        if first_round_results:
-            counter = Counter(first_round_results)
-            most_common_val, count = counter.most_common(1)[0]
-            if count < 4 and len(remaining_pool) >= 5:
-                need_second_round = True
-                write_log(f"第一轮众数数量为 {count} (<4)，启动第二轮采样。")
-        
-        if need_second_round:
-            selected_pages_2 = random.sample(remaining_pool, 5)
-            all_selected_indices.extend(selected_pages_2)
-            
-            for p in selected_pages_2:
-                page = doc[p]
-                rect = page.rect
-                max_dim = max(rect.width, rect.height)
-                
-                # 修正逻辑：始终计算缩放比例
-                if max_dim == 0:
-                    continue
-                zoom = TARGET_LONG_EDGE / max_dim
-                
-                mat = fitz.Matrix(zoom, zoom)
-                pix = page.get_pixmap(matrix=mat)
-                img_data = pix.tobytes("jpeg")
-                base64_image = base64.b64encode(img_data).decode('utf-8')
-                
-                raw_res = await fetch_single_offset(client, model, p + 1, base64_image)
-                
-                entry = {
-                    "physical_page": p + 1,
-                    "raw_response": raw_res,
-                    "parsed_offset": None,
-                    "round": 2
-                }
-                
-                if raw_res.isdigit() or (raw_res.startswith('-') and raw_res[1:].isdigit()):
-                    val = int(raw_res)
-                    entry["parsed_offset"] = val
-                    # 加入总结果列表用于最终计算（这里不需要显式列表，直接用 log_entries 过滤即可）
-                else:
-                    entry["parsed_offset"] = "Error"
-                
-                log_entries.append(entry)
-
-        doc.close()
+            return entry
+
+        async def run_round(pages, round_no, is_decided):
+            """并发采样；每收到一个结果就检查 is_decided(剩余请求数)，满足时取消其余请求"""
+            nonlocal cancelled_count
+            pending = {asyncio.create_task(sample(p, round_no)) for p in pages}
+            try:
+                while pending:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        entry = task.result()
+                        if entry is None:
+                            continue
+                        log_entries.append(entry)
+                        if isinstance(entry["parsed_offset"], int):
+                            votes[entry["parsed_offset"]] += 1
+                    if pending and is_decided(len(pending)):
+                        write_log(f"第 {round_no} 轮偏移量采样已达成一致 {dict(votes)}，取消剩余 {len(pending)} 个请求")
+                        break
+            finally:
+                for task in pending:
+                    task.cancel()
+                cancelled_count += len(pending)
+                await asyncio.gather(*pending, return_exceptions=True)
+
+        def top_counts():
+            counts = [count for _, count in votes.most_common(2)] + [0, 0]
+            return counts[0], counts[1]
+
+        await run_round(selected_pages_1, 1, lambda pending: top_counts()[0] >= OFFSET_CONSENSUS)
+
+        # 检查众数逻辑：仅当第一轮有有效样本但投票分散时才启动第二轮
+        if votes:
+            count = top_counts()[0]
+            if count < OFFSET_CONSENSUS and len(remaining_pool) >= OFFSET_SAMPLE_SIZE:
+                write_log(f"第一轮众数数量为 {count} (<{OFFSET_CONSENSUS})，启动第二轮采样。")
+                selected_pages_2 = random.sample(remaining_pool, OFFSET_SAMPLE_SIZE)
+
+                def leader_is_final(pending):
+                    first, second = top_counts()
+                    return first - second > pending
+
+                await run_round(selected_pages_2, 2, leader_is_final)
 
         # 收集所有有效偏移量
         all_offsets = [entry["parsed_offset"] for entry in log_entries if isinstance(entry["parsed_offset"], int)]
         
         # 保存详细日志到 initial_data
-        offset_log_path = os.path.join(initial_data_dir, "offset_calculation_log.json")
         summary = {
             "total_samples": len(log_entries),
             "valid_samples": len(all_offsets),
+            "cancelled_samples": cancelled_count,
             "details": log_entries
         }
-        with open(offset_log_path, 'w', encoding='utf-8') as f:
-            json.dump(summary, f, ensure_ascii=False, indent=2)
-        write_log(f"偏移量计算详细日志已保存至：{offset_log_path}")
+        artifacts.write_json("offset_calculation_log.json", summary)
 
         if all_offsets:
             most_common_offset = Counter(all_offsets).most_common(1)[0][0]
@@ -709,33 +779,59 @@ async def calculate_offset(pdf_path: str, client: AsyncOpenAI, model: str, initi
         write_log(error_msg)
         return None
 
-async def main():
+def detect_offset_from_page_labels(pdf_path: str):
+    """PDF 带有 /PageLabels 时直接换算正文偏移量，否则返回 None"""
+    try:
+        with fitz.open(pdf_path) as doc:
+            offset = pdf_fast_path.offset_from_page_labels(doc)
+    except Exception as e:
+        write_log(f"读取页码标签失败，改用 LLM 采样：{e}")
+        return None
+    if offset is not None:
+        info_msg = f"根据 PDF 页码标签得到偏移量：{offset}，跳过 LLM 采样"
+        print(f"[INFO] {info_msg}")
+        write_log(info_msg)
+    return offset
+
+async def resolved(value):
+    """已由快速通道得到的结果，与 LLM 任务一起交给 asyncio.gather"""
+    return value
+
+def fail(error_msg: str):
+    """输出并记录错误，然后终止当前阶段"""
+    print(f"错误：{error_msg}")
+    write_log(error_msg)
+    raise StageError(error_msg)
+
+def load_llm_config() -> dict:
+    """读取 static/llm_config.json 并解析 API Key"""
+    config_path = os.path.join(PROJECT_ROOT, "static", "llm_config.json")
+    if not os.path.exists(config_path):
+        fail(f"LLM 配置文件未找到，当前查找目录：{config_path}")
+
+    with open(config_path, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+
+    return {
+        "api_key": get_api_key(config.get("api_key", "")),
+        "base_url": config.get("base_url", "https://dashscope.aliyuncs.com/compatible-mode/v1"),
+        "model": config.get("model", "qwen-vl-max"),
+        "routes": llm_routes.resolve_routes(config, resolve_config_value),
+    }
+
+async def extract_metadata(input_dir: str, output_dir: str, llm_config: dict):
+    """识别书名、正文偏移量和目录页范围，并写回 output_dir 中与 PDF 同名的 JSON"""
     write_log("=== pdf_metadata_extractor.py 开始执行 ===")
-    
-    input_dir = os.getenv("PDF_METADATA_EXTRACTOR_INPUT")
-    output_dir = os.getenv("PDF_METADATA_EXTRACTOR_OUTPUT")
-    
-    if not input_dir or not output_dir:
-        error_msg = "环境变量 PDF_METADATA_EXTRACTOR_INPUT 或 PDF_METADATA_EXTRACTOR_OUTPUT 未设置"
-        print(f"错误：{error_msg}")
-        write_log(error_msg)
-        sys.exit(1)
 
     input_dir = os.path.abspath(input_dir)
     output_dir = os.path.abspath(output_dir)
 
     if not os.path.exists(input_dir):
-        error_msg = f"输入目录未找到，当前查找目录：{input_dir}"
-        print(f"错误：{error_msg}")
-        write_log(error_msg)
-        sys.exit(1)
-        
+        fail(f"输入目录未找到，当前查找目录：{input_dir}")
+
     pdf_files = [f for f in os.listdir(input_dir) if f.lower().endswith('.pdf')]
     if len(pdf_files) != 1:
-        error_msg = f"输入目录中必须仅包含 1 个 PDF 文件，当前找到 {len(pdf_files)} 个。查找目录：{input_dir}"
-        print(f"错误：{error_msg}")
-        write_log(error_msg)
-        sys.exit(1)
+        fail(f"输入目录中必须仅包含 1 个 PDF 文件，当前找到 {len(pdf_files)} 个。查找目录：{input_dir}")
     
     pdf_filename = pdf_files[0]
     pdf_path = os.path.join(input_dir, pdf_filename)
@@ -743,51 +839,54 @@ async def main():
     json_filename = os.path.splitext(pdf_filename)[0] + ".json"
     json_path = os.path.join(output_dir, json_filename)
     if not os.path.exists(json_path):
-        error_msg = f"目标 JSON 文件未找到，当前查找目录：{json_path}"
-        print(f"错误：{error_msg}")
-        write_log(error_msg)
-        sys.exit(1)
+        fail(f"目标 JSON 文件未找到，当前查找目录：{json_path}")
 
     initial_data_dir = os.path.join(output_dir, "initial_data")
-    os.makedirs(initial_data_dir, exist_ok=True)
-    info_msg = f"中间数据将保存至：{initial_data_dir}"
-    print(f"[INFO] {info_msg}")
-    write_log(info_msg)
+    artifacts = ArtifactSink(initial_data_dir)
+    if artifacts.enabled():
+        info_msg = f"中间数据将保存至：{initial_data_dir}（级别：{artifacts.level}）"
+        print(f"[INFO] {info_msg}")
+        write_log(info_msg)
 
-    config_path = os.path.join(PROJECT_ROOT, "static", "llm_config.json")
-    if not os.path.exists(config_path):
-        error_msg = f"LLM 配置文件未找到，当前查找目录：{config_path}"
-        print(f"错误：{error_msg}")
-        write_log(error_msg)
-        sys.exit(1)
-        
-    with open(config_path, 'r', encoding='utf-8') as f:
-        config = json.load(f)
-        
-    api_key = get_api_key(config.get("api_key", ""))
-    base_url = config.get("base_url", "https://dashscope.aliyuncs.com/compatible-mode/v1")
-    model = config.get("model", "qwen-vl-max")
-    
-    if not api_key:
-        error_msg = "API Key 解析失败或为空，请检查 llm_config.json 或环境变量配置。"
-        print(f"错误：{error_msg}")
-        write_log(error_msg)
-        sys.exit(1)
+    if not llm_config.get("api_key"):
+        fail("API Key 解析失败或为空，请检查 llm_config.json 或环境变量配置。")
 
-    client = AsyncOpenAI(api_key=api_key, base_url=base_url)
+    # 书名、偏移量、目录页判定分别按 routes 选择模型（未配置时均使用顶层模型）
+    clients = llm_routes.routed_clients(llm_config, (llm_routes.TOC_DETECT, llm_routes.OFFSET, llm_routes.BOOK_NAME))
 
     info_msg = f"开始处理 PDF: {pdf_filename}"
     print(f"[INFO] {info_msg}")
     write_log(info_msg)
     
-    # 传递 initial_data_dir 给 calculate_offset
-    book_name_task = extract_book_name(pdf_path, pdf_filename, client, model)
-    offset_task = calculate_offset(pdf_path, client, model, initial_data_dir)
-    toc_task = extract_toc_info(pdf_path, client, model, initial_data_dir)
+    # 页码标签、文字层可用时直接得到偏移量与目录页范围，不再调用 LLM
+    fast_paths = []
+    label_offset = detect_offset_from_page_labels(pdf_path)
+    text_toc = await asyncio.to_thread(detect_toc_from_text_layer, pdf_path, artifacts)
+
+    # 目录窗口与偏移量采样共用同一个 session 级信号量
+    semaphore = asyncio.Semaphore(SESSION_CONCURRENT_LIMIT)
+    book_name_task = extract_book_name(pdf_path, pdf_filename, *clients[llm_routes.BOOK_NAME])
+    if label_offset is not None:
+        fast_paths.append(pdf_fast_path.FAST_PATH_PAGE_LABELS)
+        offset_task = resolved(label_offset)
+    else:
+        offset_task = calculate_offset(pdf_path, *clients[llm_routes.OFFSET], artifacts, semaphore)
+    if text_toc[0] is not None:
+        fast_paths.append(pdf_fast_path.FAST_PATH_TEXT_LAYER)
+        toc_task = resolved(text_toc)
+    else:
+        toc_task = extract_toc_info(pdf_path, *clients[llm_routes.TOC_DETECT], artifacts, semaphore)
     
-    book_name, content_start, (toc_start, toc_end) = await asyncio.gather(
-        book_name_task, offset_task, toc_task
-    )
+    lag_monitor = LoopLagMonitor().start()
+    try:
+        book_name, content_start, (toc_start, toc_end) = await asyncio.gather(
+            book_name_task, offset_task, toc_task
+        )
+    finally:
+        lag = await lag_monitor.stop()
+        write_log(f"事件循环延迟：平均 {lag['mean_ms']}ms，p95 {lag['p95_ms']}ms，最大 {lag['max_ms']}ms（{lag['samples']} 个样本）")
+        # 调试产物由后台线程写出，阶段结束前等待落盘
+        await asyncio.to_thread(artifacts.close)
 
     try:
         with open(json_path, 'r', encoding='utf-8') as f:
@@ -806,10 +905,10 @@ async def main():
             updated = True
             
         if updated:
-            with open(json_path, 'w', encoding='utf-8') as f:
-                json.dump(json_data, f, ensure_ascii=False, indent=4)
+            json_data["fast_paths"] = fast_paths
+            atomic_write_json(json_path, json_data, indent=4)
             success_msg = f"成功更新 JSON 文件：{json_path}"
-            result_msg = f"提取结果 -> 书名：{book_name}, 偏移量：{content_start}, 目录：{toc_start}-{toc_end}"
+            result_msg = f"提取结果 -> 书名：{book_name}, 偏移量：{content_start}, 目录：{toc_start}-{toc_end}, 快速通道：{fast_paths or '无'}"
             print(f"[SUCCESS] {success_msg}")
             print(f"[RESULT] {result_msg}")
             write_log(success_msg)
@@ -824,14 +923,29 @@ async def main():
         print(f"[ERROR] {error_msg}")
         write_log(error_msg)
         write_log("完整错误追踪:\n" + traceback.format_exc())
-        sys.exit(1)
+        raise StageError(error_msg) from e
     
     write_log("=== pdf_metadata_extractor.py 执行完成 ===")
 
+def run_stage(input_dir: str, output_dir: str, llm_config: dict):
+    """阶段入口：供 app.py 在常驻进程内直接调用"""
+    run_async(extract_metadata(input_dir, output_dir, llm_config))
+
+async def main():
+    input_dir = os.getenv("PDF_METADATA_EXTRACTOR_INPUT")
+    output_dir = os.getenv("PDF_METADATA_EXTRACTOR_OUTPUT")
+    
+    if not input_dir or not output_dir:
+        fail("环境变量 PDF_METADATA_EXTRACTOR_INPUT 或 PDF_METADATA_EXTRACTOR_OUTPUT 未设置")
+
+    await extract_metadata(input_dir, output_dir, load_llm_config())
+
 if __name__ == "__main__":
     try:
         asyncio.run(main())
         print("\n[INFO] pdf_metadata_extractor 执行完成!")
+    except StageError:
+        sys.exit(1)
     except Exception as e:
         error_msg = f"程序执行出错：{e}"
         print(f"\n[ERROR] {error_msg}")
@@ -1,22 +1,28 @@
 import os
+import re
 import json
+import sys
 import fitz  # PyMuPDF
 import dotenv
+from PIL import Image
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mainprogress.page_render_cache import render_cache, zoom_for_long_edge
+from mainprogress.page_artifacts import page_store, encode_request_jpeg
+from mainprogress.render_pool import RENDER_WORKERS, pool_started, render_pages_to_jpeg
 
 # 加载环境变量
 dotenv.load_dotenv()
 
-def convert_pdf_to_jpg():
-    output_dir = os.getenv('PDF2JPG_OUTPUT')
-    if not output_dir:
-        print("错误：未找到环境变量 PDF2JPG_OUTPUT")
-        return
+# 渲染缓存未命中的页面数达到 PDF2JPG_PARALLEL_MIN_PAGES、或进程池已由元数据提取阶段启动时，交给多进程池并行渲染；
+# PDF2JPG_WORKERS=1 时始终在当前线程逐页渲染
+PDF2JPG_WORKERS = int(os.getenv('PDF2JPG_WORKERS', str(RENDER_WORKERS)))
+PDF2JPG_PARALLEL_MIN_PAGES = int(os.getenv('PDF2JPG_PARALLEL_MIN_PAGES', '4'))
+
+def convert_pdf_to_jpg(input_dir, output_dir):
+    """将 input_dir 中 PDF 的目录页（由同名 JSON 的 toc_start/toc_end 指定）渲染为 JPG"""
     os.makedirs(output_dir, exist_ok=True)
-    
-    input_dir = os.getenv('PDF2JPG_INPUT')
-    if not input_dir:
-        print("错误：未找到环境变量 PDF2JPG_INPUT")
-        return
 
     if not os.path.exists(input_dir):
         print(f"错误：输入目录不存在：{input_dir}")
@@ -85,10 +91,32 @@ def convert_pdf_to_jpg():
                 doc.close()
                 continue
 
+            # 清理上次运行遗留的、已不在目录页范围内的图片，避免下游阶段处理过期页面
+            page_pattern = re.compile(rf"^{re.escape(pdf_name)}_page_(\d+)\.jpg$")
+            for existing in os.listdir(output_dir):
+                match = page_pattern.match(existing)
+                if match and not (toc_start <= int(match.group(1)) <= toc_end):
+                    os.remove(os.path.join(output_dir, existing))
+                    print(f"  [清理] 移除范围外的旧图片：{existing}")
+
             saved_images = []
             range_count = toc_end - toc_start + 1
             print(f"  [计划] 即将转换 {range_count} 页...")
 
+            # 元数据提取阶段已渲染过的页面直接取自渲染缓存（含渲染进程交回的请求 JPEG），其余页面较多时按段分给多个进程并行渲染
+            pending = []
+            for page_index in range(toc_start - 1, toc_end):
+                zoom = zoom_for_long_edge(doc[page_index], TARGET_LONG_EDGE)
+                if (zoom is not None and not render_cache.contains(doc, page_index, zoom)
+                        and render_cache.get_encoded(doc, page_index, zoom) is None):
+                    pending.append(page_index)
+            if range_count > len(pending):
+                print(f"  [复用] {range_count - len(pending)} 页取自渲染缓存")
+            pooled = {}
+            if PDF2JPG_WORKERS > 1 and pending and (len(pending) >= PDF2JPG_PARALLEL_MIN_PAGES or pool_started()):
+                print(f"  [并行] {len(pending)} 页交由 {PDF2JPG_WORKERS} 个进程渲染")
+                pooled = render_pages_to_jpeg(pdf_path, pending, TARGET_LONG_EDGE, PDF2JPG_WORKERS)
+
             # 遍历指定页码范围
             for page_num in range(toc_start, toc_end + 1):
                 page_index = page_num - 1
@@ -119,32 +147,36 @@ def convert_pdf_to_jpg():
                 # 可选：设置最小缩放倍数，防止极度微小的页面被放大到失真
                 # if zoom < 1.0: zoom = 1.0  # 如果希望只放大不缩小，取消注释此行
                 
-                # 构建渲染矩阵
-                mat = fitz.Matrix(zoom, zoom)
-                
-                # 3. 执行渲染
-                # alpha=False 生成 JPG 所需的不透明图像
-                pix = page.get_pixmap(matrix=mat, alpha=False)
-                
                 output_path = os.path.join(
                     output_dir,
                     f"{pdf_name}_page_{page_num}.jpg"
                 )
                 
-                # 4. 保存图片
-                # dpi 参数仅用于元数据，不影响实际像素大小，实际大小由 matrix 决定
-                pix.save(output_path)
+                # 3. 执行渲染并保存图片
+                # 直接编码为 LLM 请求所用的 JPEG 并登记到编码页面存储，下游阶段无需再解码重编码；
+                # 先写临时文件再替换，中途失败不会留下半写入的图片
+                encoded = render_cache.get_encoded(doc, page_index, zoom)
+                if page_index in pooled:
+                    width, height, jpeg_bytes = pooled.pop(page_index)
+                elif encoded is not None:
+                    width, height, jpeg_bytes = encoded
+                else:
+                    # 生成 JPG 所需的不透明图像；元数据提取阶段已按相同分辨率渲染过的页面直接取自渲染缓存
+                    pix = render_cache.get_pixmap(doc, page_index, zoom)
+                    width, height = pix.width, pix.height
+                    jpeg_bytes = encode_request_jpeg(Image.frombytes("RGB", (width, height), pix.samples))
+                    del pix
+                page_store.write_jpeg(output_path, jpeg_bytes)
                 
                 # 计算等效 DPI 用于日志展示，方便调试
                 # 原始尺寸是 72 DPI，放大 zoom 倍后，等效 DPI = 72 * zoom
                 effective_dpi = 72 * zoom
                 
-                print(f"  [完成] 第 {page_num} 页 -> {pix.width}x{pix.height} | Zoom: {zoom:.2f}x | Eff. DPI: {effective_dpi:.0f}")
+                print(f"  [完成] 第 {page_num} 页 -> {width}x{height} | Zoom: {zoom:.2f}x | Eff. DPI: {effective_dpi:.0f}")
                 
                 saved_images.append(output_path)
                 
                 # 显式释放资源
-                del pix
                 del page
                 
                 # 进度反馈
@@ -168,9 +200,26 @@ def convert_pdf_to_jpg():
     print(f"\n=== 全部任务结束 ===")
     print(f"总计生成图片数量：{processed_count}")
 
+def run_stage(input_dir, output_dir):
+    """阶段入口：供 app.py 在常驻进程内直接调用"""
+    convert_pdf_to_jpg(input_dir, output_dir)
+
+def main():
+    output_dir = os.getenv('PDF2JPG_OUTPUT')
+    if not output_dir:
+        print("错误：未找到环境变量 PDF2JPG_OUTPUT")
+        return
+
+    input_dir = os.getenv('PDF2JPG_INPUT')
+    if not input_dir:
+        print("错误：未找到环境变量 PDF2JPG_INPUT")
+        return
+
+    run_stage(input_dir, output_dir)
+
 if __name__ == "__main__":
     try:
-        convert_pdf_to_jpg()
+        main()
     except Exception as e:
         print(f"程序主入口出错：{e}")
         import traceback
@@ -1,22 +1,38 @@
 import os
 import asyncio
-import base64
 import traceback
 import sys
 import re
 import csv
+import time
 from pathlib import Path
-from io import BytesIO, StringIO
-from PIL import Image
+from io import StringIO
 from dotenv import load_dotenv
 from openai import AsyncOpenAI, APIError
 
+PROJECT_ROOT = str(Path(__file__).resolve().parent.parent)
+sys.path.append(PROJECT_ROOT)
+
+from mainprogress.stage_context import StageError, run_async, get_session_base_dir
+from mainprogress.llm_scheduler import chat_completion, stream_consumer, StreamAborted
+from mainprogress.image_prefetch import ImagePrefetcher
+from mainprogress.stage_manifest import StageManifest, atomic_write_text, file_sha256, hash_values
+from mainprogress import text_layer, llm_routes, llm_hedge, structured_output
+from mainprogress.structured_output import EXTRACT_FIELDS
+
 # 配置常量
 IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.webp'}
-MAX_IMAGE_DIMENSION = 1500
-CONCURRENT_LIMIT = 15
+CONCURRENT_LIMIT = 15  # 单个 session 同时处理的页数上限；LLM 请求的全局并发由 llm_scheduler 统一控制
 MAX_RETRIES = 5  # API 请求最大重试次数
 POST_PROCESS_RETRIES = 2  # 后处理失败后的额外重试次数
+STAGE_NAME = 'qwen_vl_extract'
+# 单次请求打包的连续目录页数。大于 1 时提示词每批只发送一次，模型按页面标记分段输出各页 CSV；
+# 整批输出未通过校验（标记缺失、页数不符或某段 CSV 不合法）时，该批改为逐页请求。
+# 结构化输出（LLM_OUTPUT_MODE=json_schema）与流式校验（EXTRACT_STREAM=1）只支持逐页请求，启用时批量设置不生效。
+EXTRACT_BATCH_SIZE = max(1, int(os.getenv('EXTRACT_BATCH_SIZE', '1')))
+# 逐页请求使用流式响应：每收到完整一行即按 CSV 规则校验，出现无法修复的行（表头或列数错误）时
+# 立即断开并重试，不再等模型写完整页。需要服务端支持 stream_options.include_usage 才能统计 token。
+EXTRACT_STREAM = os.getenv('EXTRACT_STREAM', '0') == '1'
 
 # 全局提示词
 PROMPT_TEXT = """# 任务目标
@@ -66,9 +82,15 @@ IMPORTANT_NOTE = """
 2. 页面上出现xx篇、xx章时，尽管它们没有页码，但仍然应提取，它们必然是目录的一部分。
 """
 
-LLM_CONFIG = {}
-IMAGE_CACHE = {}
-client = None
+BATCH_NOTE = """
+# 多页输出要求
+本次请求包含 {count} 张连续的目录页图片，按顺序编号为第 1 至第 {count} 张，每张图片分别提取。
+每张图片的结果前单独输出一行页面标记 `=== PAGE k ===`（k 为图片编号），随后是该页的 CSV 数据（含表头 title,page_number）。
+必须按编号顺序输出全部 {count} 段，不得合并或跳过；某页没有目录项时仅输出该页的标记与表头。
+"""
+
+PAGE_MARKER_RE = re.compile(r'^[ \t]*=+[ \t]*PAGE[ \t]*(\d+)[ \t]*=+[ \t]*$', re.MULTILINE | re.IGNORECASE)
+CSV_HEADER = "title,page_number"
 
 def write_log(message):
     try:
@@ -76,7 +98,7 @@ def write_log(message):
         timestamp = datetime.now().strftime("%H:%M:%S")
 
         # 优先写入 session 日志
-        base_dir = os.getenv("BASE_DIR")
+        base_dir = get_session_base_dir()
         if base_dir:
             session_log = Path(base_dir) / "session.log"
             session_log.parent.mkdir(parents=True, exist_ok=True)
@@ -115,30 +137,13 @@ def load_llm_config() -> dict:
     return {
         "api_key": api_key,
         "base_url": base_url,
-        "model": model
+        "model": model,
+        "routes": llm_routes.resolve_routes(config, resolve_value)
     }
 
 def natural_sort_key(s):
     return [int(text) if text.isdigit() else text.lower() for text in re.split(r'(\d+)', str(s))]
 
-def resize_and_encode_image(image_path: Path) -> str:
-    with Image.open(image_path) as img:
-        if img.mode in ("RGBA", "P"):
-            img = img.convert("RGB")
-        width, height = img.size
-        max_dim = max(width, height)
-        if max_dim > MAX_IMAGE_DIMENSION:
-            ratio = MAX_IMAGE_DIMENSION / max_dim
-            img = img.resize((int(width * ratio), int(height * ratio)), Image.LANCZOS)
-        buffer = BytesIO()
-        img.save(buffer, format="JPEG", quality=85, optimize=True)
-        return f"data:image/jpeg;base64,{base64.b64encode(buffer.getvalue()).decode('utf-8')}"
-
-def get_encoded_image(image_path: Path) -> str:
-    if image_path not in IMAGE_CACHE:
-        IMAGE_CACHE[image_path] = resize_and_encode_image(image_path)
-    return IMAGE_CACHE[image_path]
-
 def validate_and_fix_csv_content(content: str):
     """
     验证 CSV 内容是否合法（2 列）。
@@ -205,11 +210,122 @@ def validate_and_fix_csv_content(content: str):
     except Exception:
         return False, content
 
+def strip_code_fence(content: str) -> str:
+    """清理 Markdown 代码块标记"""
+    content = content.strip()
+    if content.startswith("```csv"):
+        content = content[6:]
+    elif content.startswith("```"):
+        content = content[3:]
+    if content.endswith("```"):
+        content = content[:-3]
+    return content.strip()
+
+def is_valid_csv_response(content: str) -> bool:
+    """响应能否通过 CSV 校验（用于决定是否写入响应缓存）"""
+    return validate_and_fix_csv_content(strip_code_fence(content))[0]
+
+def is_valid_structured_response(content: str) -> bool:
+    """结构化输出模式下的缓存校验：能按 Schema 解析即可（目录页可能没有条目）"""
+    return structured_output.is_valid_response(content, EXTRACT_FIELDS, allow_empty=True)
+
+def batch_size() -> int:
+    """实际每批请求的页数：结构化输出或流式校验启用时为 1（见 EXTRACT_BATCH_SIZE）"""
+    if structured_output.enabled() or EXTRACT_STREAM:
+        return 1
+    return EXTRACT_BATCH_SIZE
+
+def batch_fingerprint() -> str:
+    """批量模式参与逐页输入哈希与整书结果缓存键；逐页模式下为空，沿用原有的键"""
+    return f"batch={batch_size()}|{BATCH_NOTE}" if batch_size() > 1 else ''
+
+def split_batch_response(content: str, count: int):
+    """
+    按页面标记拆分多页响应，返回各页校验修复后的 CSV 列表；
+    标记须恰为 1..count 且按顺序出现，任一段 CSV 不合法时返回 None
+    """
+    content = strip_code_fence(content)
+    markers = list(PAGE_MARKER_RE.finditer(content))
+    if [int(m.group(1)) for m in markers] != list(range(1, count + 1)):
+        return None
+    sections = []
+    for i, marker in enumerate(markers):
+        end = markers[i + 1].start() if i + 1 < len(markers) else len(content)
+        section = strip_code_fence(content[marker.end():end])
+        if not section.lower().startswith("title"):
+            # 空页或模型省略了表头
+            section = f"{CSV_HEADER}\n{section}" if section else CSV_HEADER
+        is_valid, fixed = validate_and_fix_csv_content(section)
+        if not is_valid:
+            return None
+        sections.append(fixed)
+    return sections
+
+class StreamingCsvCheck:
+    """
+    流式响应的增量校验：每收到完整一行即按 validate_and_fix_csv_content 的规则检查，
+    任一行无法修复为 2 列时整页响应必然校验失败，立即抛出 StreamAborted 中止读取。
+    同时记录首个数据行（表头之后）到达的时间。
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.first_row_at = None
+        self._buffer = ''
+        self._lines = 0
+
+    def feed(self, delta: str):
+        self._buffer += delta
+        while '\n' in self._buffer:
+            line, self._buffer = self._buffer.split('\n', 1)
+            self._check_line(line.strip())
+
+    def _check_line(self, line: str):
+        # 代码块标记由 strip_code_fence 去除，空行在校验时忽略
+        if not line or line.startswith('```'):
+            return
+        self._lines += 1
+        if not validate_and_fix_csv_content(line)[0]:
+            kind = "表头" if self._lines == 1 else f"第 {self._lines} 行"
+            raise StreamAborted(f"{kind}无法解析为 2 列：{line[:50]}")
+        if self._lines > 1 and self.first_row_at is None:
+            self.first_row_at = time.perf_counter()
+
+def record_usage(stats: dict, response):
+    """累计请求次数与 token 用量（缓存命中的响应同样带有原始用量）"""
+    if stats is None:
+        return
+    stats['requests'] += 1
+    usage = getattr(response, 'usage', None)
+    if usage:
+        stats['prompt_tokens'] += usage.prompt_tokens or 0
+        stats['completion_tokens'] += usage.completion_tokens or 0
+
+def record_wasted(stats: dict, response):
+    """整页响应未通过校验而被丢弃时，计入浪费的输出 token"""
+    usage = getattr(response, 'usage', None)
+    if usage:
+        stats['wasted_completion_tokens'] += usage.completion_tokens or 0
+
+def new_usage_stats() -> dict:
+    """
+    first_row_ms: 每页从发出请求到首个数据行可用的毫秒数（非流式时即整页响应返回的时间）；
+    wasted_completion_tokens: 被丢弃响应的输出 token，流式中止的按已接收片段数估算；
+    pages: 需要调用视觉模型的页数；retries: 因内容不合格（空内容、CSV 或 Schema 解析失败）而重发的逐页请求数
+    """
+    return {'requests': 0, 'prompt_tokens': 0, 'completion_tokens': 0, 'batches': 0, 'batch_fallbacks': 0,
+            'stream_aborts': 0, 'wasted_completion_tokens': 0, 'first_row_ms': [], 'pages': 0, 'retries': 0}
+
+def median(values):
+    ordered = sorted(values)
+    return ordered[len(ordered) // 2] if ordered else None
+
 def fix_null_page_numbers(csv_content: str) -> str:
     """
     处理页码为 null 的情况：
     1. 若某标题页码为 null，则向下寻找第一个非 null 项填充。
     2. 若下方全是 null，则向上寻找最近的非 null 项填充。
+    页码之后的列（如合并模式的 level）原样保留。
     """
     lines = csv_content.strip().splitlines()
     if not lines:
@@ -230,7 +346,7 @@ def fix_null_page_numbers(csv_content: str) -> str:
             if len(row) >= 2:
                 title = row[0]
                 page = row[1].strip()
-                parsed_data.append({'title': title, 'page': page, 'original_line': line})
+                parsed_data.append({'title': title, 'page': page, 'rest': row[2:], 'original_line': line})
             else:
                 # 格式错误的行，原样保留
                 parsed_data.append({'title': '', 'page': '', 'original_line': line, 'invalid': True})
@@ -285,183 +401,408 @@ def fix_null_page_numbers(csv_content: str) -> str:
             # 使用 csv 模块写入以确保安全
             buffer = StringIO()
             writer = csv.writer(buffer)
-            writer.writerow([item['title'], item['page']])
+            writer.writerow([item['title'], item['page'], *item['rest']])
             output_lines.append(buffer.getvalue().strip())
             
     return '\n'.join(output_lines)
 
-async def process_image_async(semaphore: asyncio.Semaphore, img_file: Path, output_path: Path):
+def load_text_layer_pages(image_files: list, base_dir) -> dict:
+    """按图片名 <PDF 名>_page_<页码>.jpg 找到原 PDF 中对应页并分析文字层，返回 {图片名: TextLayerPage}"""
+    if not text_layer.enabled():
+        return {}
+    pdf_dir = Path(base_dir) / "input_pdf"
+    pdf_files = [f for f in pdf_dir.iterdir() if f.suffix.lower() == '.pdf'] if pdf_dir.exists() else []
+    if len(pdf_files) != 1:
+        return {}
+    pattern = re.compile(rf"^{re.escape(pdf_files[0].stem)}_page_(\d+)$")
+    page_to_image = {}
+    for img_file in image_files:
+        match = pattern.match(img_file.stem)
+        if match:
+            page_to_image[int(match.group(1))] = img_file.name
+    try:
+        analyzed = text_layer.analyze_pages(pdf_files[0], page_to_image)
+    except Exception as e:
+        write_log(f"文字层分析失败，全部页面改用视觉模型：{e}")
+        return {}
+    return {page_to_image[page_num]: page for page_num, page in analyzed.items()}
+
+def write_text_layer_csv(img_file: Path, output_file: Path, text_page, input_hash: str, manifest: StageManifest) -> bool:
+    """把文字层条目写成与模型输出一致的 CSV；无法通过校验时返回 False，由调用方改用视觉模型"""
+    is_valid, content = validate_and_fix_csv_content(text_layer.entries_to_csv(text_page.entries))
+    if not is_valid:
+        write_log(f"文字层条目未通过 CSV 校验，改用视觉模型：{img_file.name}")
+        return False
+    atomic_write_text(output_file, fix_null_page_numbers(content))
+    manifest.record_unit(STAGE_NAME, img_file.name, input_hash, output_file)
+    write_log(f"文字层提取成功（置信度 {text_page.confidence}，{len(text_page.entries)} 条）：{img_file.name}")
+    print(f"已提取 CSV（文字层）：{img_file.name}")
+    return True
+
+def prepare_page(img_file: Path, output_file: Path, model: str, manifest: StageManifest, text_page=None):
+    """
+    不需要视觉模型的情况先行处理，返回 (结果, input_hash)：
+    结果为 None 表示阶段清单中已有完好输出而跳过，为 True 表示已由文字层生成 CSV，
+    为 False 表示需要调用视觉模型，input_hash 供写出后登记
+    """
+    if text_page is not None and text_page.confident:
+        input_hash = hash_values(file_sha256(img_file), 'text_layer', text_layer.engine_fingerprint())
+        if manifest.get_unit(STAGE_NAME, img_file.name, input_hash):
+            write_log(f"跳过已处理文件：{img_file.name}")
+            return None, input_hash
+        if write_text_layer_csv(img_file, output_file, text_page, input_hash, manifest):
+            return True, input_hash
+
+    # 仅当阶段清单中记录的输入（图片、模型、提示词）未变且输出完好时才跳过，半写入或过期的文件会重新生成
+    input_values = [file_sha256(img_file), model, PROMPT_TEXT, IMPORTANT_NOTE]
+    if batch_fingerprint():
+        input_values.append(batch_fingerprint())
+    if structured_output.fingerprint():
+        input_values.append(structured_output.fingerprint())
+    input_hash = hash_values(*input_values)
+    if manifest.get_unit(STAGE_NAME, img_file.name, input_hash):
+        write_log(f"跳过已处理文件：{img_file.name}")
+        return None, input_hash
+    return False, input_hash
+
+def save_page_csv(img_file: Path, output_file: Path, content: str, input_hash: str, manifest: StageManifest):
+    """填充 null 页码后写出该页 CSV 并登记到阶段清单"""
+    try:
+        fixed_content = fix_null_page_numbers(content)
+        atomic_write_text(output_file, fixed_content)
+        write_log(f"结果保存并修正页码成功：{output_file.name}")
+    except Exception as post_err:
+        write_log(f"页码修正过程出错，保存原始内容：{str(post_err)}")
+        # 如果修正失败，至少保存原始验证通过的内容
+        atomic_write_text(output_file, content)
+    manifest.record_unit(STAGE_NAME, img_file.name, input_hash, output_file)
+
+async def extract_page_with_model(img_file: Path, output_file: Path, input_hash: str, client: AsyncOpenAI, model: str, manifest: StageManifest, images: ImagePrefetcher, stats: dict = None):
     """
     使用 OpenAI SDK 发送请求，并包含后处理逻辑
     修改点：增加对解析错误的详细日志记录，包含原始响应
+    images: 本阶段的图片预取器；stats: 可选，请求次数与 token 用量累计（见 new_usage_stats）
     """
-    async with semaphore:
-        output_file = output_path / f"{img_file.stem}.csv"
-        if output_file.exists():
-            write_log(f"跳过已处理文件：{img_file.name}")
-            return None
-
-        write_log(f"开始处理图像：{img_file.name}")
-        
-        last_raw_response = None
-        last_error_msg = None
-        
-        try:
+    write_log(f"开始处理图像：{img_file.name}")
+    stats = stats if stats is not None else new_usage_stats()
+    
+    last_raw_response = None
+    last_error_msg = None
+    
+    try:
+        image_data_url = await images.get(img_file)
+
+        # 构建消息内容
+        content_list = [
+            {"type": "text", "text": "当前页图片（需处理）："},
+            {"type": "text", "text": PROMPT_TEXT},
+            {"type": "image_url", "image_url": {"url": image_data_url}},
+            {"type": "text", "text": PROMPT_TEXT},
+            {"type": "text", "text": IMPORTANT_NOTE}
+        ]
+        structured = structured_output.enabled()
+        if structured:
+            content_list.append({"type": "text", "text": structured_output.note(EXTRACT_FIELDS)})
+
+        # 外层循环控制总重试次数 (初始 1 次 + 后处理失败后的额外重试)
+        total_attempts = 1 + POST_PROCESS_RETRIES
+
+        final_content = None
+
+        for attempt in range(total_attempts):
             try:
-                image_data_url = get_encoded_image(img_file)
+                check = StreamingCsvCheck()
+                request_kwargs = {"cache_validate": is_valid_csv_response}
+                if structured:
+                    # 结构化输出为整段 JSON，不做逐行流式校验
+                    request_kwargs = {"cache_validate": is_valid_structured_response,
+                                      "response_format": structured_output.response_format('toc_entries', EXTRACT_FIELDS)}
+                elif EXTRACT_STREAM:
+                    request_kwargs.update({"stream": True, "stream_options": {"include_usage": True},
+                                           "consume": stream_consumer(check.feed)})
+                if attempt > 0:
+                    stats['retries'] += 1
+                # 调用 SDK
+                response = await chat_completion(client,
+                    model=model,
+                    messages=[{"role": "user", "content": content_list}],
+                    temperature=0,
+                    extra_body={"enable_thinking": False},
+                    hedge=llm_routes.EXTRACT,
+                    **request_kwargs
+                )
 
-                # 构建消息内容
-                content_list = [
-                    {"type": "text", "text": "当前页图片（需处理）："},
-                    {"type": "text", "text": PROMPT_TEXT},
-                    {"type": "image_url", "image_url": {"url": image_data_url}},
-                    {"type": "text", "text": PROMPT_TEXT},
-                    {"type": "text", "text": IMPORTANT_NOTE}
-                ]
+                record_usage(stats, response)
+                # 流式时为首个数据行到达的时间，非流式（或缓存命中）时为整页响应返回的时间
+                stats['first_row_ms'].append(round(((check.first_row_at or time.perf_counter()) - check.started) * 1000, 1))
 
-                # 外层循环控制总重试次数 (初始 1 次 + 后处理失败后的额外重试)
-                total_attempts = 1 + POST_PROCESS_RETRIES
+                # 保存原始响应内容用于潜在的错误日志
+                last_raw_response = response.choices[0].message.content
 
-                final_content = None
+                content = strip_code_fence(last_raw_response)
 
-                for attempt in range(total_attempts):
-                    try:
-                        # 调用 SDK
-                        response = await client.chat.completions.create(
-                            model=LLM_CONFIG["model"],
-                            messages=[{"role": "user", "content": content_list}],
-                            temperature=0,
-                            extra_body={"enable_thinking": False}
-                        )
-
-                        # 保存原始响应内容用于潜在的错误日志
-                        last_raw_response = response.choices[0].message.content
-
-                        content = last_raw_response.strip()
-
-                        # 清理 Markdown 代码块标记
-                        if content.startswith("```csv"):
-                            content = content[6:]
-                        elif content.startswith("```"):
-                            content = content[3:]
-                        if content.endswith("```"):
-                            content = content[:-3]
-                        content = content.strip()
-
-                        if not content:
-                            write_log(f"模型返回空内容 (尝试 {attempt+1}/{total_attempts})")
-                            if attempt == total_attempts - 1:
-                                raise Exception("模型持续返回空内容")
-                            continue
-
-                        # 后处理验证与修复
-                        is_valid, processed_content = validate_and_fix_csv_content(content)
-
-                        if is_valid:
-                            final_content = processed_content
-                            if attempt > 0:
-                                write_log(f"第 {attempt+1} 次尝试成功 (经过后处理修复)")
-                            break
-                        else:
-                            # 记录验证失败的原始内容
-                            last_error_msg = f"CSV 格式验证失败：行数或列数不符合 2 列要求。原始内容片段：{content[:200]}..."
-                            write_log(f"CSV 解析失败且修复无效 (尝试 {attempt+1}/{total_attempts})")
-                            if attempt == total_attempts - 1:
-                                raise Exception(last_error_msg)
-                            # 继续下一次重试循环，重新请求 LLM
-
-                    except APIError as e:
-                        # 捕获 API 错误，尝试提取响应体
-                        error_body = getattr(e, 'body', None) or str(e)
-                        last_raw_response = f"API Error Body: {error_body}"
-                        last_error_msg = f"API 错误：{str(e)}"
-                        write_log(f"API 错误 (尝试 {attempt+1}/{total_attempts}): {last_error_msg}")
-                        if attempt == total_attempts - 1:
-                            raise e
-                        # 短暂等待后重试
-                        await asyncio.sleep(2 ** attempt)
-                    except Exception as e:
-                        last_error_msg = f"处理逻辑错误：{str(e)}"
-                        write_log(f"处理逻辑错误 (尝试 {attempt+1}/{total_attempts}): {last_error_msg}")
-                        if attempt == total_attempts - 1:
-                            raise e
-
-                if final_content:
-                    # === 新增逻辑：页码 Null 填充 ===
+                if not content:
+                    record_wasted(stats, response)
+                    write_log(f"模型返回空内容 (尝试 {attempt+1}/{total_attempts})")
+                    if attempt == total_attempts - 1:
+                        raise Exception("模型持续返回空内容")
+                    continue
+
+                if structured:
+                    # 类型化解析，失败直接重试，不做 CSV 修复
                     try:
-                        fixed_content = fix_null_page_numbers(final_content)
-                        with open(output_file, 'w', encoding='utf-8') as f:
-                            f.write(fixed_content)
-                        write_log(f"结果保存并修正页码成功：{output_file.name}")
-                    except Exception as post_err:
-                        write_log(f"页码修正过程出错，保存原始内容：{str(post_err)}")
-                        # 如果修正失败，至少保存原始验证通过的内容
-                        with open(output_file, 'w', encoding='utf-8') as f:
-                            f.write(final_content)
-
-                    print(f"已提取 CSV：{img_file.name}")
-                    return True
+                        processed_content = structured_output.entries_to_csv(
+                            structured_output.parse_entries(content, EXTRACT_FIELDS), EXTRACT_FIELDS)
+                        is_valid = True
+                    except ValueError as e:
+                        write_log(f"结构化输出解析失败：{e}")
+                        is_valid, processed_content = False, None
                 else:
-                    # 理论上不会到达这里，因为上面已经抛出异常或 break
-                    print(f"处理 {img_file.name} 失败，未达到有效内容标准")
-                    return False
+                    # 后处理验证与修复
+                    is_valid, processed_content = validate_and_fix_csv_content(content)
 
+                if is_valid:
+                    final_content = processed_content
+                    if attempt > 0:
+                        write_log(f"第 {attempt+1} 次尝试成功 (经过后处理修复)")
+                    break
+                else:
+                    record_wasted(stats, response)
+                    # 记录验证失败的原始内容
+                    last_error_msg = f"CSV 格式验证失败：行数或列数不符合 2 列要求。原始内容片段：{content[:200]}..."
+                    write_log(f"CSV 解析失败且修复无效 (尝试 {attempt+1}/{total_attempts})")
+                    if attempt == total_attempts - 1:
+                        raise Exception(last_error_msg)
+                    # 继续下一次重试循环，重新请求 LLM
+
+            except StreamAborted as e:
+                stats['requests'] += 1
+                stats['stream_aborts'] += 1
+                stats['wasted_completion_tokens'] += e.chunks
+                last_raw_response = e.content
+                last_error_msg = f"流式输出校验失败：{e.reason}"
+                write_log(f"流式输出校验失败，提前中止 (尝试 {attempt+1}/{total_attempts}，已接收 {e.chunks} 个片段): {e.reason}")
+                if attempt == total_attempts - 1:
+                    raise e
+            except APIError as e:
+                # 捕获 API 错误，尝试提取响应体
+                error_body = getattr(e, 'body', None) or str(e)
+                last_raw_response = f"API Error Body: {error_body}"
+                last_error_msg = f"API 错误：{str(e)}"
+                write_log(f"API 错误 (尝试 {attempt+1}/{total_attempts}): {last_error_msg}")
+                if attempt == total_attempts - 1:
+                    raise e
+                # 短暂等待后重试
+                await asyncio.sleep(2 ** attempt)
             except Exception as e:
-                # === 核心修改：记录详细错误日志和原始响应 ===
-                error_details = {
-                    "file": img_file.name,
-                    "error_type": type(e).__name__,
-                    "error_message": str(e),
-                    "raw_response": last_raw_response if last_raw_response else "No response received",
-                    "last_error_context": last_error_msg if last_error_msg else "Unknown context"
-                }
-
-                log_entry = (
-                    f"=== CSV 解析失败报告 ===\n"
-                    f"文件：{error_details['file']}\n"
-                    f"错误类型：{error_details['error_type']}\n"
-                    f"错误信息：{error_details['error_message']}\n"
-                    f"上下文：{error_details['last_error_context']}\n"
-                    f"原始响应内容:\n{error_details['raw_response']}\n"
-                    f"========================\n"
-                )
+                last_error_msg = f"处理逻辑错误：{str(e)}"
+                write_log(f"处理逻辑错误 (尝试 {attempt+1}/{total_attempts}): {last_error_msg}")
+                if attempt == total_attempts - 1:
+                    raise e
 
-                write_log(log_entry)
-                traceback.print_exc()
-                return False
+        if final_content:
+            # === 新增逻辑：页码 Null 填充 ===
+            save_page_csv(img_file, output_file, final_content, input_hash, manifest)
+
+            print(f"已提取 CSV：{img_file.name}")
+            return True
+        else:
+            # 理论上不会到达这里，因为上面已经抛出异常或 break
+            print(f"处理 {img_file.name} 失败，未达到有效内容标准")
+            return False
+
+    except Exception as e:
+        # === 核心修改：记录详细错误日志和原始响应 ===
+        error_details = {
+            "file": img_file.name,
+            "error_type": type(e).__name__,
+            "error_message": str(e),
+            "raw_response": last_raw_response if last_raw_response else "No response received",
+            "last_error_context": last_error_msg if last_error_msg else "Unknown context"
+        }
+
+        log_entry = (
+            f"=== CSV 解析失败报告 ===\n"
+            f"文件：{error_details['file']}\n"
+            f"错误类型：{error_details['error_type']}\n"
+            f"错误信息：{error_details['error_message']}\n"
+            f"上下文：{error_details['last_error_context']}\n"
+            f"原始响应内容:\n{error_details['raw_response']}\n"
+            f"========================\n"
+        )
+
+        write_log(log_entry)
+        traceback.print_exc()
+        return False
+
+async def request_batch_csv(img_files: list, client: AsyncOpenAI, model: str, images: ImagePrefetcher, stats: dict = None):
+    """一次请求提取多张连续目录页，返回与 img_files 一一对应的 CSV 列表；响应未通过校验时返回 None"""
+    count = len(img_files)
+    content_list = [{"type": "text", "text": f"以下为 {count} 张连续的目录页图片（需处理）："}]
+    for index, img_file in enumerate(img_files, start=1):
+        content_list.append({"type": "text", "text": f"第 {index} 张："})
+        content_list.append({"type": "image_url", "image_url": {"url": await images.get(img_file)}})
+    content_list.append({"type": "text", "text": PROMPT_TEXT + BATCH_NOTE.format(count=count)})
+    content_list.append({"type": "text", "text": IMPORTANT_NOTE})
+
+    response = await chat_completion(client,
+        model=model,
+        messages=[{"role": "user", "content": content_list}],
+        temperature=0,
+        extra_body={"enable_thinking": False},
+        cache_validate=lambda content: split_batch_response(content, count) is not None
+    )
+    record_usage(stats, response)
+    raw_content = response.choices[0].message.content or ""
+    sections = split_batch_response(raw_content, count)
+    if sections is None:
+        write_log(f"批量提取响应未通过校验（{img_files[0].name} 起 {count} 页），原始内容片段：{raw_content[:200]}...")
+    return sections
+
+async def process_batch_async(semaphore: asyncio.Semaphore, batch: list, client: AsyncOpenAI, model: str, manifest: StageManifest, images: ImagePrefetcher, stats: dict, on_page_done=None):
+    """
+    batch: [(img_file, output_file, input_hash)]，均为需要视觉模型的页面。
+    整批请求失败或输出不合法时，释放并发名额后逐页重新请求（逐页请求各自占用名额）。
+    """
+    img_files = [img_file for img_file, _, _ in batch]
+    sections = None
+    async with semaphore:
+        stats['batches'] += 1
+        write_log(f"批量提取 {len(batch)} 页：{', '.join(f.name for f in img_files)}")
+        try:
+            sections = await request_batch_csv(img_files, client, model, images, stats)
+        except Exception as e:
+            write_log(f"批量提取请求失败（{img_files[0].name} 起 {len(batch)} 页）：{e}")
+
+    if sections is not None:
+        for (img_file, output_file, input_hash), content in zip(batch, sections):
+            save_page_csv(img_file, output_file, content, input_hash, manifest)
+            print(f"已提取 CSV：{img_file.name}")
+            if on_page_done:
+                on_page_done(img_file, True)
+        return [True] * len(batch)
+
+    stats['batch_fallbacks'] += 1
+    write_log(f"改为逐页提取：{', '.join(f.name for f in img_files)}")
+
+    async def fallback(img_file, output_file, input_hash):
+        result = False
+        try:
+            async with semaphore:
+                result = await extract_page_with_model(img_file, output_file, input_hash, client, model, manifest, images, stats)
+            return result
         finally:
-            IMAGE_CACHE.pop(img_file, None)
+            if on_page_done:
+                on_page_done(img_file, result is not False)
 
-async def run_batch_processing(image_files: list, output_path: Path):
-    write_log("正在预处理并缓存图片...")
-    # 预加载图片到内存，避免在处理时频繁读取磁盘
-    for img in image_files:
-        get_encoded_image(img)
-    
+    return await asyncio.gather(*(fallback(*item) for item in batch), return_exceptions=True)
+
+async def run_batch_processing(image_files: list, output_path: Path, client: AsyncOpenAI, model: str, manifest: StageManifest, on_page_done=None, text_pages=None):
+    """
+    on_page_done: 可选，callable(img_file, ok)；每页处理结束（含跳过）后立即调用，
+    供流水线模式在该页 CSV 写出后马上发出层级判定请求。
+    text_pages: 可选，{图片名: TextLayerPage}，见 load_text_layer_pages
+    返回请求次数与 token 用量（见 new_usage_stats）
+    """
+    text_pages = text_pages or {}
+    if EXTRACT_BATCH_SIZE > 1 and batch_size() == 1:
+        warn_msg = (f"EXTRACT_BATCH_SIZE={EXTRACT_BATCH_SIZE} 不支持"
+                    f"{'结构化输出' if structured_output.enabled() else '流式校验'}，改为逐页请求")
+        print(f"[WARNING] {warn_msg}")
+        write_log(warn_msg)
+    text_layer_count = sum(1 for page in text_pages.values() if page.confident)
+    if text_layer_count:
+        info_msg = f"文字层可信的页面：{text_layer_count}/{len(image_files)}，这些页面不再调用视觉模型"
+        print(info_msg)
+        write_log(info_msg)
+
+    # 目录页范围变化后，清理不再存在的页面遗留的 CSV
+    manifest.prune_units(STAGE_NAME, [img.name for img in image_files])
     semaphore = asyncio.Semaphore(CONCURRENT_LIMIT)
+    stats = new_usage_stats()
+    started = time.perf_counter()
     
-    tasks = []
+    # 跳过与文字层页面先行完成，其余页面按顺序每 batch_size() 页（默认 1 页）发送一次请求
+    results = []
+    pending = []
     for img_file in image_files:
-        tasks.append(process_image_async(semaphore, img_file, output_path))
+        output_file = output_path / f"{img_file.stem}.csv"
+        result, input_hash = prepare_page(img_file, output_file, model, manifest, text_pages.get(img_file.name))
+        if result is False:
+            pending.append((img_file, output_file, input_hash))
+            continue
+        results.append(result)
+        if on_page_done:
+            on_page_done(img_file, True)
+
+    # 图片按请求顺序有界预取，不再在发出首个请求前编码全部页面
+    stats['pages'] = len(pending)
+    images = ImagePrefetcher([img_file for img_file, _, _ in pending]).start()
+
+    async def process_and_notify(img_file, output_file, input_hash):
+        result = False
+        try:
+            async with semaphore:
+                result = await extract_page_with_model(img_file, output_file, input_hash, client, model, manifest, images, stats)
+            return result
+        finally:
+            if on_page_done:
+                on_page_done(img_file, result is not False)
 
-    results = await asyncio.gather(*tasks, return_exceptions=True)
+    size = batch_size()
+    batches = [pending[i:i + size] for i in range(0, len(pending), size)]
+    tasks = [process_batch_async(semaphore, batch, client, model, manifest, images, stats, on_page_done)
+             if len(batch) > 1 else process_and_notify(*batch[0]) for batch in batches]
+    try:
+        for batch_results in await asyncio.gather(*tasks, return_exceptions=True):
+            results.extend(batch_results if isinstance(batch_results, list) else [batch_results])
+    finally:
+        await images.close()
+    if pending:
+        write_log(images.summary())
     success_count = sum(1 for r in results if r is True)
     print(f"CSV 提取完成，成功：{success_count}/{len(image_files)}")
+    stats['elapsed'] = round(time.perf_counter() - started, 2)
+    write_log(f"提取用量：{stats['pages']} 页，每批 {size} 页，请求 {stats['requests']} 次（批量 {stats['batches']}，回退逐页 {stats['batch_fallbacks']} 批，"
+              f"输出格式 {structured_output.LLM_OUTPUT_MODE}，内容不合格重发 {stats['retries']} 次），输入 token {stats['prompt_tokens']}，输出 token {stats['completion_tokens']}，耗时 {stats['elapsed']}s")
+    if stats['first_row_ms']:
+        write_log(f"逐页请求{'（流式）' if EXTRACT_STREAM else ''}：首行可用中位数 {median(stats['first_row_ms'])}ms，"
+                  f"提前中止 {stats['stream_aborts']} 次，丢弃的输出 token {stats['wasted_completion_tokens']}")
+    if llm_hedge.LLM_HEDGE_ENABLED:
+        write_log(llm_hedge.hedge_policy(llm_routes.EXTRACT).summary())
+    return stats
+
+
+async def extract_csv(input_path: Path, output_path: Path, llm_config: dict, on_page_done=None):
+    """逐页（或按 EXTRACT_BATCH_SIZE 成批）提取目录图片中的 title,page_number 并保存为 CSV，返回用量统计（on_page_done 见 run_batch_processing）"""
+    input_path = Path(input_path)
+    output_path = Path(output_path)
+
+    # 初始化 OpenAI 客户端 (兼容模式)，模型按 routes 中的 extract 类别选择
+    client, model = llm_routes.routed_clients(llm_config, (llm_routes.EXTRACT,))[llm_routes.EXTRACT]
+    
+    if not input_path.exists():
+        print(f"错误：输入路径不存在 {input_path}")
+        raise StageError(f"输入路径不存在 {input_path}")
+        
+    output_path.mkdir(parents=True, exist_ok=True)
+    image_files = sorted([f for f in input_path.iterdir() if f.is_file() and f.suffix.lower() in IMAGE_EXTENSIONS], key=lambda x: natural_sort_key(x.name))
+    
+    if image_files:
+        base_dir = get_session_base_dir() or output_path.parent
+        manifest = StageManifest(base_dir)
+        text_pages = await asyncio.to_thread(load_text_layer_pages, image_files, base_dir)
+        return await run_batch_processing(image_files, output_path, client, model, manifest, on_page_done, text_pages)
+    print("未找到需要处理的图片。")
+    return new_usage_stats()
 
-    # 处理完成后清空图片缓存，释放内存
-    IMAGE_CACHE.clear()
+def run_stage(input_dir, output_dir, llm_config: dict):
+    """阶段入口：供 app.py 在常驻进程内直接调用"""
+    run_async(extract_csv(input_dir, output_dir, llm_config))
 
 async def main_async():
-    global client, LLM_CONFIG
-    
     load_dotenv()
-    LLM_CONFIG = load_llm_config()
-    
-    # 初始化 OpenAI 客户端 (兼容模式)
-    client = AsyncOpenAI(
-        api_key=LLM_CONFIG["api_key"],
-        base_url=LLM_CONFIG["base_url"]
-    )
+    llm_config = load_llm_config()
     
     base_dir = os.getenv("BASE_DIR")
     if base_dir:
@@ -477,20 +818,13 @@ async def main_async():
             
         input_path = Path(input_path_str)
         output_path = Path(output_path_str)
-    
-    if not input_path.exists():
-        print(f"错误：输入路径不存在 {input_path}")
-        sys.exit(1)
-        
-    output_path.mkdir(parents=True, exist_ok=True)
-    image_files = sorted([f for f in input_path.iterdir() if f.is_file() and f.suffix.lower() in IMAGE_EXTENSIONS], key=lambda x: natural_sort_key(x.name))
-    
-    if image_files:
-        await run_batch_processing(image_files, output_path)
-    else:
-        print("未找到需要处理的图片。")
+
+    await extract_csv(input_path, output_path, llm_config)
 
 if __name__ == "__main__":
     if sys.platform == 'win32':
         asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
-    asyncio.run(main_async())
\ No newline at end of file
+    try:
+        asyncio.run(main_async())
+    except StageError:
+        sys.exit(1)
\ No newline at end of file
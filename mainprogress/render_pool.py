@@ -0,0 +1,206 @@
+import os
+import io
+import base64
+import asyncio
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import fitz  # PyMuPDF
+from PIL import Image, ImageDraw, ImageFont
+
+from mainprogress.page_render_cache import PageRenderCache, render_cache, zoom_for_long_edge
+from mainprogress.page_artifacts import encode_request_jpeg
+
+# 多进程页面光栅化：PyMuPDF 渲染是 CPU 密集型操作且 Document 对象不能跨线程共享，
+# 因此每个工作进程各自打开 PDF，渲染分配给它的一段连续页面并直接编码为请求用 JPEG。
+# 进程池常驻复用；使用 spawn 方式启动，避免在多线程的 Flask 进程中 fork。
+# 协程中的渲染与编码通过 run_in_pool 提交到同一个进程池，事件循环不再被同步的光栅化阻塞。
+# 工作进程各自的渲染缓存只用于同一进程内的重复渲染，使用远小于主进程的上限；
+# 按请求分辨率光栅化的页面编码为请求 JPEG 交回主进程的渲染缓存，pdf_to_image 不再重新渲染。
+RENDER_WORKERS = int(os.getenv('RENDER_WORKERS', str(min(4, os.cpu_count() or 1))))
+RENDER_WORKER_CACHE_MAX_BYTES = int(os.getenv('RENDER_WORKER_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+REQUEST_LONG_EDGE = 1500  # 目录页请求图片（及 pdf_to_image 输出）的长边像素
+WORKER_MAX_DOCUMENTS = 4  # 每个工作进程保持打开的 PDF 数量上限
+
+_pool = None
+_pool_lock = threading.Lock()
+# 仅在工作进程中使用：路径 -> ((大小, 修改时间), Document)
+_worker_documents = OrderedDict()
+_worker_cache = None
+
+
+def pool_started() -> bool:
+    """进程池是否已经启动（此时提交少量页面也不必再承担进程启动开销）"""
+    return _pool is not None
+
+
+def get_render_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=RENDER_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+        return _pool
+
+
+def shutdown_render_pool():
+    """关闭进程池（工作进程中的 Document 与渲染缓存随之释放），下次使用时重新启动"""
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=True)
+
+
+async def run_in_pool(func, *args):
+    """在渲染进程池中执行 func(*args)；func 及其参数、返回值需可被 pickle"""
+    return await asyncio.get_running_loop().run_in_executor(get_render_pool(), func, *args)
+
+
+def worker_render_cache() -> PageRenderCache:
+    """工作进程中使用的渲染缓存（不溢出到磁盘）"""
+    global _worker_cache
+    if _worker_cache is None:
+        _worker_cache = PageRenderCache(max_bytes=RENDER_WORKER_CACHE_MAX_BYTES, spill=False)
+    return _worker_cache
+
+
+def worker_document(pdf_path):
+    """工作进程中执行：复用本进程已打开的 Document（PyMuPDF 对象不能跨线程共享，每个进程各持一份），文件变化后重新打开"""
+    stat = os.stat(pdf_path)
+    version = (stat.st_size, stat.st_mtime_ns)
+    entry = _worker_documents.pop(pdf_path, None)
+    if entry is not None and entry[0] != version:
+        entry[1].close()
+        entry = None
+    if entry is None:
+        entry = (version, fitz.open(pdf_path))
+    _worker_documents[pdf_path] = entry
+    while len(_worker_documents) > WORKER_MAX_DOCUMENTS:
+        _, (_, old_doc) = _worker_documents.popitem(last=False)
+        old_doc.close()
+    return entry[1]
+
+
+def concat_pages_b64(pdf_path, page_numbers, save_path=None, target_long_edge=REQUEST_LONG_EDGE):
+    """
+    工作进程中执行：将指定物理页码的页面横向拼接为 JPG，并在每页底部标注 "PDFNumber 页码"。
+    返回 (base64, rendered)，rendered 为本次新光栅化且分辨率与请求图片一致的页面
+    [(页序号, 缩放比例, 宽, 高, 请求 JPEG 字节)]，由 concat_pages 登记到主进程的渲染缓存。
+    save_path 指定时同时写出图片文件；没有可渲染的页面时 base64 为 None。
+    """
+    doc = worker_document(pdf_path)
+    cache = worker_render_cache()
+    images = []
+    page_nums = []
+    rendered = []
+    for page_num in page_numbers:
+        if not 1 <= page_num <= len(doc):
+            continue
+        # 始终按目标长边缩放（小页面也会放大）；同一工作进程中重复渲染的页面直接取渲染缓存
+        zoom = zoom_for_long_edge(doc[page_num - 1], target_long_edge)
+        if zoom is None:
+            continue
+        fresh = not cache.contains(doc, page_num - 1, zoom)
+        pix = cache.get_pixmap(doc, page_num - 1, zoom)
+        img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+        if fresh and target_long_edge == REQUEST_LONG_EDGE:
+            rendered.append((page_num - 1, zoom, pix.width, pix.height, encode_request_jpeg(img)))
+        images.append(img)
+        page_nums.append(page_num)
+
+    if not images:
+        return None, rendered
+
+    max_h = max(img.height for img in images)
+    total_w = sum(img.width for img in images)
+    new_h = int(max_h * 1.2)
+
+    combined = Image.new("RGB", (total_w, new_h), "white")
+    draw = ImageDraw.Draw(combined)
+    try:
+        font = ImageFont.load_default(size=max(40, int(max_h * 0.05)))
+    except TypeError:
+        font = ImageFont.load_default()
+
+    current_x = 0
+    for img, page_num in zip(images, page_nums):
+        combined.paste(img, (current_x, 0))
+        text = f"PDFNumber {page_num}"
+        bbox = font.getbbox(text) if hasattr(font, 'getbbox') else draw.textbbox((0, 0), text, font=font)
+        text_w, text_h = bbox[2] - bbox[0], bbox[3] - bbox[1]
+        text_x = current_x + (img.width - text_w) // 2
+        text_y = max_h + (new_h - max_h) // 2 - text_h // 2
+        draw.text((text_x, text_y), text, fill="black", font=font)
+        current_x += img.width
+
+    buffered = io.BytesIO()
+    combined.save(buffered, format="JPEG", quality=85)
+    jpeg_bytes = buffered.getvalue()
+    if save_path:
+        with open(save_path, 'wb') as f:
+            f.write(jpeg_bytes)
+    return base64.b64encode(jpeg_bytes).decode('utf-8'), rendered
+
+
+async def concat_pages(pdf_path, page_numbers, save_path=None, target_long_edge=REQUEST_LONG_EDGE):
+    """在进程池中执行 concat_pages_b64，并把交回的页面登记到主进程的渲染缓存；返回 base64（无可渲染页面时为 None）"""
+    b64_img, rendered = await run_in_pool(concat_pages_b64, pdf_path, page_numbers, save_path, target_long_edge)
+    for page_index, zoom, width, height, jpeg_bytes in rendered:
+        render_cache.put_encoded(pdf_path, page_index, zoom, width, height, jpeg_bytes)
+    return b64_img
+
+
+def render_page_b64(pdf_path, page_index, target_long_edge):
+    """工作进程中执行：单页按目标长边渲染为 JPEG 并 base64 编码；页面尺寸为 0 时返回 None"""
+    pix = worker_render_cache().render_long_edge(worker_document(pdf_path), page_index, target_long_edge)
+    if pix is None:
+        return None
+    return base64.b64encode(pix.tobytes("jpeg")).decode('utf-8')
+
+
+def render_slice_to_jpeg(pdf_path, page_indices, target_long_edge):
+    """工作进程中执行：返回 [(页序号, 宽, 高, JPEG 字节)]，跳过尺寸为 0 的页面"""
+    results = []
+    doc = fitz.open(pdf_path)
+    try:
+        for page_index in page_indices:
+            page = doc[page_index]
+            zoom = zoom_for_long_edge(page, target_long_edge)
+            if zoom is None:
+                continue
+            pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+            img = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+            results.append((page_index, pix.width, pix.height, encode_request_jpeg(img)))
+    finally:
+        doc.close()
+    return results
+
+
+def split_slices(page_indices, workers):
+    """把页面平均切分为至多 workers 段连续区间"""
+    page_indices = list(page_indices)
+    count = min(workers, len(page_indices))
+    if count <= 0:
+        return []
+    size, extra = divmod(len(page_indices), count)
+    slices, start = [], 0
+    for i in range(count):
+        end = start + size + (1 if i < extra else 0)
+        slices.append(page_indices[start:end])
+        start = end
+    return slices
+
+
+def render_pages_to_jpeg(pdf_path, page_indices, target_long_edge, workers=None):
+    """在进程池中并行渲染，返回 {页序号: (宽, 高, JPEG 字节)}"""
+    workers = workers or RENDER_WORKERS
+    pool = get_render_pool()
+    futures = [pool.submit(render_slice_to_jpeg, pdf_path, chunk, target_long_edge)
+               for chunk in split_slices(page_indices, workers)]
+    results = {}
+    for future in futures:
+        for page_index, width, height, jpeg_bytes in future.result():
+            results[page_index] = (width, height, jpeg_bytes)
+    return results
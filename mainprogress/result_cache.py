@@ -0,0 +1,251 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+
+from mainprogress import llm_routes
+from mainprogress.stage_manifest import atomic_write_json
+
+# 整书结果缓存：以 PDF 内容的 SHA-256 + 模型名（含按调用类别路由的模型）+ 提示词版本为键，
+# 保存 content_postprocessor 的最终目录数据及目录页/偏移量等元数据。
+# 重复上传同一本书时直接恢复这些结果，跳过全部 LLM 阶段，只执行 pdf_generator。
+RESULT_CACHE_DIR = os.getenv('RESULT_CACHE_DIR', os.path.join('data', 'result_cache'))
+RESULT_CACHE_MAX_BYTES = int(os.getenv('RESULT_CACHE_MAX_BYTES', str(100 * 1024 * 1024)))
+
+# 修改任一阶段的提示词或解析逻辑后递增此版本号，旧缓存将全部失效。
+# 另外会对 qwen_vl_extract / determine_toc_levels 的提示词常量取指纹，修改它们时自动失效。
+PROMPT_VERSION = '1'
+
+ENTRY_FILENAME = 'entry.json'
+FINAL_FILENAME = 'final.json'
+METADATA_KEYS = ('toc_start', 'toc_end', 'content_start', 'book_name')
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def save_and_hash_upload(file_storage, dest_path) -> str:
+    """边写入磁盘边计算 SHA-256，避免上传后再整体读一遍文件"""
+    digest = hashlib.sha256()
+    with open(dest_path, 'wb') as f:
+        while True:
+            chunk = file_storage.stream.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            f.write(chunk)
+    return digest.hexdigest()
+
+
+def prompt_fingerprint() -> str:
+    """提示词（及文字层配置）版本指纹"""
+    from mainprogress import qwen_vl_extract, determine_toc_levels, text_layer, structured_output, stage_runner, fused_toc
+    digest = hashlib.sha256(PROMPT_VERSION.encode('utf-8'))
+    fused = fused_toc.fingerprint() if stage_runner.TOC_PIPELINE_MODE == stage_runner.TOC_PIPELINE_FUSED else ''
+    for text in (qwen_vl_extract.PROMPT_TEXT, qwen_vl_extract.IMPORTANT_NOTE, determine_toc_levels.PROMPT_TEXT,
+                 text_layer.engine_fingerprint(), qwen_vl_extract.batch_fingerprint(), structured_output.fingerprint(), fused):
+        digest.update(text.encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+
+def compute_cache_key(pdf_sha256, llm_config) -> str:
+    raw = f"{pdf_sha256}|{llm_routes.models_fingerprint(llm_config)}|{prompt_fingerprint()}"
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    """基于目录的缓存存储，总大小超过上限时按最近访问时间（LRU）淘汰"""
+
+    def __init__(self, root=RESULT_CACHE_DIR, max_bytes=RESULT_CACHE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def _entry_dir(self, key):
+        return os.path.join(self.root, key)
+
+    def _read_entry(self, key):
+        entry_path = os.path.join(self._entry_dir(key), ENTRY_FILENAME)
+        try:
+            with open(entry_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+
+    @staticmethod
+    def _write_json(path, data):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, path)
+
+    def lookup(self, key):
+        """命中时返回 (entry, final_data) 并刷新访问时间，否则返回 None"""
+        with self._lock:
+            entry = self._read_entry(key)
+            if not entry:
+                return None
+            try:
+                with open(os.path.join(self._entry_dir(key), FINAL_FILENAME), 'r', encoding='utf-8') as f:
+                    final_data = json.load(f)
+            except (OSError, json.JSONDecodeError):
+                shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+                return None
+            entry['last_access'] = time.time()
+            entry['hits'] = entry.get('hits', 0) + 1
+            self._write_json(os.path.join(self._entry_dir(key), ENTRY_FILENAME), entry)
+            return entry, final_data
+
+    def store(self, key, final_data, metadata, info=None):
+        with self._lock:
+            os.makedirs(self.root, exist_ok=True)
+            tmp_dir = self._entry_dir(key) + f'.tmp{threading.get_ident()}'
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            os.makedirs(tmp_dir)
+            self._write_json(os.path.join(tmp_dir, FINAL_FILENAME), final_data)
+            now = time.time()
+            entry = dict(info or {})
+            entry.update({
+                'metadata': metadata,
+                'prompt_fingerprint': prompt_fingerprint(),
+                'created': now,
+                'last_access': now,
+                'hits': 0,
+            })
+            self._write_json(os.path.join(tmp_dir, ENTRY_FILENAME), entry)
+            shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+            os.replace(tmp_dir, self._entry_dir(key))
+            self._evict_locked()
+
+    def _scan_locked(self):
+        """返回 [(key, entry, size_bytes)]"""
+        results = []
+        if not os.path.isdir(self.root):
+            return results
+        for key in os.listdir(self.root):
+            entry_dir = self._entry_dir(key)
+            if not os.path.isdir(entry_dir) or '.tmp' in key:
+                continue
+            size = sum(os.path.getsize(os.path.join(entry_dir, name)) for name in os.listdir(entry_dir))
+            results.append((key, self._read_entry(key), size))
+        return results
+
+    def _evict_locked(self):
+        entries = self._scan_locked()
+        current = prompt_fingerprint()
+        total = 0
+        kept = []
+        for key, entry, size in entries:
+            # 提示词已变更的条目永远不会再命中，直接清理
+            if not entry or entry.get('prompt_fingerprint') != current:
+                shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+                continue
+            kept.append((entry.get('last_access', 0), key, size))
+            total += size
+
+        kept.sort()
+        for _, key, size in kept:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+            total -= size
+
+    def invalidate(self, only_stale=False) -> int:
+        """清除缓存条目；only_stale=True 时只清除提示词版本不一致的条目。返回清除数量"""
+        with self._lock:
+            current = prompt_fingerprint()
+            removed = 0
+            for key, entry, _ in self._scan_locked():
+                if only_stale and entry and entry.get('prompt_fingerprint') == current:
+                    continue
+                shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+                removed += 1
+            return removed
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._scan_locked()
+            return {
+                'entries': len(entries),
+                'total_bytes': sum(size for _, _, size in entries),
+                'max_bytes': self.max_bytes,
+                'prompt_fingerprint': prompt_fingerprint(),
+            }
+
+
+result_cache = ResultCache()
+
+
+def _find_info_json(base_dir):
+    """返回 session 中与 PDF 同名的 info JSON 路径"""
+    input_dir = os.path.join(base_dir, 'input_pdf')
+    pdf_files = [f for f in os.listdir(input_dir) if f.lower().endswith('.pdf')]
+    if len(pdf_files) != 1:
+        return None
+    json_path = os.path.join(input_dir, os.path.splitext(pdf_files[0])[0] + '.json')
+    return json_path if os.path.exists(json_path) else None
+
+
+def restore_session(base_dir, llm_config) -> bool:
+    """
+    若该 session 的 PDF 已有缓存结果，则写回目录元数据和 *_final.json。
+    返回 True 表示可以直接执行 pdf_generator。
+    """
+    json_path = _find_info_json(base_dir)
+    if not json_path:
+        return False
+    with open(json_path, 'r', encoding='utf-8') as f:
+        info_data = json.load(f)
+    pdf_sha256 = info_data.get('pdf_sha256')
+    if not pdf_sha256:
+        return False
+
+    hit = result_cache.lookup(compute_cache_key(pdf_sha256, llm_config))
+    if not hit:
+        return False
+    entry, final_data = hit
+
+    info_data.update({k: v for k, v in entry['metadata'].items() if k in METADATA_KEYS})
+    info_data['result_cache_hit'] = True
+
+    # pdf_generator 要求恰好一个 *_final.json，先删除之前运行留下的（可能文件名不同）
+    output_dir = os.path.join(base_dir, 'level_adjusted_content')
+    os.makedirs(output_dir, exist_ok=True)
+    for name in os.listdir(output_dir):
+        if name.endswith('_final.json'):
+            os.remove(os.path.join(output_dir, name))
+    pdf_stem = os.path.splitext(os.path.basename(json_path))[0]
+    book_title = pdf_stem.split('_')[0] or 'booktitle'
+    atomic_write_json(os.path.join(output_dir, f"{book_title}_final.json"), final_data)
+    atomic_write_json(json_path, info_data, indent=4)
+    return True
+
+
+def save_session(base_dir, llm_config) -> bool:
+    """在整条流水线成功后，将该 session 的结果写入缓存"""
+    json_path = _find_info_json(base_dir)
+    if not json_path:
+        return False
+    with open(json_path, 'r', encoding='utf-8') as f:
+        info_data = json.load(f)
+    pdf_sha256 = info_data.get('pdf_sha256')
+    if not pdf_sha256 or info_data.get('result_cache_hit'):
+        return False
+
+    output_dir = os.path.join(base_dir, 'level_adjusted_content')
+    final_files = [f for f in os.listdir(output_dir) if f.endswith('_final.json')] if os.path.isdir(output_dir) else []
+    if len(final_files) != 1:
+        return False
+    with open(os.path.join(output_dir, final_files[0]), 'r', encoding='utf-8') as f:
+        final_data = json.load(f)
+    if not final_data:
+        return False
+
+    result_cache.store(
+        compute_cache_key(pdf_sha256, llm_config),
+        final_data,
+        {k: info_data.get(k) for k in METADATA_KEYS},
+        {'pdf_sha256': pdf_sha256, 'model': llm_routes.models_fingerprint(llm_config),
+         'original_filename': info_data.get('original_filename')},
+    )
+    return True
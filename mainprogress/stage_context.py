@@ -0,0 +1,82 @@
+import os
+import asyncio
+import threading
+import contextvars
+
+# 当前阶段所属的 session 目录。
+# 子进程模式下通过环境变量 BASE_DIR 传入；进程内模式下多个 session 共用一个进程，
+# 因此改用 ContextVar 按线程/协程隔离，避免互相覆盖环境变量。
+SESSION_BASE_DIR = contextvars.ContextVar("session_base_dir", default=None)
+# 进程内模式下当前阶段的取消句柄（子进程模式下为 None，超时由父进程直接结束子进程）
+STAGE_CANCEL = contextvars.ContextVar("stage_cancel", default=None)
+
+
+class StageError(RuntimeError):
+    """阶段执行失败（对应子进程模式下的 sys.exit(1)）"""
+
+
+class StageCancelToken:
+    """
+    进程内模式下阶段的协作式取消句柄：阶段超时后由调用方执行 cancel()，取消 run_async 登记的主协程任务。
+    不经过 run_async 的同步阶段无法取消，由 stage_runner 将其占用的工作线程记为不可用。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cancelled = False
+        self._loop = None
+        self._task = None
+
+    def cancel(self):
+        with self._lock:
+            self._cancelled = True
+            if self._task is not None:
+                self._loop.call_soon_threadsafe(self._task.cancel)
+
+    def attach(self, loop, task) -> bool:
+        """登记阶段事件循环中的主任务；已取消时返回 False"""
+        with self._lock:
+            if self._cancelled:
+                return False
+            self._loop, self._task = loop, task
+            return True
+
+    def detach(self):
+        with self._lock:
+            self._loop = self._task = None
+
+
+def run_async(coro):
+    """
+    代替 asyncio.run 执行阶段主协程。
+    进程内模式下超时取消会取消主任务（其中的 LLM 请求与渲染等待随之取消），并以 StageError 结束阶段。
+    """
+    token = STAGE_CANCEL.get()
+    if token is None:
+        return asyncio.run(coro)
+
+    async def main():
+        if not token.attach(asyncio.get_running_loop(), asyncio.current_task()):
+            coro.close()
+            raise asyncio.CancelledError()
+        try:
+            return await coro
+        finally:
+            token.detach()
+
+    try:
+        return asyncio.run(main())
+    except asyncio.CancelledError:
+        raise StageError("阶段执行超时，已取消") from None
+
+
+def get_session_base_dir():
+    """获取当前阶段的 session 目录，优先使用进程内设置的上下文"""
+    return SESSION_BASE_DIR.get() or os.getenv("BASE_DIR")
+
+
+def resolve_config_value(val):
+    """解析 $ENV_NAME$ 形式的配置值"""
+    if isinstance(val, str) and val.startswith('$') and val.endswith('$'):
+        return os.environ.get(val[1:-1], "")
+    return val
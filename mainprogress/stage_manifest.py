@@ -0,0 +1,222 @@
+import os
+import glob
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+# 阶段清单：每个 session 目录下一份 stage_manifest.json，记录各阶段（以及逐页任务）的
+# 输入哈希、输出文件哈希和完成状态。重跑失败的作业时，只有输入变化或输出缺失/被改动的
+# 阶段和页面才会重新计算；上游输出变化会改变下游的输入哈希，下游随之自动失效。
+MANIFEST_FILENAME = 'stage_manifest.json'
+MANIFEST_VERSION = 1
+
+# 阶段状态
+STAGE_RUNNING = 'running'
+STAGE_COMPLETED = 'completed'
+STAGE_FAILED = 'failed'
+
+# 各阶段的 (输入文件, 输出文件)，均为相对 session 目录的 glob
+STAGE_FILES = {
+    'pdf_metadata_extractor': (['input_pdf/*.pdf'], ['input_pdf/*.json']),
+    'pdf_to_image': (['input_pdf/*.pdf', 'input_pdf/*.json'], ['mark/input_image/*.jpg']),
+    'qwen_vl_extract': (['mark/input_image/*.jpg'], ['raw_content/*.csv']),
+    'determine_toc_levels': (['mark/input_image/*.jpg', 'raw_content/*.csv'], ['raw_content/*_merged.json']),
+    'content_postprocessor': (['raw_content/*.json'], ['level_adjusted_content/*_final.json']),
+    'pdf_generator': (['level_adjusted_content/*_final.json', 'input_pdf/*.pdf', 'input_pdf/*.json'], ['output_pdf/*.pdf']),
+}
+
+HASH_CHUNK_SIZE = 1024 * 1024
+# 文件哈希缓存的条目上限（按最近使用淘汰）；常驻进程会处理大量 session，不能无限增长
+FILE_HASH_CACHE_MAX_ENTRIES = int(os.getenv('FILE_HASH_CACHE_MAX_ENTRIES', '4096'))
+
+_locks = {}
+_locks_guard = threading.Lock()
+# (path, size, mtime_ns) -> sha256，避免每个阶段都重新读取整本 PDF
+_file_hash_cache = OrderedDict()
+_file_hash_lock = threading.Lock()
+
+
+def _get_lock(path):
+    with _locks_guard:
+        return _locks.setdefault(path, threading.Lock())
+
+
+def atomic_write_text(path, text):
+    """先写同目录下的临时文件再替换，保证读到的文件要么是旧内容要么是完整的新内容"""
+    tmp_path = f"{path}.tmp{os.getpid()}_{threading.get_ident()}"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def atomic_write_json(path, data, indent=2):
+    atomic_write_text(path, json.dumps(data, ensure_ascii=False, indent=indent))
+
+
+def file_sha256(path) -> str:
+    stat = os.stat(path)
+    cache_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    with _file_hash_lock:
+        cached = _file_hash_cache.get(cache_key)
+        if cached:
+            _file_hash_cache.move_to_end(cache_key)
+            return cached
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+    with _file_hash_lock:
+        _file_hash_cache[cache_key] = digest.hexdigest()
+        while len(_file_hash_cache) > FILE_HASH_CACHE_MAX_ENTRIES:
+            _file_hash_cache.popitem(last=False)
+    return digest.hexdigest()
+
+
+def hash_values(*values) -> str:
+    """对若干值（字符串、数字、None 等）计算组合哈希，用作逐页任务的输入哈希"""
+    raw = json.dumps(values, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class StageManifest:
+    """
+    每次读写都加锁并重新读取文件，因此 app 中的阶段级记录与阶段内部的逐页记录
+    可以使用各自的实例；所有写入均为原子替换。
+    """
+
+    def __init__(self, base_dir):
+        self.base_dir = os.path.abspath(base_dir)
+        self.path = os.path.join(self.base_dir, MANIFEST_FILENAME)
+        self._lock = _get_lock(self.path)
+
+    # ---------- 读写 ----------
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') == MANIFEST_VERSION:
+                return data
+        except (OSError, json.JSONDecodeError):
+            pass
+        return {'version': MANIFEST_VERSION, 'stages': {}}
+
+    def _save(self, data):
+        os.makedirs(self.base_dir, exist_ok=True)
+        atomic_write_json(self.path, data)
+
+    def _rel(self, path):
+        return os.path.relpath(os.path.abspath(path), self.base_dir).replace(os.sep, '/')
+
+    def _abs(self, rel_path):
+        return os.path.join(self.base_dir, rel_path)
+
+    def _output_intact(self, rel_path, expected_hash) -> bool:
+        path = self._abs(rel_path)
+        try:
+            return os.path.isfile(path) and file_sha256(path) == expected_hash
+        except OSError:
+            return False
+
+    def _glob(self, patterns):
+        paths = set()
+        for pattern in patterns:
+            paths.update(p for p in glob.glob(os.path.join(self.base_dir, pattern)) if os.path.isfile(p))
+        return sorted(paths)
+
+    # ---------- 阶段级 ----------
+
+    def stage_input_hash(self, stage, extra=None) -> str:
+        """阶段输入文件的组合哈希；extra 用于混入模型名、提示词版本等非文件输入"""
+        input_patterns, _ = STAGE_FILES[stage]
+        entries = [(self._rel(p), file_sha256(p)) for p in self._glob(input_patterns)]
+        return hash_values(stage, entries, extra)
+
+    def is_stage_current(self, stage, input_hash) -> bool:
+        """阶段已完成、输入未变且记录的输出文件全部完好"""
+        with self._lock:
+            record = self._load()['stages'].get(stage)
+        if not record or record.get('state') != STAGE_COMPLETED or record.get('input_hash') != input_hash:
+            return False
+        return all(self._output_intact(rel, h) for rel, h in record.get('outputs', {}).items())
+
+    def begin_stage(self, stage, input_hash):
+        with self._lock:
+            data = self._load()
+            record = data['stages'].setdefault(stage, {})
+            record.update({'state': STAGE_RUNNING, 'input_hash': input_hash,
+                           'started_at': time.time(), 'finished_at': None, 'error': None})
+            self._save(data)
+
+    def complete_stage(self, stage):
+        """记录阶段完成及当前全部输出文件的哈希"""
+        _, output_patterns = STAGE_FILES[stage]
+        outputs = {self._rel(p): file_sha256(p) for p in self._glob(output_patterns)}
+        with self._lock:
+            data = self._load()
+            record = data['stages'].setdefault(stage, {})
+            record.update({'state': STAGE_COMPLETED, 'outputs': outputs, 'finished_at': time.time()})
+            self._save(data)
+
+    def fail_stage(self, stage, error=None):
+        with self._lock:
+            data = self._load()
+            record = data['stages'].setdefault(stage, {})
+            record.update({'state': STAGE_FAILED, 'finished_at': time.time(), 'error': error})
+            self._save(data)
+
+    # ---------- 逐页任务 ----------
+
+    def get_unit(self, stage, unit, input_hash):
+        """逐页任务输入未变且输出完好时返回其记录，否则返回 None"""
+        with self._lock:
+            record = self._load()['stages'].get(stage, {}).get('units', {}).get(unit)
+        if not record or record.get('input_hash') != input_hash:
+            return None
+        if not self._output_intact(record['output'], record.get('output_hash')):
+            return None
+        return record
+
+    def record_unit(self, stage, unit, input_hash, output_path, extra=None):
+        """输出文件写入完成后调用，记录该页的输入哈希与输出哈希"""
+        output_hash = file_sha256(output_path)
+        with self._lock:
+            data = self._load()
+            units = data['stages'].setdefault(stage, {}).setdefault('units', {})
+            units[unit] = {
+                'input_hash': input_hash,
+                'output': self._rel(output_path),
+                'output_hash': output_hash,
+                'extra': extra,
+                'finished_at': time.time(),
+            }
+            self._save(data)
+
+    def refresh_units(self, stage):
+        """阶段内的后处理改写了输出文件后调用，更新已记录的输出哈希"""
+        with self._lock:
+            data = self._load()
+            for record in data['stages'].get(stage, {}).get('units', {}).values():
+                path = self._abs(record['output'])
+                if os.path.isfile(path):
+                    record['output_hash'] = file_sha256(path)
+            self._save(data)
+
+    def prune_units(self, stage, keep):
+        """删除不在 keep 中的逐页记录及其输出文件（例如目录页范围缩小后遗留的页面）"""
+        keep = set(keep)
+        with self._lock:
+            data = self._load()
+            units = data['stages'].get(stage, {}).get('units', {})
+            for unit in [u for u in units if u not in keep]:
+                try:
+                    os.remove(self._abs(units[unit]['output']))
+                except OSError:
+                    pass
+                del units[unit]
+            self._save(data)
@@ -0,0 +1,236 @@
+import os
+import sys
+import io
+import json
+import asyncio
+import importlib
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+from mainprogress.stage_context import SESSION_BASE_DIR, STAGE_CANCEL, StageCancelToken, StageError, resolve_config_value
+from mainprogress import llm_routes
+
+# 在常驻进程内执行各阶段，避免每个阶段都重新启动解释器并重新导入 fitz/PIL/openai。
+# 子进程模式保留为后备方案：设置环境变量 STAGE_RUN_MODE=subprocess 即可切换回去。
+STAGE_RUN_MODE = os.getenv('STAGE_RUN_MODE', 'inprocess')
+STAGE_WORKERS = int(os.getenv('STAGE_WORKERS', '4'))
+# 阶段超时后先取消其主协程，等待该秒数仍未退出的阶段视为卡死：其工作线程不再可用，
+# 全部工作线程都被卡死阶段占用时 run_stage_inprocess 抛出 StagePoolExhausted，由调用方回退到子进程模式
+STAGE_CANCEL_GRACE = float(os.getenv('STAGE_CANCEL_GRACE', '10'))
+
+# 需要 LLM 配置的阶段
+LLM_STAGES = {'pdf_metadata_extractor', 'qwen_vl_extract', 'determine_toc_levels'}
+
+# 流水线模式（默认）：目录数据提取阶段改为执行 toc_pipeline，边提取边判定层级，
+# 随后的 determine_toc_levels 阶段只需逐页跳过并执行后处理。设置 TOC_PIPELINE_MODE=stage 恢复逐阶段执行。
+# 合并模式（TOC_PIPELINE_MODE=fused）：两个阶段都执行 fused_toc，每个目录页一次请求同时得到标题、页码与层级。
+TOC_PIPELINE_MODE = os.getenv('TOC_PIPELINE_MODE', 'stream')
+TOC_PIPELINE_STREAM = 'stream'
+TOC_PIPELINE_FUSED = 'fused'
+PIPELINED_STAGE_MODULES = {'qwen_vl_extract': 'toc_pipeline'}
+FUSED_STAGE_MODULES = {'qwen_vl_extract': 'fused_toc', 'determine_toc_levels': 'fused_toc'}
+
+# 各阶段 run_stage() 的参数名 -> 对应的环境变量名（子进程模式下通过环境变量传入同样的路径）
+STAGE_PATH_ARGS = {
+    'pdf_metadata_extractor': {'input_dir': 'PDF_METADATA_EXTRACTOR_INPUT', 'output_dir': 'PDF_METADATA_EXTRACTOR_OUTPUT'},
+    'pdf_to_image': {'input_dir': 'PDF2JPG_INPUT', 'output_dir': 'PDF2JPG_OUTPUT'},
+    'qwen_vl_extract': {'input_dir': 'QWEN_VL_EXTRACT_INPUT', 'output_dir': 'QWEN_VL_EXTRACT_OUTPUT'},
+    'determine_toc_levels': {'input_dir': 'QWEN_VL_EXTRACT_INPUT', 'output_dir': 'QWEN_VL_EXTRACT_OUTPUT'},
+    'content_postprocessor': {'input_dir': 'CONTENT_POSTPROCESSOR_INPUT', 'output_dir': 'CONTENT_POSTPROCESSOR_OUTPUT'},
+    'pdf_generator': {'content_dir': 'PDF_GENERATOR_INPUT_1', 'pdf_dir': 'PDF_GENERATOR_INPUT_2', 'output_dir': 'PDF_GENERATOR_OUTPUT_1'},
+}
+
+_executor = None
+_executor_lock = threading.Lock()
+_llm_config_cache = {}
+# 超时取消后仍在执行的阶段：future -> (script_name, base_dir)
+_hung_stages = {}
+_hung_lock = threading.Lock()
+
+
+class StagePoolExhausted(RuntimeError):
+    """全部工作线程都被超时后仍未退出的阶段占用"""
+
+
+def build_stage_env(base_dir):
+    """生成 session 内各阶段的输入输出路径（环境变量形式）"""
+    return {
+        'BASE_DIR': base_dir,
+        'PDF_METADATA_EXTRACTOR_INPUT': f"{base_dir}/input_pdf",
+        'PDF_METADATA_EXTRACTOR_OUTPUT': f"{base_dir}/input_pdf",
+        'PDF2JPG_INPUT': f"{base_dir}/input_pdf",
+        'PDF2JPG_OUTPUT': f"{base_dir}/mark/input_image",
+        'CONTENT_POSTPROCESSOR_INPUT': f"{base_dir}/raw_content",
+        'CONTENT_POSTPROCESSOR_OUTPUT': f"{base_dir}/level_adjusted_content",
+        'PDF_GENERATOR_INPUT_1': f"{base_dir}/level_adjusted_content",
+        'PDF_GENERATOR_INPUT_2': f"{base_dir}/input_pdf",
+        'PDF_GENERATOR_OUTPUT_1': f"{base_dir}/output_pdf",
+        'QWEN_VL_INPUT': f"{base_dir}/mark/input_image",
+        'QWEN_VL_OUTPUT': f"{base_dir}/automark_raw_data",
+        'QWEN_VL_EXTRACT_INPUT': f"{base_dir}/mark/input_image",
+        'QWEN_VL_EXTRACT_OUTPUT': f"{base_dir}/raw_content",
+    }
+
+
+def stage_module_name(script_name):
+    """阶段实际执行的模块名（进程内与子进程模式共用）"""
+    if TOC_PIPELINE_MODE == TOC_PIPELINE_STREAM:
+        return PIPELINED_STAGE_MODULES.get(script_name, script_name)
+    if TOC_PIPELINE_MODE == TOC_PIPELINE_FUSED:
+        return FUSED_STAGE_MODULES.get(script_name, script_name)
+    return script_name
+
+
+def load_llm_config(config_path):
+    """读取并解析 llm_config.json，按修改时间缓存，避免每个阶段重复读取"""
+    if not os.path.exists(config_path):
+        return None
+    mtime = os.path.getmtime(config_path)
+    cached = _llm_config_cache.get(config_path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    with open(config_path, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+    resolved = {
+        "api_key": resolve_config_value(config.get("api_key", "")),
+        "base_url": resolve_config_value(config.get("base_url", "https://dashscope.aliyuncs.com/compatible-mode/v1")),
+        "model": resolve_config_value(config.get("model", "qwen-vl-max")),
+        "routes": llm_routes.resolve_routes(config, resolve_config_value),
+    }
+    _llm_config_cache[config_path] = (mtime, resolved)
+    return resolved
+
+
+class _ThreadLocalStream(io.TextIOBase):
+    """按线程分流的输出流：阶段线程写入各自的缓冲区，其他线程照常输出到原始流"""
+
+    def __init__(self, original):
+        self._original = original
+        self._local = threading.local()
+
+    def start_capture(self):
+        self._local.buffer = io.StringIO()
+
+    def stop_capture(self) -> str:
+        buffer = getattr(self._local, 'buffer', None)
+        self._local.buffer = None
+        return buffer.getvalue() if buffer else ''
+
+    def write(self, text):
+        buffer = getattr(self._local, 'buffer', None)
+        if buffer is not None:
+            return buffer.write(text)
+        return self._original.write(text)
+
+    def flush(self):
+        if getattr(self._local, 'buffer', None) is None:
+            self._original.flush()
+
+    def __getattr__(self, name):
+        return getattr(self._original, name)
+
+
+def _install_output_capture():
+    if not isinstance(sys.stdout, _ThreadLocalStream):
+        sys.stdout = _ThreadLocalStream(sys.stdout)
+    if not isinstance(sys.stderr, _ThreadLocalStream):
+        sys.stderr = _ThreadLocalStream(sys.stderr)
+
+
+def warm_up():
+    """预先导入全部阶段模块，使 fitz/PIL/openai 等依赖常驻内存"""
+    _install_output_capture()
+    if sys.platform == 'win32':
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+    for script_name in STAGE_PATH_ARGS:
+        importlib.import_module(f'mainprogress.{stage_module_name(script_name)}')
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            warm_up()
+            _executor = ThreadPoolExecutor(max_workers=STAGE_WORKERS, thread_name_prefix='stage-worker')
+        return _executor
+
+
+def start_worker():
+    """启动常驻工作线程池（应用启动时调用，提前完成模块导入）"""
+    _get_executor()
+
+
+def _run_stage_in_thread(script_name, base_dir, llm_config, cancel_token):
+    """在工作线程中执行阶段，返回 (returncode, stdout, stderr)"""
+    module = importlib.import_module(f'mainprogress.{stage_module_name(script_name)}')
+    stage_env = build_stage_env(base_dir)
+    kwargs = {arg: stage_env[env_name] for arg, env_name in STAGE_PATH_ARGS[script_name].items()}
+    if script_name in LLM_STAGES:
+        kwargs['llm_config'] = llm_config
+
+    sys.stdout.start_capture()
+    sys.stderr.start_capture()
+    token = SESSION_BASE_DIR.set(base_dir)
+    cancel_reset = STAGE_CANCEL.set(cancel_token)
+    returncode = 0
+    try:
+        module.run_stage(**kwargs)
+    except StageError as e:
+        sys.stderr.write(f"{e}\n")
+        returncode = 1
+    except SystemExit as e:
+        returncode = e.code if isinstance(e.code, int) else 1
+    except Exception:
+        sys.stderr.write(traceback.format_exc())
+        returncode = 1
+    finally:
+        STAGE_CANCEL.reset(cancel_reset)
+        SESSION_BASE_DIR.reset(token)
+        stdout = sys.stdout.stop_capture()
+        stderr = sys.stderr.stop_capture()
+    return returncode, stdout, stderr
+
+
+def _mark_hung(future, script_name, base_dir):
+    """记录超时取消后仍未退出的阶段，阶段最终结束时自动移除"""
+    with _hung_lock:
+        _hung_stages[future] = (script_name, base_dir)
+
+    def release(done):
+        with _hung_lock:
+            _hung_stages.pop(done, None)
+
+    future.add_done_callback(release)
+
+
+def stage_alive(base_dir) -> bool:
+    """该 session 是否仍有超时取消后未退出的阶段"""
+    with _hung_lock:
+        return any(hung_base_dir == base_dir for _, hung_base_dir in _hung_stages.values())
+
+
+def run_stage_inprocess(script_name, base_dir, llm_config, timeout=None):
+    """
+    在常驻工作线程中执行一个阶段。
+    返回 (returncode, stdout, stderr)；超时时先取消阶段，再抛出 concurrent.futures.TimeoutError。
+    全部工作线程都被卡死的阶段占用时抛出 StagePoolExhausted。
+    """
+    if script_name in LLM_STAGES and not llm_config:
+        return 1, '', 'LLM 配置文件不存在或为空'
+    with _hung_lock:
+        if len(_hung_stages) >= STAGE_WORKERS:
+            raise StagePoolExhausted(f"{len(_hung_stages)} 个阶段超时取消后仍未退出，工作线程已全部占用")
+    cancel_token = StageCancelToken()
+    future = _get_executor().submit(_run_stage_in_thread, script_name, base_dir, llm_config, cancel_token)
+    try:
+        return future.result(timeout=timeout)
+    except FutureTimeoutError:
+        if not future.cancel():
+            cancel_token.cancel()
+            try:
+                future.result(timeout=STAGE_CANCEL_GRACE)
+            except FutureTimeoutError:
+                _mark_hung(future, script_name, base_dir)
+        raise
@@ -0,0 +1,105 @@
+import os
+import csv
+import json
+from io import StringIO
+
+# 结构化输出模式：对支持 response_format（JSON Schema）的服务端，目录提取与层级判定要求模型按 Schema 返回 JSON，
+# 由类型化解析器直接得到条目，不再经过全角逗号、多余列等 CSV 修复逻辑。
+# 解析结果仍转换为标准 CSV 写出，下游阶段与 Few-shot 示例不受影响。
+# - csv（默认）：自由格式 CSV + 修复；
+# - json_schema：response_format={"type": "json_schema", ...}，需服务端支持（如 OpenAI、部分兼容接口）。
+LLM_OUTPUT_MODE = os.getenv('LLM_OUTPUT_MODE', 'csv')
+OUTPUT_MODE_CSV = 'csv'
+OUTPUT_MODE_JSON_SCHEMA = 'json_schema'
+
+EXTRACT_FIELDS = ('title', 'page_number')
+LEVEL_FIELDS = ('title', 'page_number', 'level')
+
+STRUCTURED_NOTE = """
+# 输出格式（结构化模式，优先于上文的 CSV 要求）
+按给定的 JSON Schema 输出一个对象，entries 数组按目录顺序列出每个条目，字段为 {fields}。
+page_number 为整数，无法推算时为 null；其余提取与判定规则不变。
+"""
+
+
+def enabled() -> bool:
+    return LLM_OUTPUT_MODE == OUTPUT_MODE_JSON_SCHEMA
+
+
+def fingerprint() -> str:
+    """参与逐页输入哈希与结果缓存键；CSV 模式下为空，沿用原有的键"""
+    return f"output={LLM_OUTPUT_MODE}" if enabled() else ''
+
+
+def note(fields) -> str:
+    return STRUCTURED_NOTE.format(fields='、'.join(fields))
+
+
+def response_format(name, fields) -> dict:
+    """entries 数组的 JSON Schema（strict 模式要求列出全部字段且不允许额外字段）"""
+    properties = {
+        'title': {'type': 'string'},
+        'page_number': {'type': ['integer', 'null']},
+        'level': {'type': 'integer'},
+    }
+    item = {
+        'type': 'object',
+        'properties': {field: properties[field] for field in fields},
+        'required': list(fields),
+        'additionalProperties': False,
+    }
+    schema = {
+        'type': 'object',
+        'properties': {'entries': {'type': 'array', 'items': item}},
+        'required': ['entries'],
+        'additionalProperties': False,
+    }
+    return {'type': 'json_schema', 'json_schema': {'name': name, 'strict': True, 'schema': schema}}
+
+
+def parse_entries(content: str, fields) -> list:
+    """按 Schema 解析响应，返回 [{字段: 值}]；结构或类型不符时抛出 ValueError"""
+    try:
+        data = json.loads(content)
+    except (TypeError, json.JSONDecodeError) as e:
+        raise ValueError(f"响应不是合法的 JSON：{e}") from e
+    entries = data.get('entries') if isinstance(data, dict) else None
+    if not isinstance(entries, list):
+        raise ValueError("响应缺少 entries 数组")
+    parsed = []
+    for index, entry in enumerate(entries):
+        if not isinstance(entry, dict):
+            raise ValueError(f"第 {index + 1} 个条目不是对象")
+        title = entry.get('title')
+        if not isinstance(title, str):
+            raise ValueError(f"第 {index + 1} 个条目的 title 不是字符串")
+        page_number = entry.get('page_number')
+        if page_number is not None and (isinstance(page_number, bool) or not isinstance(page_number, int)):
+            raise ValueError(f"第 {index + 1} 个条目的 page_number 不是整数")
+        item = {'title': title.strip(), 'page_number': page_number}
+        if 'level' in fields:
+            level = entry.get('level')
+            if isinstance(level, bool) or not isinstance(level, int):
+                raise ValueError(f"第 {index + 1} 个条目的 level 不是整数")
+            item['level'] = level
+        parsed.append(item)
+    return parsed
+
+
+def is_valid_response(content: str, fields, allow_empty=False) -> bool:
+    """能否按 Schema 解析（allow_empty=False 时还要求至少一个条目），用于决定是否写入响应缓存"""
+    try:
+        entries = parse_entries(content, fields)
+    except ValueError:
+        return False
+    return allow_empty or bool(entries)
+
+
+def entries_to_csv(entries, fields) -> str:
+    """转换为带表头的标准 CSV，页码为空时写 null（与模型 CSV 输出一致，交由 null 页码填充处理）"""
+    buffer = StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(fields)
+    for entry in entries:
+        writer.writerow(['null' if entry[field] is None else entry[field] for field in fields])
+    return buffer.getvalue().strip()
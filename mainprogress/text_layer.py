@@ -0,0 +1,273 @@
+import os
+import re
+import csv
+import unicodedata
+from io import StringIO
+from dataclasses import dataclass, field
+
+import fitz  # PyMuPDF
+
+# 文字层快速通道：不少"扫描版"PDF 已带有不可见的 OCR 文字层。
+# 这里用 page.get_text("dict") 按视觉行重建页面文字，依据"标题 …… 页码"行的密度判断目录页，
+# 并在本地直接提取 title/page_number；只有置信度不足的页面才交给视觉模型。
+# TEXT_LAYER_MODE=off 时完全关闭，恢复原有的纯视觉模型流程。
+TEXT_LAYER_MODE = os.getenv('TEXT_LAYER_MODE', 'auto')
+TEXT_LAYER_MIN_CONFIDENCE = float(os.getenv('TEXT_LAYER_MIN_CONFIDENCE', '0.75'))
+TEXT_LAYER_SCAN_PAGES = int(os.getenv('TEXT_LAYER_SCAN_PAGES', '60'))
+# 规则变更时递增，使阶段清单与结果缓存失效
+ENGINE_VERSION = '2'
+
+MIN_TEXT_CHARS = 30        # 少于该字符数视为没有文字层
+MIN_TOC_ENTRIES = 3        # 判定为目录页所需的最少条目数
+MIN_TOC_LINE_RATIO = 0.5   # 目录行占正文行的最低比例
+MAX_GARBAGE_RATIO = 0.02   # 乱码字符（替换符、私用区、控制符）比例上限
+MARGIN_RATIO = 0.06        # 页面上下边缘（页眉页脚）所占高度比例
+
+# 标题 + 引导点/空白 + 阿拉伯数字页码；罗马数字页码只在引导点之后识别，避免把 civil、mid 等单词当作页码
+TOC_LINE_RE = re.compile(
+    r'^(?P<title>.*?\S)(?:(?:\s*[.．·…•⋯_\-—]{2,}\s*|\s+)(?P<page>\d{1,4})'
+    r'|\s*[.．·…•⋯_\-—]{2,}\s*(?P<roman>[ivxlcdm]{1,7}|[IVXLCDM]{1,7}))$'
+)
+# 无页码但必然属于目录的篇、章级标题；整行只有 "Chapter 1"、"Part 2" 时先按标题处理，
+# 否则 TOC_LINE_RE 会把编号当作页码
+HEADING_RE = re.compile(r'^(第\s*[0-9一二三四五六七八九十百零〇]+\s*[篇章部卷编]|Part\s+\w+|PART\s+\w+|Chapter\s+\w+|CHAPTER\s+\w+)')
+HEADING_KEYWORDS = {'part', 'chapter'}
+LEADER_RE = re.compile(r'\s*[.．·…•⋯]{2,}\s*')
+CIRCLED_DIGITS = {chr(0x2460 + i): str(i + 1) for i in range(20)}
+
+
+@dataclass
+class TextLayerPage:
+    page_num: int
+    text_chars: int = 0
+    garbage_ratio: float = 0.0
+    line_count: int = 0
+    toc_line_count: int = 0
+    monotonic_ratio: float = 0.0
+    entries: list = field(default_factory=list)  # [(title, page_number 或 None)]
+
+    @property
+    def has_text(self) -> bool:
+        return self.text_chars >= MIN_TEXT_CHARS
+
+    @property
+    def toc_line_ratio(self) -> float:
+        return self.toc_line_count / self.line_count if self.line_count else 0.0
+
+    @property
+    def is_toc(self) -> bool:
+        numbered = sum(1 for _, page in self.entries if page is not None)
+        return (self.has_text and numbered >= MIN_TOC_ENTRIES
+                and self.toc_line_ratio >= MIN_TOC_LINE_RATIO)
+
+    @property
+    def is_toc_edge(self) -> bool:
+        """条目较少的目录首尾页（如只剩两三行的最后一页）"""
+        return (self.has_text and any(page is not None for _, page in self.entries)
+                and self.toc_line_ratio >= MIN_TOC_LINE_RATIO)
+
+    @property
+    def confidence(self) -> float:
+        """0~1：目录行越密集、页码越单调、乱码越少，置信度越高"""
+        if not self.is_toc or self.garbage_ratio > MAX_GARBAGE_RATIO:
+            return 0.0
+        return round(min(self.toc_line_ratio / 0.8, 1.0) * self.monotonic_ratio, 3)
+
+    @property
+    def confident(self) -> bool:
+        return self.confidence >= TEXT_LAYER_MIN_CONFIDENCE
+
+    def to_dict(self) -> dict:
+        return {
+            'page': self.page_num,
+            'text_chars': self.text_chars,
+            'lines': self.line_count,
+            'toc_lines': self.toc_line_count,
+            'toc_line_ratio': round(self.toc_line_ratio, 3),
+            'monotonic_ratio': round(self.monotonic_ratio, 3),
+            'garbage_ratio': round(self.garbage_ratio, 4),
+            'entries': len(self.entries),
+            'is_toc': self.is_toc,
+            'confidence': self.confidence,
+        }
+
+
+def enabled() -> bool:
+    return TEXT_LAYER_MODE != 'off'
+
+
+def engine_fingerprint() -> str:
+    """参与阶段清单与结果缓存键的文字层配置指纹"""
+    return f"{ENGINE_VERSION}|{TEXT_LAYER_MODE}|{TEXT_LAYER_MIN_CONFIDENCE}"
+
+
+def is_garbage_char(ch) -> bool:
+    if ch == '�':
+        return True
+    category = unicodedata.category(ch)
+    return category in ('Co', 'Cs') or (category == 'Cc' and ch not in '\t\n\r')
+
+
+def normalize_title(title: str) -> str:
+    """按提取提示词的规则清理标题：去引导点、带圈数字转阿拉伯数字、合并空白"""
+    title = LEADER_RE.sub(' ', title)
+    title = ''.join(CIRCLED_DIGITS.get(ch, ch) for ch in title)
+    return re.sub(r'\s+', ' ', title).strip(' .．·…•⋯_-—')
+
+
+def _page_spans(page):
+    spans = []
+    for block in page.get_text("dict").get("blocks", []):
+        if block.get("type") != 0:
+            continue
+        for line in block.get("lines", []):
+            for span in line.get("spans", []):
+                text = span.get("text", "")
+                if text.strip():
+                    spans.append((fitz.Rect(span["bbox"]), span.get("size", 0) or 1, text))
+    return spans
+
+
+def visual_rows(page):
+    """把各文本块中的片段按纵向位置归并为视觉行（目录的标题与页码常分属不同文本块），返回 [(y0, y1, [片段])]"""
+    rows = []
+    for rect, size, text in sorted(_page_spans(page), key=lambda s: (s[0].y0 + s[0].y1) / 2):
+        center = (rect.y0 + rect.y1) / 2
+        if rows and abs(center - rows[-1]['center']) <= max(rows[-1]['height'], rect.height) * 0.5:
+            row = rows[-1]
+            row['spans'].append((rect, size, text))
+            row['y0'], row['y1'] = min(row['y0'], rect.y0), max(row['y1'], rect.y1)
+        else:
+            rows.append({'center': center, 'height': rect.height, 'y0': rect.y0, 'y1': rect.y1,
+                         'spans': [(rect, size, text)]})
+    return [(row['y0'], row['y1'], sorted(row['spans'], key=lambda s: s[0].x0)) for row in rows]
+
+
+def _join_spans(spans) -> str:
+    """按水平间距拼接片段：间距超过约四分之一字号时补一个空格"""
+    text, last_x1 = '', None
+    for rect, size, span_text in spans:
+        if last_x1 is not None and rect.x0 - last_x1 > size * 0.25 and not text.endswith(' '):
+            text += ' '
+        text += span_text
+        last_x1 = rect.x1
+    return re.sub(r'\s+', ' ', text).strip()
+
+
+def _split_columns(spans, column_gap):
+    """双栏目录：行内出现超过 column_gap 的空白且左段本身就是完整目录行时，拆为两段"""
+    for i in range(1, len(spans)):
+        if spans[i][0].x0 - spans[i - 1][0].x1 > column_gap:
+            left = spans[:i]
+            if TOC_LINE_RE.match(_join_spans(left)):
+                return [left] + _split_columns(spans[i:], column_gap)
+            break
+    return [spans]
+
+
+def analyze_page(page, page_num: int) -> TextLayerPage:
+    result = TextLayerPage(page_num=page_num)
+    rows = visual_rows(page)
+    all_text = ''.join(text for _, _, spans in rows for _, _, text in spans)
+    chars = [ch for ch in all_text if not ch.isspace()]
+    result.text_chars = len(chars)
+    if not result.has_text:
+        return result
+    result.garbage_ratio = sum(1 for ch in chars if is_garbage_char(ch)) / len(chars)
+
+    height = page.rect.height or 1
+    column_gap = page.rect.width * 0.08
+    segments = []
+    two_columns = False
+    for y0, y1, spans in rows:
+        # 页眉页脚（书名、章节导航、页码）不计入
+        if y1 < height * MARGIN_RATIO or y0 > height * (1 - MARGIN_RATIO):
+            continue
+        parts = _split_columns(spans, column_gap)
+        two_columns = two_columns or len(parts) > 1
+        segments.extend((part[0][0].x0, y0, _join_spans(part)) for part in parts)
+    if two_columns:
+        # 双栏目录按"左栏自上而下，再右栏"排序
+        middle = page.rect.width / 2
+        segments.sort(key=lambda s: (s[0] > middle, s[1]))
+
+    numbers = []
+    for _, _, line in segments:
+        if len(line) < 2:
+            continue
+        result.line_count += 1
+        match = None if HEADING_RE.fullmatch(line) else TOC_LINE_RE.match(line)
+        if match:
+            title = normalize_title(match.group('title'))
+            if not re.search(r'[^\W\d_]', title) or title.lower() in HEADING_KEYWORDS:
+                continue
+            result.toc_line_count += 1
+            # 罗马数字页码（前言等）计入目录行密度，但下游只接受整数页码，不作为条目输出
+            if match.group('page'):
+                page_number = int(match.group('page'))
+                numbers.append(page_number)
+                result.entries.append((title, page_number))
+        elif HEADING_RE.match(line):
+            result.toc_line_count += 1
+            result.entries.append((normalize_title(line), None))
+
+    if len(numbers) >= 2:
+        ordered = sum(1 for a, b in zip(numbers, numbers[1:]) if b >= a)
+        result.monotonic_ratio = ordered / (len(numbers) - 1)
+    elif numbers:
+        result.monotonic_ratio = 1.0
+    return result
+
+
+def analyze_pages(pdf_path, page_numbers) -> dict:
+    """分析指定物理页（从 1 开始），返回 {页码: TextLayerPage}"""
+    results = {}
+    with fitz.open(pdf_path) as doc:
+        for page_num in page_numbers:
+            if 1 <= page_num <= len(doc):
+                results[page_num] = analyze_page(doc[page_num - 1], page_num)
+    return results
+
+
+def detect_toc_range(pdf_path, max_pages=TEXT_LAYER_SCAN_PAGES) -> dict:
+    """
+    扫描前 max_pages 页，返回 {'toc_start', 'toc_end', 'confident', 'pages'}。
+    取最长的连续目录页区间并向两侧扩展条目较少的首尾页；区间内至少一页置信度达标且未触及扫描上限时才视为可信，
+    否则调用方应回退到视觉模型。
+    """
+    with fitz.open(pdf_path) as doc:
+        total_pages = len(doc)
+        pages = [analyze_page(doc[i], i + 1) for i in range(min(max_pages, total_pages))]
+
+    report = {'toc_start': None, 'toc_end': None, 'confident': False, 'pages': [p.to_dict() for p in pages]}
+    best = None
+    run = []
+    for page in pages + [None]:
+        if page is not None and page.is_toc:
+            run.append(page)
+            continue
+        if run and (best is None or len(run) > len(best)):
+            best = run
+        run = []
+    if not best:
+        return report
+
+    start, end = best[0].page_num, best[-1].page_num
+    while start > 1 and pages[start - 2].is_toc_edge:
+        start -= 1
+    while end < len(pages) and pages[end].is_toc_edge:
+        end += 1
+    report['toc_start'], report['toc_end'] = start, end
+    reaches_limit = end >= max_pages and total_pages > max_pages
+    report['confident'] = (not reaches_limit and max(p.confidence for p in best) >= TEXT_LAYER_MIN_CONFIDENCE)
+    return report
+
+
+def entries_to_csv(entries) -> str:
+    """转换为与视觉模型输出一致的 title,page_number CSV（页码缺失的行留空，由 fix_null_page_numbers 填充）"""
+    buffer = StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(['title', 'page_number'])
+    for title, page_number in entries:
+        writer.writerow([title, '' if page_number is None else page_number])
+    return buffer.getvalue().strip()
@@ -0,0 +1,65 @@
+import os
+import sys
+import asyncio
+from pathlib import Path
+from dotenv import load_dotenv
+
+PROJECT_ROOT = str(Path(__file__).resolve().parent.parent)
+sys.path.append(PROJECT_ROOT)
+
+from mainprogress.stage_context import StageError, run_async
+from mainprogress import qwen_vl_extract, determine_toc_levels
+
+# 流水线模式：在同一个事件循环中同时执行目录数据提取与层级判定。
+# 某页的 CSV 一写出即通过队列交给层级判定，不再等待全部页面提取完成，
+# 最慢的一次提取请求不再叠加到层级判定的关键路径上。
+# 之后的 determine_toc_levels 阶段会按阶段清单逐页跳过已完成的页面，只执行层级后处理。
+
+
+async def extract_and_determine(input_path, output_path, llm_config: dict):
+    queue = asyncio.Queue()
+
+    def on_page_done(img_file, ok):
+        queue.put_nowait((img_file, ok))
+
+    async def ready_pages():
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            yield item
+
+    async def extract():
+        try:
+            await qwen_vl_extract.extract_csv(input_path, output_path, llm_config, on_page_done=on_page_done)
+        finally:
+            queue.put_nowait(None)
+
+    await asyncio.gather(
+        extract(),
+        determine_toc_levels.determine_levels(input_path, output_path, llm_config, ready_pages=ready_pages()),
+    )
+
+
+def run_stage(input_dir, output_dir, llm_config: dict):
+    """阶段入口：流水线模式下替代 qwen_vl_extract 的阶段入口"""
+    run_async(extract_and_determine(input_dir, output_dir, llm_config))
+
+
+async def main_async():
+    load_dotenv()
+    input_dir = os.getenv("QWEN_VL_EXTRACT_INPUT")
+    output_dir = os.getenv("QWEN_VL_EXTRACT_OUTPUT")
+    if not input_dir or not output_dir:
+        print("错误：未设置必要的环境变量 QWEN_VL_EXTRACT_INPUT 或 QWEN_VL_EXTRACT_OUTPUT")
+        sys.exit(1)
+    await extract_and_determine(input_dir, output_dir, qwen_vl_extract.load_llm_config())
+
+
+if __name__ == "__main__":
+    if sys.platform == 'win32':
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+    try:
+        asyncio.run(main_async())
+    except StageError:
+        sys.exit(1)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# 与 benchmark 脚本一致：把项目根目录加入导入路径，测试中按 mainprogress.xxx 导入
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,54 @@
+import pytest
+
+from mainprogress.llm_scheduler import StreamAborted
+from mainprogress.qwen_vl_extract import StreamingCsvCheck, fix_null_page_numbers, split_batch_response
+
+
+def test_split_batch_response_sections_in_order():
+    content = "```csv\n=== PAGE 1 ===\ntitle,page_number\n第一章，1\n=== PAGE 2 ===\n第二章,9\n```"
+    assert split_batch_response(content, 2) == ["title,page_number\n第一章,1", "title,page_number\n第二章,9"]
+
+
+def test_split_batch_response_empty_page_keeps_header():
+    content = "=== PAGE 1 ===\ntitle,page_number\n序言,1\n=== page 2 ===\n"
+    assert split_batch_response(content, 2) == ["title,page_number\n序言,1", "title,page_number"]
+
+
+@pytest.mark.parametrize("content", [
+    "=== PAGE 1 ===\ntitle,page_number\n第一章,1",                                  # 少一段
+    "=== PAGE 2 ===\ntitle,page_number\n第二章,9\n=== PAGE 1 ===\ntitle,page_number",  # 顺序错误
+    "title,page_number\n第一章,1\n第二章,9",                                          # 没有标记
+])
+def test_split_batch_response_rejects_wrong_markers(content):
+    assert split_batch_response(content, 2) is None
+
+
+def test_split_batch_response_rejects_invalid_section():
+    content = "=== PAGE 1 ===\ntitle,page_number\n只有标题\n=== PAGE 2 ===\ntitle,page_number\n第二章,9"
+    assert split_batch_response(content, 2) is None
+
+
+def test_streaming_check_accepts_rows_split_across_chunks():
+    check = StreamingCsvCheck()
+    for delta in ("```csv\ntitle,page", "_number\n第一章，", "1\n第二", "章,9\n```"):
+        check.feed(delta)
+    assert check.first_row_at is not None
+
+
+def test_streaming_check_aborts_on_unfixable_row():
+    check = StreamingCsvCheck()
+    check.feed("title,page_number\n第一章,1\n")
+    with pytest.raises(StreamAborted, match="第 3 行"):
+        check.feed("这一行没有页码\n")
+
+
+def test_streaming_check_aborts_on_bad_header():
+    with pytest.raises(StreamAborted, match="表头"):
+        StreamingCsvCheck().feed("以下是目录：\n")
+
+
+def test_fix_null_page_numbers_fills_from_next_then_previous():
+    content = "title,page_number,level\n第一篇,null,1\n第一章,3,2\n第二章,9,2\n附录,null,1"
+    assert fix_null_page_numbers(content).splitlines() == [
+        "title,page_number,level", "第一篇,3,1", "第一章,3,2", "第二章,9,2", "附录,9,1",
+    ]
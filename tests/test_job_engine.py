@@ -0,0 +1,71 @@
+import json
+import time
+
+from mainprogress import job_engine
+from mainprogress.job_engine import JobEngine, JOB_COMPLETED, JOB_FAILED
+
+
+def wait_finished(engine, session_id, base_dir):
+    engine.submit(session_id, base_dir)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        job = engine.get(session_id, base_dir)
+        if job['state'] in (JOB_COMPLETED, JOB_FAILED):
+            return job
+        time.sleep(0.01)
+    raise AssertionError('作业未在 10 秒内结束')
+
+
+def test_failure_message_counts_retries(tmp_path):
+    engine = JobEngine([('s1', '阶段1')], lambda name, base_dir: (1, '', 'boom'), max_retries=3, retry_delay=0)
+    job = wait_finished(engine, 'a', str(tmp_path))
+    assert job['state'] == JOB_FAILED
+    assert job['message'] == '阶段1执行失败，已重试2次'
+    assert [stage['attempt'] for stage in job['stages']] == [1, 2, 3]
+
+
+def test_retry_waits_for_previous_attempt(tmp_path):
+    alive_until = {'t': 0.0}
+    calls = []
+
+    def execute(name, base_dir):
+        calls.append(time.time())
+        if len(calls) == 1:
+            alive_until['t'] = time.time() + 0.3
+            raise TimeoutError('timeout')
+        return 0, '', ''
+
+    engine = JobEngine([('s1', '阶段1')], execute, retry_delay=0.01,
+                       stage_alive=lambda base_dir: time.time() < alive_until['t'])
+    job = wait_finished(engine, 'a', str(tmp_path))
+    assert job['state'] == JOB_COMPLETED
+    assert calls[1] >= alive_until['t']
+
+
+def test_retry_gives_up_when_previous_attempt_never_exits(tmp_path):
+    engine = JobEngine([('s1', '阶段1')], lambda name, base_dir: (1, '', ''), retry_delay=0.01,
+                       stage_alive=lambda base_dir: True, attempt_wait=0.05)
+    job = wait_finished(engine, 'a', str(tmp_path))
+    assert job['state'] == JOB_FAILED
+    assert len(job['stages']) == 1
+
+
+def test_running_status_from_previous_process_is_interrupted(tmp_path):
+    (tmp_path / job_engine.JOB_STATUS_FILENAME).write_text(
+        json.dumps({'session_id': 'a', 'state': 'running', 'stages': []}), encoding='utf-8')
+    job = JobEngine([('s1', '阶段1')], lambda name, base_dir: (0, '', '')).get('a', str(tmp_path))
+    assert job['state'] == JOB_FAILED and job['interrupted']
+    saved = json.loads((tmp_path / job_engine.JOB_STATUS_FILENAME).read_text(encoding='utf-8'))
+    assert saved['state'] == JOB_FAILED
+
+
+def test_finished_jobs_are_pruned(tmp_path, monkeypatch):
+    monkeypatch.setattr(job_engine, 'JOB_MAX_FINISHED', 2)
+    engine = JobEngine([('s1', '阶段1')], lambda name, base_dir: (0, '', ''), max_workers=1)
+    for session_id in ('a', 'b', 'c'):
+        session_dir = tmp_path / session_id
+        session_dir.mkdir()
+        wait_finished(engine, session_id, str(session_dir))
+    assert sorted(engine._jobs) == ['b', 'c']
+    # 被淘汰的作业仍可从状态文件读取
+    assert engine.get('a', str(tmp_path / 'a'))['state'] == JOB_COMPLETED
@@ -0,0 +1,151 @@
+import asyncio
+import time
+from email.utils import formatdate
+from types import SimpleNamespace
+
+import pytest
+from openai import RateLimitError
+
+from mainprogress import llm_scheduler
+from mainprogress.llm_scheduler import DEFAULT_RETRY_AFTER, MAX_RETRY_AFTER, LLMScheduler, parse_retry_after
+
+
+def rate_limit_error(headers):
+    """只携带响应头的 429 异常，不依赖 SDK 的 HTTP 实现"""
+    error = RateLimitError.__new__(RateLimitError)
+    Exception.__init__(error, 'rate limited')
+    error.response = SimpleNamespace(status_code=429, headers=headers)
+    return error
+
+
+class FakeCompletions:
+    def __init__(self, failures):
+        self.failures = list(failures)
+        self.calls = 0
+
+    async def create(self, **kwargs):
+        self.calls += 1
+        if self.failures:
+            raise self.failures.pop(0)
+        return SimpleNamespace(model=kwargs.get('model'))
+
+
+class FakeClient:
+    max_retries = 2
+
+    def __init__(self, failures=()):
+        self.completions = FakeCompletions(failures)
+        self.chat = SimpleNamespace(completions=self.completions)
+        self.options = None
+
+    def with_options(self, **options):
+        self.options = options
+        return self
+
+
+def test_parse_retry_after_headers():
+    assert parse_retry_after(rate_limit_error({'retry-after-ms': '250'})) == 0.25
+    assert parse_retry_after(rate_limit_error({'retry-after': '3'})) == 3.0
+    assert parse_retry_after(rate_limit_error({'retry-after': '3600'})) == MAX_RETRY_AFTER
+    assert parse_retry_after(rate_limit_error({})) == DEFAULT_RETRY_AFTER
+    assert parse_retry_after(rate_limit_error({'retry-after': 'soon'})) == DEFAULT_RETRY_AFTER
+    assert parse_retry_after(Exception('no response')) == DEFAULT_RETRY_AFTER
+    http_date = formatdate(time.time() + 5, usegmt=True)
+    assert 3 <= parse_retry_after(rate_limit_error({'retry-after': http_date})) <= 5
+
+
+def test_token_bucket_limits_request_rate():
+    scheduler = LLMScheduler(rate=20, burst=2, initial_concurrency=8)
+
+    async def run():
+        started = time.monotonic()
+        for _ in range(6):
+            await scheduler.acquire('s')
+            scheduler._release()
+        return time.monotonic() - started
+
+    # 桶内 2 个令牌立即放行，其余 4 个按 20/s 补充
+    elapsed = asyncio.run(run())
+    assert 0.15 <= elapsed < 1.0
+
+
+def test_concurrency_limit_blocks_until_release():
+    scheduler = LLMScheduler(rate=1000, burst=10, initial_concurrency=2)
+
+    async def run():
+        await scheduler.acquire('s')
+        await scheduler.acquire('s')
+        third = asyncio.ensure_future(scheduler.acquire('s'))
+        await asyncio.sleep(0.05)
+        blocked = not third.done()
+        scheduler._release()
+        await asyncio.wait_for(third, 1)
+        return blocked
+
+    assert asyncio.run(run())
+    assert scheduler.stats()['in_flight'] == 2
+
+
+def test_aimd_increase_and_decrease(monkeypatch):
+    scheduler = LLMScheduler(initial_concurrency=4, min_concurrency=1, max_concurrency=5)
+    scheduler._on_success(1.0)
+    assert scheduler._limit == pytest.approx(4.25)
+
+    scheduler._on_rate_limited(1.5)
+    assert scheduler._limit == pytest.approx(2.125)
+    assert scheduler.is_throttled()
+    # 冷却期内的第二次 429 只延长暂停，不再收缩
+    scheduler._on_rate_limited(3.0)
+    assert scheduler._limit == pytest.approx(2.125)
+    assert scheduler.stats()['paused_for'] > 2
+    assert scheduler.stats()['rate_limited'] == 2
+
+    monkeypatch.setattr(llm_scheduler, 'DECREASE_COOLDOWN', 0)
+    for _ in range(5):
+        scheduler._on_rate_limited(0)
+    assert scheduler._limit == 1
+
+    for _ in range(100):
+        scheduler._on_success(1.0)
+    assert scheduler._limit == 5
+
+
+def test_latency_growth_shrinks_limit(monkeypatch):
+    monkeypatch.setattr(llm_scheduler, 'DECREASE_COOLDOWN', 0)
+    scheduler = LLMScheduler(initial_concurrency=10, latency_factor=2.0)
+    scheduler._on_success(1.0)
+    limit = scheduler._limit
+    for _ in range(10):
+        scheduler._on_success(10.0)
+    assert scheduler._limit < limit
+
+
+def test_rate_limited_request_is_retried_after_pause():
+    scheduler = LLMScheduler(rate=100, burst=10, initial_concurrency=4)
+    client = FakeClient([rate_limit_error({'retry-after-ms': '200'})])
+
+    started = time.monotonic()
+    response = asyncio.run(scheduler.create_chat_completion(client, session='book', model='m'))
+    elapsed = time.monotonic() - started
+
+    assert response.model == 'm'
+    assert client.completions.calls == 2
+    assert client.options == {'max_retries': 0}
+    assert elapsed >= 0.2
+    stats = scheduler.stats()
+    assert stats['rate_limited'] == 1 and stats['succeeded'] == 1 and stats['failed'] == 0
+    assert stats['concurrency_limit'] < 4
+    assert stats['in_flight'] == 0
+    assert stats['per_session']['book']['requests'] == 2
+
+
+def test_rate_limit_gives_up_after_retries(monkeypatch):
+    monkeypatch.setattr(llm_scheduler, 'RATE_LIMIT_RETRIES', 1)
+    scheduler = LLMScheduler(rate=100, burst=10)
+    client = FakeClient([rate_limit_error({'retry-after-ms': '10'}) for _ in range(3)])
+
+    with pytest.raises(RateLimitError):
+        asyncio.run(scheduler.create_chat_completion(client, session='book', model='m'))
+    assert client.completions.calls == 2
+    assert scheduler.stats()['failed'] == 1
+    assert scheduler.stats()['in_flight'] == 0
@@ -0,0 +1,52 @@
+import numpy as np
+
+from mainprogress.page_prefilter import SKIP_BLANK, SKIP_PICTURE, analyze_gray
+
+WIDTH, HEIGHT = 600, 800
+
+
+def blank_page():
+    return np.full((HEIGHT, WIDTH), 250, dtype=np.uint8)
+
+
+def text_page(number_column):
+    """每行左侧一段标题；number_column 时行尾在同一位置另有一段窄页码"""
+    gray = blank_page()
+    for row in range(15):
+        top = 60 + row * 40
+        gray[top:top + 12, 60:60 + 180 + (row % 4) * 30] = 20
+        if number_column:
+            gray[top:top + 12, 520:540] = 20
+    return gray
+
+
+def test_blank_page_is_skipped():
+    stats = analyze_gray(blank_page(), 1)
+    assert stats.skip == SKIP_BLANK
+    assert stats.text_lines == 0
+
+
+def test_toc_like_page_scores_number_column():
+    stats = analyze_gray(text_page(number_column=True), 3)
+    assert stats.skip is None
+    assert stats.text_lines == 15
+    assert stats.number_lines == 15
+    assert stats.toc_score == 1.0
+
+
+def test_body_text_page_has_no_toc_score():
+    stats = analyze_gray(text_page(number_column=False), 4)
+    assert stats.skip is None and stats.text_lines == 15
+    assert stats.toc_score == 0.0
+
+
+def test_full_page_picture_is_skipped():
+    gray = blank_page()
+    gray[40:760, 40:560] = 150
+    gray[100:112, 80:300] = 20
+    stats = analyze_gray(gray, 1)
+    assert stats.skip == SKIP_PICTURE
+
+
+def test_empty_array_is_blank():
+    assert analyze_gray(np.zeros((0, 0), dtype=np.uint8), 1).skip == SKIP_BLANK
@@ -0,0 +1,31 @@
+import fitz
+
+from mainprogress.pdf_fast_path import offset_from_page_labels
+
+
+def make_doc(pages, labels):
+    doc = fitz.open()
+    for _ in range(pages):
+        doc.new_page()
+    if labels:
+        doc.set_page_labels(labels)
+    return doc
+
+
+def test_offset_from_arabic_section():
+    # 物理第 1-4 页为罗马数字，第 5 页起印刷页码从 1 开始
+    doc = make_doc(20, [{'startpage': 0, 'style': 'r'}, {'startpage': 4, 'style': 'D', 'firstpagenum': 1}])
+    assert offset_from_page_labels(doc) == 4
+
+
+def test_offset_uses_largest_arabic_section():
+    doc = make_doc(20, [{'startpage': 0, 'style': 'D', 'firstpagenum': 1},
+                        {'startpage': 2, 'style': 'D', 'firstpagenum': 3, 'prefix': 'A-'},
+                        {'startpage': 6, 'style': 'D', 'firstpagenum': 11}])
+    assert offset_from_page_labels(doc) == 6 + 1 - 11
+
+
+def test_no_offset_without_labels_or_coverage():
+    assert offset_from_page_labels(make_doc(10, None)) is None
+    doc = make_doc(20, [{'startpage': 0, 'style': 'r'}, {'startpage': 15, 'style': 'D', 'firstpagenum': 1}])
+    assert offset_from_page_labels(doc) is None
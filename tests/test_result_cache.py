@@ -0,0 +1,40 @@
+import os
+import json
+
+from mainprogress import result_cache
+from mainprogress.result_cache import ResultCache
+
+LLM_CONFIG = {"api_key": "sk-test", "base_url": "http://127.0.0.1/v1", "model": "fake-model", "routes": {}}
+
+
+def make_session(tmp_path):
+    base_dir = tmp_path / 'session'
+    (base_dir / 'input_pdf').mkdir(parents=True)
+    (base_dir / 'input_pdf' / 'book.pdf').write_bytes(b'%PDF-1.4')
+    (base_dir / 'input_pdf' / 'book.json').write_text(json.dumps({"pdf_sha256": "abc"}), encoding='utf-8')
+    return base_dir
+
+
+def test_restore_replaces_stale_final_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(result_cache, 'result_cache', ResultCache(root=str(tmp_path / 'cache')))
+    base_dir = make_session(tmp_path)
+    final_dir = base_dir / 'level_adjusted_content'
+    final_dir.mkdir()
+    (final_dir / 'outline_final.json').write_text('[]', encoding='utf-8')
+
+    final_data = [{"title": "第一章", "number": 1, "level": 1}]
+    key = result_cache.compute_cache_key("abc", LLM_CONFIG)
+    result_cache.result_cache.store(key, final_data, {"toc_start": 3, "toc_end": 4, "content_start": 6})
+
+    assert result_cache.restore_session(str(base_dir), LLM_CONFIG)
+    assert sorted(os.listdir(final_dir)) == ['book_final.json']
+    assert json.loads((final_dir / 'book_final.json').read_text(encoding='utf-8')) == final_data
+    info = json.loads((base_dir / 'input_pdf' / 'book.json').read_text(encoding='utf-8'))
+    assert info['toc_start'] == 3 and info['content_start'] == 6 and info['result_cache_hit']
+
+
+def test_restore_misses_without_entry(tmp_path, monkeypatch):
+    monkeypatch.setattr(result_cache, 'result_cache', ResultCache(root=str(tmp_path / 'cache')))
+    base_dir = make_session(tmp_path)
+    assert not result_cache.restore_session(str(base_dir), LLM_CONFIG)
+    assert not (base_dir / 'level_adjusted_content').exists()
@@ -0,0 +1,50 @@
+from mainprogress.stage_manifest import StageManifest, hash_values
+
+STAGE = 'qwen_vl_extract'
+
+
+def write_unit(manifest, tmp_path, name, text, input_hash):
+    output = tmp_path / 'raw_content' / f'{name}.csv'
+    output.parent.mkdir(exist_ok=True)
+    output.write_text(text, encoding='utf-8')
+    manifest.record_unit(STAGE, f'{name}.jpg', input_hash, str(output))
+    return output
+
+
+def test_get_unit_requires_same_input_and_intact_output(tmp_path):
+    manifest = StageManifest(str(tmp_path))
+    input_hash = hash_values('page_1.jpg', 'model-a')
+    output = write_unit(manifest, tmp_path, 'page_1', 'title,page_number\n第一章,1', input_hash)
+
+    record = StageManifest(str(tmp_path)).get_unit(STAGE, 'page_1.jpg', input_hash)
+    assert record['output'] == 'raw_content/page_1.csv'
+    assert manifest.get_unit(STAGE, 'page_1.jpg', hash_values('page_1.jpg', 'model-b')) is None
+    assert manifest.get_unit(STAGE, 'page_2.jpg', input_hash) is None
+
+    output.write_text('title,page_number\n第一章,2', encoding='utf-8')
+    assert manifest.get_unit(STAGE, 'page_1.jpg', input_hash) is None
+    output.unlink()
+    assert manifest.get_unit(STAGE, 'page_1.jpg', input_hash) is None
+
+
+def test_refresh_units_accepts_rewritten_output(tmp_path):
+    manifest = StageManifest(str(tmp_path))
+    output = write_unit(manifest, tmp_path, 'page_1', 'title,page_number\n第一章,null', 'h1')
+    output.write_text('title,page_number\n第一章,1', encoding='utf-8')
+    manifest.refresh_units(STAGE)
+    assert manifest.get_unit(STAGE, 'page_1.jpg', 'h1') is not None
+
+
+def test_prune_units_removes_records_and_outputs(tmp_path):
+    manifest = StageManifest(str(tmp_path))
+    kept = write_unit(manifest, tmp_path, 'page_1', 'a,1', 'h1')
+    dropped = write_unit(manifest, tmp_path, 'page_2', 'b,2', 'h2')
+    manifest.prune_units(STAGE, ['page_1.jpg'])
+    assert kept.exists() and not dropped.exists()
+    assert manifest.get_unit(STAGE, 'page_1.jpg', 'h1') is not None
+    assert manifest.get_unit(STAGE, 'page_2.jpg', 'h2') is None
+
+
+def test_hash_values_is_order_sensitive_and_stable():
+    assert hash_values('a', 1, None) == hash_values('a', 1, None)
+    assert hash_values('a', 'b') != hash_values('b', 'a')
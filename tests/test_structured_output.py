@@ -0,0 +1,62 @@
+import json
+
+import pytest
+
+from mainprogress import fused_toc, structured_output
+from mainprogress.structured_output import EXTRACT_FIELDS, LEVEL_FIELDS, entries_to_csv, parse_entries
+
+
+def test_parse_entries_strips_titles_and_keeps_null_pages():
+    content = json.dumps({"entries": [{"title": " 第一章 ", "page_number": 1}, {"title": "第一篇", "page_number": None}]})
+    assert parse_entries(content, EXTRACT_FIELDS) == [
+        {"title": "第一章", "page_number": 1}, {"title": "第一篇", "page_number": None},
+    ]
+
+
+@pytest.mark.parametrize("content", [
+    "title,page_number\n第一章,1",
+    json.dumps([{"title": "第一章", "page_number": 1}]),
+    json.dumps({"entries": [{"title": "第一章", "page_number": "1"}]}),
+    json.dumps({"entries": [{"title": "第一章", "page_number": True}]}),
+    json.dumps({"entries": [{"title": 1, "page_number": 1}]}),
+    json.dumps({"entries": ["第一章"]}),
+    json.dumps({"entries": [{"title": "第一章", "page_number": 1}]}),  # 缺少 level
+])
+def test_parse_entries_rejects_wrong_structure(content):
+    with pytest.raises(ValueError):
+        parse_entries(content, LEVEL_FIELDS)
+
+
+def test_entries_to_csv_quotes_commas_and_writes_null():
+    entries = [{"title": "总论, 上", "page_number": None, "level": 1}]
+    assert entries_to_csv(entries, LEVEL_FIELDS) == 'title,page_number,level\n"总论, 上",null,1'
+
+
+def test_is_valid_response_empty_entries():
+    content = json.dumps({"entries": []})
+    assert not structured_output.is_valid_response(content, EXTRACT_FIELDS)
+    assert structured_output.is_valid_response(content, EXTRACT_FIELDS, allow_empty=True)
+
+
+def test_parse_fused_content_csv_fills_null_pages(monkeypatch):
+    monkeypatch.setattr(structured_output, 'LLM_OUTPUT_MODE', structured_output.OUTPUT_MODE_CSV)
+    content = "```csv\ntitle,page_number,level\n第一篇 总论,null,1\n第一章，绪论，3，2\n```"
+    parsed, csv_text = fused_toc.parse_fused_content(content, "page_1.jpg")
+    assert csv_text.splitlines()[1] == "第一篇 总论,3,1"
+    assert [(item['text'], item['number'], item['level']) for item in parsed] == [
+        ("第一篇 总论", 3, 1), ("第一章，绪论", 3, 2),
+    ]
+
+
+def test_parse_fused_content_structured(monkeypatch):
+    monkeypatch.setattr(structured_output, 'LLM_OUTPUT_MODE', structured_output.OUTPUT_MODE_JSON_SCHEMA)
+    content = json.dumps({"entries": [{"title": "第一篇", "page_number": None, "level": 1},
+                                      {"title": "第一章", "page_number": 5, "level": 2}]})
+    parsed, _ = fused_toc.parse_fused_content(content, "page_1.jpg")
+    assert [(item['text'], item['number'], item['level']) for item in parsed] == [("第一篇", 5, 1), ("第一章", 5, 2)]
+
+
+def test_parse_fused_content_structured_rejects_csv(monkeypatch):
+    monkeypatch.setattr(structured_output, 'LLM_OUTPUT_MODE', structured_output.OUTPUT_MODE_JSON_SCHEMA)
+    with pytest.raises(ValueError):
+        fused_toc.parse_fused_content("title,page_number,level\n第一章,1,1", "page_1.jpg")
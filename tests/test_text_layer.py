@@ -0,0 +1,35 @@
+import fitz
+
+from mainprogress import text_layer
+
+
+def make_page(lines):
+    doc = fitz.open()
+    page = doc.new_page()
+    for i, line in enumerate(lines):
+        page.insert_text((72, 120 + i * 24), line, fontsize=11)
+    return doc, page
+
+
+def test_bare_heading_lines_are_headings_not_entries():
+    doc, page = make_page(["Chapter 1", "Introduction ........ 3", "Part 2", "Methods ........ 15",
+                           "Results ........ 27", "Chapter 12 Appendix ........ 40"])
+    result = text_layer.analyze_page(page, 5)
+    doc.close()
+    assert result.entries == [
+        ("Chapter 1", None),
+        ("Introduction", 3),
+        ("Part 2", None),
+        ("Methods", 15),
+        ("Results", 27),
+        ("Chapter 12 Appendix", 40),
+    ]
+    assert result.toc_line_count == 6
+    assert result.monotonic_ratio == 1.0
+
+
+def test_heading_keyword_alone_is_not_a_title():
+    doc, page = make_page(["Chapter ........ 7", "Preface ........ 1", "Contents of the book"])
+    result = text_layer.analyze_page(page, 2)
+    doc.close()
+    assert result.entries == [("Preface", 1)]
@@ -0,0 +1,89 @@
+import json
+import asyncio
+from types import SimpleNamespace
+
+import fitz
+import pytest
+
+from mainprogress import pdf_metadata_extractor as extractor
+from mainprogress import page_prefilter
+from mainprogress.artifact_sink import ArtifactSink, LEVEL_OFF
+from mainprogress.page_prefilter import PageStats
+
+TOC_PAGES = {9, 10, 11}
+
+
+def make_pdf(path, pages):
+    doc = fitz.open()
+    for _ in range(pages):
+        doc.new_page()
+    doc.save(path)
+    doc.close()
+    return str(path)
+
+
+def completion(content):
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+
+@pytest.fixture
+def fake_search(monkeypatch, tmp_path):
+    """
+    窗口请求按 responses 中的 (延迟秒数, toc_start, toc_end) 返回；单页投票按 TOC_PAGES 判定。
+    预筛选给真实目录页正的 toc_score，其余页面为 0。
+    """
+    responses = {}
+    finished = []
+
+    async def fake_concat_pages(pdf_path, page_numbers, save_path=None):
+        return 'img'
+
+    async def fake_fetch(client, model, b64_img, start_p, end_p, artifacts=None):
+        delay, toc_start, toc_end = responses.get(start_p, (0, None, None))
+        await asyncio.sleep(delay)
+        finished.append(start_p)
+        return json.dumps({"toc_start": toc_start, "toc_end": toc_end})
+
+    async def fake_chat_completion(client, **kwargs):
+        page = int(kwargs['messages'][0]['content'][0]['text'].split('物理页码为 ')[1].split('。')[0])
+        return completion(json.dumps({"is_toc": page in TOC_PAGES}))
+
+    async def fake_run_in_pool(func, pdf_path, pages):
+        return {p: PageStats(page=p, text_lines=20, number_lines=15 if p in TOC_PAGES else 0,
+                             toc_score=0.75 if p in TOC_PAGES else 0.0) for p in pages}
+
+    monkeypatch.setattr(extractor, 'concat_pages', fake_concat_pages)
+    monkeypatch.setattr(extractor, 'fetch_toc_from_image', fake_fetch)
+    monkeypatch.setattr(extractor, 'chat_completion', fake_chat_completion)
+    monkeypatch.setattr(extractor, 'run_in_pool', fake_run_in_pool)
+    monkeypatch.setattr(extractor, 'TOC_SEARCH_MODE', 'adaptive')
+    monkeypatch.setattr(page_prefilter, 'PAGE_PREFILTER', True)
+    pdf_path = make_pdf(tmp_path / 'book.pdf', 20)
+
+    def run():
+        artifacts = ArtifactSink(str(tmp_path / 'artifacts'), level=LEVEL_OFF)
+        return asyncio.run(extractor.extract_toc_info(pdf_path, None, 'fake-model', artifacts))
+
+    return responses, finished, run
+
+
+def test_early_false_positive_does_not_cancel_real_toc(fake_search):
+    responses, finished, run = fake_search
+    # 1-4 最先返回且误判第 2 页为目录，真实目录 9-11 所在窗口最后返回
+    responses.update({1: (0, 2, 2), 5: (0.05, None, None), 9: (0.1, 9, 11)})
+    assert run() == (9, 11)
+
+
+def test_windows_after_confirmed_toc_are_cancelled(fake_search):
+    responses, finished, run = fake_search
+    responses.update({5: (0.02, None, None), 9: (0, 9, 11), 13: (0, None, None), 17: (1, None, None)})
+    assert run() == (9, 11)
+    assert 17 not in finished
+
+
+def test_window_with_positive_toc_score_is_not_cancelled(fake_search):
+    responses, finished, run = fake_search
+    # 误判的 2-3 页先确认结束，疑似目录页所在的 9-12 窗口不因此被取消
+    responses.update({1: (0, 2, 3), 5: (0, None, None), 9: (0.05, 9, 11), 13: (0.2, None, None)})
+    assert run() == (9, 11)
+    assert 9 in finished